@@ -0,0 +1,186 @@
+# coding: utf-8
+
+"""
+Rule ablation: precision, recall and F1 against a reference (see
+eval/score.py) with each rule disabled in turn, and with each rule that is
+off by default (L{detect.OFF_RULES}) enabled in turn (and all of them at
+once), next to the scores with the default rules.
+All variants are evaluated in a single pass over the corpus, with each poem
+read and parsed once (or read from a feature store, -s). Per poem, a variant
+is only run when it can change the results: disabling a rule changes nothing
+in a poem where the rule was not selected for any boundary, and enabling
+rules that are off changes nothing where none of them is selected with all
+of them enabled.
+Requires NumPy (for eval/score.py).
+"""
+
+__author__ = 'Pablo Ruiz'
+__date__ = '19/10/26'
+__email__ = 'pabloruizfabo@gmail.com'
+
+
+import argparse
+import codecs
+import os
+import time
+
+# add current dir
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(here)
+sys.path.append(os.path.join(here, "eval"))
+
+# app specific imports
+import config as cfg
+import detect as dt
+import score as sc
+import sweep as sw
+
+
+HEADER = ["variant", "rule_id", "poems_run", "span_precis", "span_recall",
+          "span_fscore", "typed_precis", "typed_recall", "typed_fscore",
+          "span_fscore_diff", "typed_fscore_diff"]
+
+
+def run_argparse():
+    """
+    Run the argparse-based cli parser for options or defaults
+    """
+    parser = argparse.ArgumentParser(
+        description="Scores with each rule disabled, or enabled if off "
+                    "by default",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-r', '--rffile', required=True,
+                        help='Reference (standoff) file')
+    parser.add_argument('-i', '--input', dest='inname',
+                        help='Input dir (contains PoS and term-id annotations)')
+    parser.add_argument('-n', '--nlpdir',
+                        help='Dir containing NLP output (NAF from IXA pipes)')
+    parser.add_argument('-s', '--store',
+                        help='Read poems from this feature store instead '
+                             '(see feature_store.py)')
+    parser.add_argument('-o', '--outfile', help='Output file (else stdout)')
+    parser.add_argument('-c', '--constituency', action='store_true',
+                        help='Use constituency info')
+    parser.add_argument('-d', '--dependency', action='store_true',
+                        help='Use dependency info')
+    parser.add_argument('-5', '--m14', action='store_true',
+                        help='Allow rule application above 14 lines')
+    parser.set_defaults(constituency=cfg.USE_CONSTITUENCY,
+                        dependency=cfg.USE_DEP, m14=cfg.MORE14)
+    return parser.parse_args()
+
+
+def ablation_variants():
+    """
+    Rule sets to evaluate
+    @return: list of (variant, rule-id, disabled rule-ids): the default rules
+    ('baseline'), each default rule disabled ('disable'), each rule off by
+    default enabled ('enable'), and all rules enabled ('enable', 'all')
+    """
+    todo = [("baseline", u"", dt.OFF_RULES)]
+    todo.extend(("disable", rid, dt.OFF_RULES | set([rid]))
+                for rid in dt.RULE_IDS if rid not in dt.OFF_RULES)
+    todo.extend(("enable", rid, dt.OFF_RULES - set([rid]))
+                for rid in dt.RULE_IDS if rid in dt.OFF_RULES)
+    todo.append(("enable", u"all", frozenset()))
+    return todo
+
+
+def ablate(poems, todo, useconst=cfg.USE_CONSTITUENCY, usedep=cfg.USE_DEP,
+           m14=cfg.MORE14):
+    """
+    Run detection for each variant
+    @param poems: iterable of (filename, tokens, features), see
+    L{sweep.read_poems}
+    @param todo: variants as output by L{ablation_variants}
+    @return: list with the standoff rows for each variant (see
+    L{detect.standoff_rows}), and the number of poems each variant was run on
+    """
+    lxinfo = dt.load_resources()
+    rows = [[] for variant in todo]
+    runs = [0] * len(todo)
+
+    def detect_rows(fn, toks, feats, disabled, fired=None):
+        ana = dt.detect(fn, None, toks, feats, lxinfo, "en", useconst, usedep,
+                        m14, disabled=disabled, fired=fired)
+        return dt.standoff_rows(fn, dt.standoff_spans(ana))
+
+    for fn, toks, feats in poems:
+        base_fired, all_fired = set(), set()
+        base_rows = detect_rows(fn, toks, feats, dt.OFF_RULES, base_fired)
+        all_rows = detect_rows(fn, toks, feats, frozenset(), all_fired)
+        for vidx, (variant, rid, disabled) in enumerate(todo):
+            if variant == "baseline":
+                vrows = base_rows
+                runs[vidx] += 1
+            elif rid == u"all":
+                vrows = all_rows
+                runs[vidx] += 1
+            elif variant == "disable" and rid not in base_fired:
+                vrows = base_rows
+            elif variant == "enable" and not all_fired & dt.OFF_RULES:
+                vrows = base_rows
+            else:
+                vrows = detect_rows(fn, toks, feats, disabled)
+                runs[vidx] += 1
+            rows[vidx].extend(vrows)
+    return rows, runs
+
+
+def score_variants(todo, rows, runs, refrows):
+    """
+    Scores for each variant (see L{HEADER})
+    @param refrows: rows of the reference (see L{score.read_rows})
+    """
+    scores = []
+    for (variant, rid, disabled), vrows, vruns in zip(todo, rows, runs):
+        span, typed = sc.score(vrows, refrows)[0:2]
+        scores.append([variant, rid, vruns] + list(span[5:8]) +
+                      list(typed[5:8]))
+    base = scores[0]
+    for row in scores:
+        row.extend([row[5] - base[5], row[8] - base[8]])
+    return scores
+
+
+def format_scores(scores):
+    """Scores as TSV lines, header first"""
+    ols = [u"\t".join(HEADER)]
+    for row in scores:
+        ols.append(u"{}\t{}\t{}\t".format(*row[0:3]) + u"\t".join(
+            u"{:.4f}".format(val) for val in row[3:9]) + u"\t" + u"\t".join(
+            # no negative zeros
+            u"{:+.4f}".format(round(val, 4) + 0.0) for val in row[9:]))
+    return ols
+
+
+def main():
+    argus = run_argparse()
+    start = time.time()
+    if argus.store is not None:
+        import feature_store as fs
+        poems = fs.read_poems(fs.read_store(argus.store))
+    else:
+        if argus.inname is None or argus.nlpdir is None:
+            print "Give the input (-i) and NLP (-n) dirs, or a store (-s)"
+            sys.exit(2)
+        poems = sw.read_poems(argus.inname, argus.nlpdir, argus.constituency)
+    todo = ablation_variants()
+    rows, runs = ablate(poems, todo, argus.constituency, argus.dependency,
+                        argus.m14)
+    scores = score_variants(todo, rows, runs,
+                            list(sc.read_rows(argus.rffile)))
+    out = u"\n".join(format_scores(scores)) + u"\n"
+    if argus.outfile is None:
+        sys.stdout.write(out.encode("utf8"))
+    else:
+        with codecs.open(argus.outfile, "w", "utf8") as oufi:
+            oufi.write(out)
+        print u"- Wrote scores to [{}]".format(argus.outfile)
+    print u"- {} variants in {:.1f} s".format(len(todo), time.time() - start)
+
+
+if __name__ == "__main__":
+    main()
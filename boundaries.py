@@ -0,0 +1,295 @@
+# coding: utf-8
+
+"""
+Vectorized application of the rules that only need word-forms, pos-tags
+and lemmas (tmesis, pp01-pp26, cp01; see L{detect.lexical_rule}).
+Features for the line boundaries of a whole batch of poems are extracted
+into NumPy columns (interned word-forms, pos-tags and lemmas), and each rule
+becomes a boolean mask over all boundaries. Masks are combined in the order
+of L{detect.lexical_rule}, so that the first matching rule wins as in its
+elif chain. Boundaries matching no rule are left to the syntactic rules
+in L{detect.detect}.
+Requires NumPy.
+"""
+
+__author__ = 'Pablo Ruiz'
+__date__ = '19/10/26'
+__email__ = 'pabloruizfabo@gmail.com'
+
+
+import re
+
+import numpy
+
+# add current dir
+import os
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(here)
+
+# app specific imports
+import detect as dt
+import utils as ut
+
+
+# rules in same priority order as in detect.lexical_rule, as
+# (rule-id, enjambment type); type None means rule matches without tagging.
+# Rules off by default there (detect.OFF_RULES: pp08, pp17, pp18, pp22,
+# cp02) are not listed
+LEXICAL_RULES = [
+    ("t001", "tmesis"),
+    ("pp01", "sirrem_adj_noun"),
+    ("pp02", "sirrem_adj_noun"),
+    ("pp03", "sirrem_adj_noun"),
+    ("pp04", "sirrem_adj_noun"),
+    ("pp05", "sirrem_noun_prep-de"),
+    ("pp06", "sirrem_noun_prep-de"),
+    ("pp06.1", "sirrem_noun_prep-de"),
+    ("pp07", "sirrem_adj_prep-de"),
+    ("pp09", "sirrem_adj_adv"),
+    ("pp10", "sirrem_adj_adv"),
+    ("pp11", "sirrem_verb_adv"),
+    ("pp12", "sirrem_pal-rel~clitic"),
+    ("pp13", "sirrem_pal-rel~conj"),
+    ("pp14", "sirrem_pal-rel~conj"),
+    ("pp15", "sirrem_pal-rel~prep"),
+    ("pp15", None),
+    ("pp16", "sirrem_pal-rel~det"),
+    ("pp19", "sirrem_perif_verb"),
+    ("pp20", "sirrem_perif_verb"),
+    ("pp21", "sirrem_perif_verb"),
+    ("pp23", "sirrem_verb_supl"),
+    ("pp24", "sirrem_verb_supl"),
+    ("pp25", "sirrem_verb_supl"),
+    ("pp26", "sirrem_verb_supl"),
+    ("cp01", "oracional_comp-noun"),
+    ("cp01", "oracional_comp-pron"),
+]
+
+# feature columns, named like the variables in detect.detect
+FORM_COLS = ("pwf", "cwf", "nwf", "swf")
+POS_COLS = ("ppos", "cpos", "npos", "spos", "tpos")
+LEMMA_COLS = ("clemma", "slemma")
+
+PARTICIPLE_RE = re.compile(r"[ai]d[oa]s?$")
+DE = ("de", "del")
+
+
+def boundary_tokens(tokp, idx):
+    """
+    Return the (penult, last, first, second) token triples and the pos of the
+    third token in the next line, for the boundary at line index idx.
+    Lines are paired and missing tokens filled in as in L{detect.detect}
+    @param tokp: poem lines as lists of (word-form, pos, term-id) tokens
+    @param idx: line index
+    """
+    empty = ("", "", "")
+    if idx < len(tokp) - 1:
+        cline, nline = tokp[idx], tokp[idx+1]
+    else:
+        cline, nline = tokp[idx-1], tokp[idx]
+    if cline and nline:
+        cur, nxt = tuple(cline[-1]), tuple(nline[0])
+    else:
+        cur, nxt = empty, empty
+    if len(cline) > 1 and len(nline) > 1:
+        pen, sec = tuple(cline[-2]), tuple(nline[1])
+    else:
+        pen, sec = empty, empty
+    tpos = nline[2][1] if len(nline) > 2 else ""
+    return cline, pen, cur, nxt, sec, tpos
+
+
+def extract_features(poems, lxinfo):
+    """
+    Extract boundary features for a batch of poems into NumPy columns.
+    @param poems: list of (filename, tokens, tree) for each poem. Tokens as
+    read by L{utils.read_pos_tagged_poem}
+    @param tree: NAF tree for the poem, for lemmas, or the features stored
+    for it (see L{detect.naf_features})
+    @type tree: L{KafNafParserPy.KafNafParser}
+    @param lxinfo: dict of dicts with lexical info (see L{detect.detect})
+    @return: dict with an integer column per feature (one row per boundary,
+    see L{FORM_COLS}, L{POS_COLS}, L{LEMMA_COLS}), the vocabularies the codes
+    point to ('forms', 'poss', 'lemmas'), 'lower' (code for the lowercased
+    form of each form) and 'lengths' (number of boundaries per poem)
+    @note: 'slemma' is the first lemma in the line that governs 'suplemento'
+    """
+    forms, poss, lemmas = {}, {}, {}
+    cols = dict((col, []) for col in FORM_COLS + POS_COLS + LEMMA_COLS)
+    lengths = []
+    for fn, tokp, tree in poems:
+        if isinstance(tree, dict):
+            # features stored for the poem (see detect.naf_features)
+            tid2lemma = dict((ut.term_id(tnb), lemma)
+                             for tnb, lemma in tree["lemmas"].items())
+        else:
+            tid2lemma = dict((te.get_id(), te.get_lemma())
+                             for te in tree.term_layer)
+        for idx in range(len(tokp)):
+            cline, pen, cur, nxt, sec, tpos = boundary_tokens(tokp, idx)
+            clemma = tid2lemma.get(cur[2], "") if cur[2] else ""
+            slemma = ""
+            for tok in cline:
+                if tid2lemma.get(tok[2]) in lxinfo["suplemento"]:
+                    slemma = tid2lemma[tok[2]]
+                    break
+            for col, tok in zip(FORM_COLS, (pen, cur, nxt, sec)):
+                cols[col].append(forms.setdefault(tok[0], len(forms)))
+                forms.setdefault(tok[0].lower(), len(forms))
+            for col, pos in zip(POS_COLS, (pen[1], cur[1], nxt[1], sec[1],
+                                           tpos)):
+                cols[col].append(poss.setdefault(pos, len(poss)))
+            for col, lem in zip(LEMMA_COLS, (clemma, slemma)):
+                cols[col].append(lemmas.setdefault(lem, len(lemmas)))
+        lengths.append(len(tokp))
+    feats = dict((col, numpy.array(vals, dtype=numpy.int32))
+                 for col, vals in cols.items())
+    feats["forms"] = sorted(forms, key=forms.get)
+    feats["poss"] = sorted(poss, key=poss.get)
+    feats["lemmas"] = sorted(lemmas, key=lemmas.get)
+    feats["lower"] = numpy.array([forms[fo.lower()] for fo in feats["forms"]],
+                                 dtype=numpy.int32)
+    feats["lengths"] = lengths
+    return feats
+
+
+def vocab_mask(vocab, test):
+    """Boolean array telling whether each vocabulary item passes test"""
+    return numpy.array([bool(test(it)) for it in vocab] or [False],
+                       dtype=bool)
+
+
+def pair_mask(lemma_col, form_col, feats, lexicon):
+    """
+    Boolean array telling, for each boundary, whether the word-form
+    in form_col is listed in lexicon for the lemma in lemma_col
+    @param lexicon: dict with a container of word-forms for each lemma
+    """
+    form2code = dict((fo, co) for co, fo in enumerate(feats["forms"]))
+    nforms = len(feats["forms"])
+    valid = [lco * nforms + form2code[fo]
+             for lco, lem in enumerate(feats["lemmas"]) if lem in lexicon
+             for fo in lexicon[lem] if fo in form2code]
+    keys = lemma_col.astype(numpy.int64) * nforms + form_col
+    return numpy.in1d(keys, numpy.array(valid, dtype=numpy.int64))
+
+
+def lexical_hits(feats, lxinfo, disabled=dt.OFF_RULES):
+    """
+    Apply the lexical rules to all boundaries in feats
+    @param feats: features as output by L{extract_features}
+    @param lxinfo: dict of dicts with lexical info (see L{detect.detect})
+    @param disabled: ids of the rules not to apply; must include the rules
+    off by default (L{detect.OFF_RULES}), which are not vectorized
+    @return: array with the index in L{LEXICAL_RULES} of the first rule
+    matching each boundary, -1 if none matches
+    """
+    if not dt.OFF_RULES <= set(disabled):
+        raise ValueError(u"Rules not vectorized: {}".format(
+            u", ".join(sorted(dt.OFF_RULES - set(disabled)))))
+    pos2code = dict((po, co) for co, po in enumerate(feats["poss"]))
+    forms, lemmas = feats["forms"], feats["lemmas"]
+    pwf, cwf, nwf, swf = [feats[col] for col in FORM_COLS]
+    ppos, cpos, npos, spos, tpos = [feats[col] for col in POS_COLS]
+    clemma, slemma = [feats[col] for col in LEMMA_COLS]
+    nlow = feats["lower"][nwf]
+
+    def pos(col, *tags):
+        return numpy.in1d(col, [pos2code[tag] for tag in tags
+                                if tag in pos2code])
+
+    def count(tag, *cols):
+        return sum(pos(col, tag).astype(numpy.int8) for col in cols)
+
+    def form(col, test):
+        return vocab_mask(forms, test)[col]
+
+    def lemma(col, test):
+        return vocab_mask(lemmas, test)[col]
+
+    periph, supl = lxinfo["periphrases"], lxinfo["suplemento"]
+    in_periph = lemma(clemma, lambda lem: lem in periph)
+    in_supl = lemma(clemma, lambda lem: lem in supl)
+    nde = form(nwf, lambda fo: fo.lower() in DE)
+    supl_pair = in_supl & pair_mask(clemma, nwf, feats, supl)
+    conds = [
+        # t001
+        form(cwf, lambda fo: len(fo) > 1 and fo[-1] == "-" and fo != ".-"),
+        # pp01, pp02
+        (count("G", ppos, cpos, npos) == 1) & (count("N", ppos, cpos, npos) == 2),
+        (pos(cpos, "G") & pos(npos, "N")) | (pos(cpos, "N") & pos(npos, "G")),
+        # pp03, pp04
+        ((count("A", cpos, npos, spos) == 1) & (count("G", cpos, npos, spos) == 1)
+         & (count("N", cpos, npos, spos) == 1)),
+        ((count("A", cpos, npos, spos) == 1) & (count("G", cpos, npos, spos) == 1)
+         & (count("N", cpos, npos, spos) == 1)
+         & form(cwf, lambda fo: fo.endswith("ada"))),
+        # pp05, pp06, pp06.1, pp07
+        ((count("G", ppos, cpos, npos) == 1) & (count("N", ppos, cpos, npos) == 1)
+         & (count("P", ppos, cpos, npos) == 1) & nde),
+        (pos(ppos, "N") & pos(cpos, "P") & pos(npos, "D")
+         & form(cwf, lambda fo: fo.lower() in DE)),
+        pos(cpos, "N") & pos(npos, "P") & nde,
+        pos(cpos, "G") & pos(npos, "P") & nde,
+        # pp09, pp10
+        (pos(cpos, "A") & pos(npos, "G")
+         & ~form(cwf, lambda fo: PARTICIPLE_RE.search(fo))),
+        (pos(cpos, "G") & pos(npos, "A") & ~form(swf, lambda fo: fo in DE)
+         & ~form(nwf, lambda fo: PARTICIPLE_RE.search(fo))),
+        # pp11
+        (pos(cpos, "A") & pos(npos, "V")) | (pos(cpos, "V") & pos(npos, "A")),
+        # pp12, pp13, pp14
+        pos(cpos, "Q") & form(cwf, lambda fo: fo.lower() in dt.PRON_ATONO),
+        (pos(ppos, "O") & pos(npos, "V")
+         & form(cwf, lambda fo: fo.lower() in ("cuando", "donde"))),
+        pos(cpos, "C"),
+        # pp15 (tagging and non-tagging), pp16
+        pos(cpos, "P") & form(cwf, lambda fo: fo in dt.PREPS),
+        pos(cpos, "P"),
+        pos(cpos, "D") & pos(npos, "N", "G", "A", "D"),
+        # pp19, pp20, pp21
+        (in_periph & pair_mask(
+            clemma, nwf, feats,
+            dict((lem, vals["ponly"]) for lem, vals in periph.items()))
+         & (pos(spos, "V") | (pos(spos, "Q") & pos(tpos, "V")))),
+        (in_periph & ~lemma(clemma, lambda lem: periph.get(lem, {}).get("ponly"))
+         & (pos(npos, "V") | (pos(npos, "G") & lemma(
+             clemma, lambda lem: "G" in periph.get(lem, {}).get("tonly", ()))))),
+        (in_periph & lemma(clemma, lambda lem: periph.get(lem, {}).get("tonly"))
+         & pos(npos, "V")),
+        # pp23, pp24, pp25, pp26
+        pos(cpos, "V") & pos(npos, "P") & supl_pair,
+        pos(cpos, "G") & pos(npos, "P") & supl_pair,
+        supl_pair,
+        (lemma(slemma, lambda lem: lem in supl)
+         & pair_mask(slemma, nlow, feats, supl)),
+        # cp01 (noun and pronoun antecedent)
+        (pos(cpos, "G", "N", "R") & pos(npos, "Q")
+         & form(nwf, lambda fo: fo.lower() in dt.RELATIVES)),
+        (pos(cpos, "Q") & pos(npos, "Q")
+         & form(nwf, lambda fo: fo.lower() in dt.RELATIVES)),
+    ]
+    assert len(conds) == len(LEXICAL_RULES)
+    keep = [ridx for ridx, (rid, etype) in enumerate(LEXICAL_RULES)
+            if rid not in disabled]
+    return numpy.select([conds[ridx] for ridx in keep], keep, default=-1)
+
+
+def lexical_hits_by_poem(feats, hits):
+    """
+    Split rule matches for a batch into a list per poem
+    @param feats: features as output by L{extract_features}
+    @param hits: rule matches as output by L{lexical_hits}
+    @return: for each poem, list with (rule-id, enjambment type) for each
+    line index, (None, None) where no lexical rule matches (as expected
+    by L{detect.detect})
+    """
+    by_poem = []
+    start = 0
+    for length in feats["lengths"]:
+        by_poem.append([LEXICAL_RULES[hit] if hit >= 0 else (None, None)
+                        for hit in hits[start:start + length]])
+        start += length
+    return by_poem
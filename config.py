@@ -8,12 +8,10 @@ import re
 
 
 # set basedir to dir containing this module
-import inspect
 import os
 
 
-basedir = os.path.dirname(os.path.abspath(
-    inspect.getfile(inspect.currentframe())))
+basedir = os.path.dirname(os.path.abspath(__file__))
 parentdir = os.path.join(basedir, os.pardir)
 
 
@@ -27,6 +25,17 @@ NORM_ETAGS = True         # normalize enjambment type tags based on
 PRINT_RULEIDS = True     # write rule-ids to output
 MORE14 = False           # allow tagging more than 14 lines (extends to 17 for estrambote)
 LOG = False               #
+VECTOR_BATCH = 50        # poems per batch for vectorized rules (detect -x)
+NLP_CHUNK_CHARS = 3000   # max chars per chunk for nlp_chunks.py
+NLP_CHUNK_WORKERS = 2    # chunks of a poem parsed at once by nlp_chunks.py
+GZIP_LEVEL = 6           # compression level for .gz outputs
+ZSTD_LEVEL = 3           # compression level for .zst outputs
+PROFILE_TOP = 20         # rows in --profile reports (slowest poems etc.)
+PROFILE_INTERVAL = 0.005 # secs of CPU time between --profile stack samples
+METRICS_INTERVAL = 10    # secs between rewrites of the --metrics textfile
+# upper bounds (secs) for the --metrics histogram of time per poem
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, 300)
 
 #IO: paths are directory basenames ============================================
 
@@ -37,9 +46,7 @@ datadir = os.path.join(basedir, "data")
 tag_confdir = os.path.join(basedir, "config_tags")
 # for the IO tests
 sample_outdir = os.path.join(datadir, "sample" + os.sep + "out")
-for dn in baselogdir, baseoutdir, datadir, sample_outdir:
-    if not os.path.exists(dn):
-        os.makedirs(dn)
+# (no dirs are created here: each tool creates its output dirs)
 
 
 # I: poem on split lines, O: poem on one line ----------------------------
@@ -61,6 +68,8 @@ else:
     tokwpos = u"{batch}_pos"
     TOKFMT = u"{{{} {}}}"
 nlpsfx = "_parsed.xml"    # suffix for files coming out of nlp pipeline
+nafext = ".naf"           # alternative extension for NAF (run_nlp.sh with
+                          # compression writes _parsed.naf.gz or .naf.zst)
 possfx = "_annot.txt"     # suffix for files annotated with pos (and term-id)
 
 
@@ -84,6 +93,8 @@ nlprunner = os.path.join(basedir, "run_nlp.sh")
 preprocessor = os.path.join(basedir, os.path.join("prepro", "prepro.py"))
 posextractor = os.path.join(basedir, "extract_pos.py")
 detector = os.path.join(basedir, "detect.py")
+# command for .zst files (zstandard command-line tool)
+zstd = "zstd"
 
 # Enjambment tagging config ===================================================
 entagnorm = os.path.join(tag_confdir, "enca_tags_normalization.txt")
@@ -93,9 +104,17 @@ lexdata = os.path.join(datadir, "lexical")
 # dicts
 suplemento = os.path.join(lexdata, "suplemento.txt")
 periphrases = os.path.join(lexdata, "periphrases.txt")
+# compiled suplemento and periphrases, rebuilt when those change
+lexicon_snapshot = os.path.join(lexdata, "lexicons.snapshot")
 tag_translation = os.path.join(tag_confdir, "enca_tags_translation.txt")
 
 # Logging =======================================================================
 
 log_filename = u"{batch}_log.txt"
+# prefix for --profile outputs, in the batch log dir
+profile_prefix = u"{batch}_{tool}_profile"
+# --metrics outputs, in the batch log dir: events for all stages, and a
+# Prometheus textfile per stage
+metrics_events = u"{batch}_events.jsonl"
+metrics_prom = u"{batch}_{stage}.prom"
 
@@ -13,25 +13,29 @@ __date__ = '16/01/16'
 __email__ = 'pabloruizfabo@gmail.com'
 
 
+import sys
+if "--import-time" in sys.argv:
+    # before the other imports, to time them
+    import importtime
+    importtime.install()
+
 import argparse
 import codecs
+import itertools
 import os
 import re
 from string import punctuation
 
-import KafNafParserPy as knp
-from KafNafParserPy import KafNafParser as np
-
 # add current dir
-import inspect
-import sys
-
-here = os.path.dirname(os.path.abspath(
-    inspect.getfile(inspect.currentframe())))
+here = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(here)
 
 # app specific imports
 import config as cfg
+import metrics as mt
+import profiling as pf
+import result_index as ri
+import selection as sel
 import utils as ut
 
 
@@ -105,6 +109,32 @@ def run_argparse():
     parser.add_argument('-5', '--m14',
                         help='Allow rule application above 14 lines',
                         action='store_true')
+    parser.add_argument('-q', '--sqlite', dest='dbfile',
+                        help='Also store results in this SQLite database '
+                             '(see results_db.py)')
+    parser.add_argument('--import-time', action='store_true',
+                        help='Report time spent importing modules (stderr)')
+    parser.add_argument('--profile', nargs='?', metavar='DIR',
+                        const=os.path.join(cfg.baselogdir,
+                                           partargs.batchname),
+                        help='Profile the run, writing the reports to DIR '
+                             '(see profiling.py; default: the batch log dir)')
+    parser.add_argument('--metrics', nargs='?', metavar='DIR',
+                        const=os.path.join(cfg.baselogdir,
+                                           partargs.batchname),
+                        help='Write per-poem events and a Prometheus textfile '
+                             'to DIR (see metrics.py; default: the batch log '
+                             'dir)')
+    parser.add_argument('--authors', type=sel.parse_id_ranges,
+                        help='Only poems by these author ids (from the '
+                             'file names), e.g. 321,400-420')
+    parser.add_argument('--poems', type=sel.parse_id_ranges,
+                        help='Only poems with these poem ids (from the file '
+                             'names), e.g. 1000-1099')
+    parser.add_argument('-x', '--vectorized',
+                        help='Apply rules not needing syntax to batches of '
+                             'poems at once (requires NumPy)',
+                        action='store_true')
     if 'customsort' in partargs and partargs.customsort:
         parser.add_argument('-s', '--sorter',
                             help='File for custom result sort order',
@@ -127,12 +157,280 @@ ACC = [u"á", u"é", u"í", u"ó", u"ú"]
 PREPS = ["a", "al", "ante", "bajo", "con", "contra", "desde", "en", "entre", 
          "hacia", "hasta", "para", "por", "según", "sin", "sobre", "tras",
          "mediante", "durante", "salvo", "excepto", "cabe", "so"]
+# relatives introducing 'oracional' enjambment
+RELATIVES = ("que", "cuyo", "cuya", "cuyos", "cuyas", "donde")
 # to have uniform labels on enca output
+#   (C and P only reach the dep rules with pp14 or pp15 disabled)
 REPS = {"N": "noun", "G": "adj", "A": "adv", "D": "det", "O": "other",
-        "V": "verb", "Q": "cuantif", "R": "propn"}
+        "V": "verb", "Q": "cuantif", "R": "propn", "C": "conj", "P": "prep"}
+# lexicons and tag maps, loaded once (see load_resources)
+RESOURCES = {}
+# rule-ids in the order the rules are tried (see lexical_rule and detect)
+RULE_IDS = ["t001", "pp01", "pp02", "pp03", "pp04", "pp05", "pp06", "pp06.1",
+            "pp07", "pp08", "pp09", "pp10", "pp11", "pp12", "pp13", "pp14",
+            "pp15", "pp16", "pp17", "pp18", "pp19", "pp20", "pp21", "pp22",
+            "pp23", "pp24", "pp25", "pp26", "cp01", "cp02", "pc01", "pc02",
+            "pd01", "pd02", "pd03", "ld01", "ld02"]
+# rules not applied by default, since they overapply
+OFF_RULES = frozenset(["pp08", "pp17", "pp18", "pp22", "cp02"])
+
+
+def index_chunks_by_term(tree):
+    """
+    Index the constituents that each term belongs to, so that testing
+    whether two terms share a constituent of a given type is a set lookup.
+    @param tree: NAF tree for NLP results
+    @type tree: L{KafNafParserPy.KafNafParser}
+    @return: dict {term-id: {chunk label: set of term-ids in those chunks}}
+    @note: terms sharing a terminal node share the same inner dict
+    """
+    from KafNafParserPy.feature_extractor.constituency import \
+        Cconstituency_extractor
+    extractor = Cconstituency_extractor(tree)
+    by_terminal = {}
+    tid2chunks = {}
+    for tid, terminal_id in extractor.terminal_for_term.items():
+        if terminal_id not in by_terminal:
+            label2tids = {}
+            for chunk_type, tid_list in extractor.get_all_chunks_for_term(tid):
+                label2tids.setdefault(chunk_type, set()).update(tid_list)
+            by_terminal[terminal_id] = label2tids
+        tid2chunks[tid] = by_terminal[terminal_id]
+    return tid2chunks
+
+
+def index_deps_by_function(deps):
+    """
+    Index dependencies by function, with their endpoints as integers
+    (see L{utils.term_number}), for the dependency rules
+    @param deps: dependencies in the tree
+    @type deps: iterable of L{KafNafParserPy.dependency_data.Cdependency}
+    @return: dict {function: [(head term-nbr, dependent term-nbr, dependency),
+    ...]}, in tree order
+    """
+    func2deps = {}
+    for hd in deps:
+        func2deps.setdefault(hd.get_function(), []).append(
+            (ut.term_number(hd.get_from()), ut.term_number(hd.get_to()), hd))
+    return func2deps
+
+
+def naf_features(tokp, tree, useconst=False):
+    """
+    Inputs to the rules that come from the NAF tree (see L{detect}), so that
+    they can be stored and the rules applied without the NAF (see
+    L{feature_store})
+    @param tokp: the poem, a L{utils.TaggedPoem}
+    @param useconst: also extract the constituents shared across boundaries
+    @return: dict with the lemma for each term number ('lemmas'), the
+    dependencies as (function, head, dependent) tuples, with term numbers
+    ('deps', None if the tree has no dependency layer), and with useconst,
+    (last term, first term, labels) for each boundary where the last term in
+    a line and the first in the next share constituents ('chunks', None
+    without useconst)
+    """
+    feats = {"lemmas": dict((ut.term_number(te.get_id()), te.get_lemma())
+                            for te in tree.term_layer),
+             "deps": None, "chunks": None}
+    try:
+        feats["deps"] = [(hd.get_function(), ut.term_number(hd.get_from()),
+                          ut.term_number(hd.get_to()))
+                         for hd in tree.get_dependencies()]
+    except TypeError:
+        pass
+    if useconst:
+        chunks = index_chunks_by_term(tree)
+        feats["chunks"] = []
+        for idx in xrange(len(tokp) - 1):
+            ctnbs, ntnbs = tokp.line_tids(idx), tokp.line_tids(idx + 1)
+            if not ctnbs or not ntnbs:
+                continue
+            ntid = ut.term_id(ntnbs[0])
+            labels = sorted(label for label, tids in chunks.get(
+                ut.term_id(ctnbs[-1]), {}).items() if ntid in tids)
+            if labels:
+                feats["chunks"].append((ctnbs[-1], ntnbs[0], labels))
+    return feats
+
+
+def index_features(feats, useconst):
+    """
+    Index stored features (see L{naf_features}) like L{detect} indexes a NAF
+    tree: constituents as in L{index_chunks_by_term} (only for the terms
+    across boundaries), dependencies as in L{index_deps_by_function} (with
+    None for the dependency objects)
+    @return: chunks (None without useconst), dependencies (None if not
+    stored) and lemmas
+    """
+    chunks = None
+    if useconst:
+        if feats["chunks"] is None:
+            raise ValueError("Features were stored without constituents")
+        chunks = {}
+        for ctnb, ntnb, labels in feats["chunks"]:
+            label2tids = chunks.setdefault(ut.term_id(ctnb), {})
+            for label in labels:
+                label2tids.setdefault(label, set()).add(ut.term_id(ntnb))
+    deps = None
+    if feats["deps"] is not None:
+        deps = {}
+        for func, frm, to in feats["deps"]:
+            deps.setdefault(func, []).append((frm, to, None))
+    return chunks, deps, feats["lemmas"]
+
+
+def lexical_rule(pen, cur, nxt, sec, nline, clemma, suplemento_lemma, lxinfo,
+                 disabled=OFF_RULES):
+    """
+    Apply the rules that need word-forms, pos-tags and lemmas only (no syntax)
+    to a line boundary. Rules are tried in order and the first match wins.
+    @param pen: triple (word-form, pos, term-id) for current line's penult token
+    @param cur: triple (word-form, pos, term-id) for current line's final token
+    @param nxt: triple (word-form, pos, term-id) for following line's first token
+    @param sec: triple (word-form, pos, term-id) for following line's second token
+    @param nline: following line's tokens
+    @param clemma: lemma for current line's final token
+    @param suplemento_lemma: lemmas in current line for verbs taking
+    'suplemento' (see L{utils.read_suplemento})
+    @param lxinfo: dict of dicts with lexical info (see L{detect})
+    @param disabled: ids of the rules not to apply (see L{RULE_IDS})
+    @return: tuple (rule-id, enjambment type). Both are None if no rule
+    matches, type is None if a rule matches without tagging the boundary
+    (then the syntactic rules must not be tried)
+    """
+    pwf, ppos, ptid = pen
+    cwf, cpos, ctid = cur
+    nwf, npos, ntid = nxt
+    swf, spos, stid = sec
+    periph, supl = lxinfo["periphrases"], lxinfo["suplemento"]
+    # (rule-id, enjambment type, test), tested lazily in this order
+    rules = [
+        # RULES USING WORD-FORM ONLY ======================================
+        # tmesis (no se da en _Noche_)
+        #   note: tokenizer errors with ".-" (different in each tok version)
+        ("t001", "tmesis",
+         lambda: len(cwf) > 1 and cwf[-1] == "-" and cwf != ".-"),
+        # RULES WITHOUT SYNTAX ============================================
+        # noun + adjective // + noun
+        ("pp01", "sirrem_adj_noun",
+         lambda: tuple(sorted((ppos, cpos, npos))) == ("G", "N", "N")),
+        # noun + adjective ------------------------------------------------
+        ("pp02", "sirrem_adj_noun",
+         lambda: tuple(sorted((cpos, npos))) == ("G", "N")),
+        # noun // + adv + adjective (e.g. monumento nunca oprimido)
+        ("pp03", "sirrem_adj_noun",
+         lambda: tuple(sorted((cpos, npos, spos))) == ("A", "G", "N")),
+        # adj // + noun + adj with misanalysis of adj/participle as adv
+        # (e.g. apasionada corona liberal)
+        ("pp04", "sirrem_adj_noun",
+         lambda: (tuple(sorted((cpos, npos, spos))) == ("A", "G", "N") and
+                  cwf.endswith("ada"))),
+        # noun + adj // + prep-de -----------------------------------------
+        ("pp05", "sirrem_noun_prep-de",
+         lambda: (tuple(sorted((ppos, cpos, npos))) == ("G", "N", "P") and
+                  nwf.lower() in ("de", "del"))),
+        # noun + prep -----------------------------------------------------
+        ("pp06", "sirrem_noun_prep-de",
+         lambda: ((ppos, cpos, npos) == ("N", "P", "D") and
+                  cwf.lower() in ("de", "del"))),
+        ("pp06.1", "sirrem_noun_prep-de",
+         lambda: (cpos, npos) == ("N", "P") and nwf.lower() in ("de", "del")),
+        # adj + prep-de ---------------------------------------------------
+        ("pp07", "sirrem_adj_prep-de",
+         lambda: (cpos, npos) == ("G", "P") and nwf.lower() in ("de", "del")),
+        # adj + adv -------------------------------------------------------
+        ("pp08", "sirrem_adj_adv",                              # overapplies
+         lambda: tuple(sorted((cpos, npos))) == ("A", "G")),
+        # work around pos errors (participles tagged as A)
+        ("pp09", "sirrem_adj_adv",
+         lambda: ((cpos, npos) == ("A", "G") and
+                  not re.search(r"[ai]d[oa]s?$", cwf))),
+        #avoid errors like 'azul dentro de' being tagged as enjambment
+        ("pp10", "sirrem_adj_adv",
+         lambda: ((cpos, npos) == ("G", "A") and swf not in ("de", "del")
+                  and not re.search(r"[ai]d[oa]s?$", nwf))),
+        # verb + adverb ---------------------------------------------------
+        ("pp11", "sirrem_verb_adv",
+         lambda: tuple(sorted((cpos, npos))) == ("A", "V")),
+        # palabra de relación ---------------------------------------------
+        #   pron átonos ---------------
+        ("pp12", "sirrem_pal-rel~clitic",
+         lambda: cpos == "Q" and cwf.lower() in PRON_ATONO),
+        # adverbial clause
+        ("pp13", "sirrem_pal-rel~conj",
+         lambda: (ppos == "O" and cwf.lower() in ("cuando", "donde") and
+                  npos == "V")),
+        #   conjunción ----------------
+        ("pp14", "sirrem_pal-rel~conj", lambda: cpos == "C"),
+        #   preposition ---------------
+        ("pp15", "sirrem_pal-rel~prep", lambda: cpos == "P" and cwf in PREPS),
+        # rule matches but does not tag: no later rule is tried
+        ("pp15", None, lambda: cpos == "P"),
+        #   determiners ---------------
+        #   (needs to precede noun, adj, adverb, determiner)
+        ("pp16", "sirrem_pal-rel~det",
+         lambda: cpos == "D" and npos in ("N", "G", "A", "D")),
+        # verb + verb (perífrasis verbal o tiempo compuesto etc.) ---------
+        ("pp17", "sirrem_perif_verb",                           # overapplies
+         lambda: (cpos, npos) == ("V", "V")),
+        # verb + prep + verb (perífrasis verbal)
+        ("pp18", "sirrem_perif_verb",                           # overapplies
+         lambda: (cpos, npos, spos) == ("V", "P", "V")),
+        # new periphrasis rules (dictionary-based)
+        #   [verb // prep + verb] or [verb // prep + clitic + verb]
+        ("pp19", "sirrem_perif_verb",
+         lambda: (clemma in periph and nwf in periph[clemma]["ponly"] and
+                  # [// prep + V] or [// prep + preposed clitic + V (archaic)]
+                  (spos == "V" or (spos == "Q" and nline[2][1] == "V")))),
+        #   [verb // verb|participle] ("G" possible participle for pos-errors)
+        ("pp20", "sirrem_perif_verb",
+         lambda: (clemma in periph and not periph[clemma]["ponly"] and
+                  (npos == "V" or ("G" in periph[clemma]["tonly"] and
+                                   npos == "G")))),
+        # [verb // verb], general rule for any aux verb in list
+        ("pp21", "sirrem_perif_verb",
+         lambda: (clemma in periph and periph[clemma]["tonly"] and
+                  npos == "V")),
+        # verbo + suplemento ----------------------------------------------
+        # aproximación [verbo + prep_de] overapplies
+        ("pp22", "sirrem_verb_supl",
+         lambda: (cpos, npos) == ("V", "P") and nwf.lower() in ("de", "del")),
+        # (aproximación: verbo + prep if verb lemma and prep in
+        #  a configurable list in lxinfo)
+        ("pp23", "sirrem_verb_supl",
+         lambda: ((cpos, npos) == ("V", "P") and clemma in supl and
+                  nwf in supl[clemma])),
+        ("pp24", "sirrem_verb_supl",
+         lambda: ((cpos, npos) == ("G", "P") and clemma in supl and
+                  nwf in supl[clemma])),
+        ("pp25", "sirrem_verb_supl",
+         lambda: clemma in supl and nwf in supl[clemma]),
+        ("pp26", "sirrem_verb_supl",
+         lambda: (len(suplemento_lemma) > 0 and
+                  nwf.lower() in supl[suplemento_lemma[0]])),
+        # oracional -------------------------------------------------------
+        #   ('adonde' many errors in xv-xvii)
+        ("cp01", "oracional_comp-noun",
+         lambda: (cpos in ("G", "N", "R") and npos == "Q" and
+                  nwf.lower() in RELATIVES)),
+        ("cp01", "oracional_comp-pron",
+         lambda: cpos == "Q" and npos == "Q" and nwf.lower() in RELATIVES),
+        #   adverbial clause (a quien, con quien ...)
+        ("cp02", "oracional_comp-noun",
+         lambda: (cpos in ("G", "N", "R") and spos == "Q" and npos == "P"
+                  and swf.lower() in RELATIVES)),
+        ("cp02", "oracional_comp-pron",
+         lambda: (cpos == "Q" and spos == "Q" and npos == "P" and
+                  swf.lower() in RELATIVES)),
+    ]
+    for rid, etype, test in rules:
+        if rid not in disabled and test():
+            return rid, etype
+    return None, None
 
 
-def detect(fn, lf, tokp, naffn, lxinfo, lang, useconst, usedep, m14):
+def detect(fn, lf, tokp, naffn, lxinfo, lang, useconst, usedep, m14,
+           lexhits=None, norm=None, disabled=OFF_RULES, fired=None):
     """
     Apply encabalgamiento rules to part-of-speech tagged lines, with access
     to dependencies and constituents in a NAF file via term-id.
@@ -140,10 +438,13 @@ def detect(fn, lf, tokp, naffn, lxinfo, lang, useconst, usedep, m14):
     (wf_n, pos-tag_n, term-id_n)]
     @param fn: filename for the poem (used to long info per file)
     @param lf: log filehandle open to write
-    @param tokp: list of tokens as described
-    @param naffn: need this to create a NAF tree (for constituents)
+    @param tokp: lines as described, or the L{utils.TaggedPoem} for them
+    @param naffn: need this to create a NAF tree (for constituents). Can also
+    be the NAF tree itself, if already parsed, or the features for the poem
+    extracted from it (see L{naf_features}; rule details are then not logged)
     @param lxinfo: dict of dicts with lexical info like verbs governing
-    'suplemento' prepositional complement etc.
+    'suplemento' prepositional complement etc., and tag maps
+    (see L{load_resources})
     @param lang: language for enjambment tags (en (default) or es)
     @param useconst: use constituency info or not (bool)
     @type useconst: bool
@@ -151,277 +452,174 @@ def detect(fn, lf, tokp, naffn, lxinfo, lang, useconst, usedep, m14):
     @type usedep: bool
     @param m14: allow rule application beyond 14 lines (actually extends to 1
     for estrambote, so it's actually beyond 17 lines)
+    @param lexhits: (rule-id, enjambment type) for each line index, as output
+    by L{boundaries.lexical_hits_by_poem}. If given, L{lexical_rule} is not
+    applied here and only unmatched boundaries go on to the syntactic rules
+    @param norm: normalize enjambment tags (see
+    L{utils.normalize_enca_types}), L{config.NORM_ETAGS} if None
+    @param disabled: ids of the rules not to apply, L{OFF_RULES} by default
+    (a boundary goes on to the next rule, as if a disabled rule did not
+    match). With lexhits, it only applies to the syntactic rules
+    @param fired: set to add the ids of the rules selected for a boundary to
+    (the first matching rule, even if the boundary ends up untagged)
     """
+    if norm is None:
+        norm = cfg.NORM_ETAGS
     detections = {}
     keeps = {}
     dones = set()
-    naffn = naffn.replace(".txt", ".xml")
-    tree = np(naffn)
-    extractor = knp.feature_extractor.constituency.Cconstituency_extractor(tree)
-    try:
-        deps = list(tree.get_dependencies())
-    except TypeError:
-        print "No dep layer for file: {}".format(naffn)
-        usedep = False
-    for idx, toklist in enumerate(tokp):
+    if not isinstance(tokp, ut.TaggedPoem):
+        tokp = ut.TaggedPoem(tokp)
+    if isinstance(naffn, basestring):
+        tree = ut.read_naf(naffn.replace(".txt", ".xml"))
+    else:
+        tree = naffn
+    if isinstance(tree, dict):
+        chunks, deps, tid2lemma = index_features(tree, useconst)
+        tree = None
+        if deps is None:
+            print "No dep layer for file: {}".format(repr(fn))
+            usedep = False
+    else:
+        # constituents are costly to extract, only index them if rules need them
+        if useconst:
+            chunks = index_chunks_by_term(tree)
+        try:
+            deps = index_deps_by_function(tree.get_dependencies())
+        except TypeError:
+            print "No dep layer for file: {}".format(repr(fn))
+            usedep = False
+        # term-ids are compared as integers (see utils.TaggedPoem)
+        if lexhits is None:
+            tid2lemma = dict((ut.term_number(te.get_id()), te.get_lemma())
+                             for te in tree.term_layer)
+    # rule details are only computed when logging, with indexes for the
+    # tree built at the first logged rule
+    trace = lf is not None and tree is not None
+    logidx = None
+    for idx in xrange(len(tokp)):
         has_enca = False
         if idx < len(tokp) - 1:
-            cline = toklist
-            nline = tokp[idx+1]
+            cidx, nidx = idx, idx + 1
         else:
-            cline = tokp[idx-1]
-            nline = toklist
+            cidx, nidx = idx - 1, idx
+        cline, nline = tokp[cidx], tokp[nidx]
         # variable names mean:
-        #   wf: word-form, pos: pos, tid: term-id
-        ctids = [tok[2] for tok in cline]
-        ntids = [tok[2] for tok in nline]
+        #   wf: word-form, pos: pos, tid: term-id, tnb: term-id as integer
+        ctnbs = tokp.line_tids(cidx)
+        ntnbs = tokp.line_tids(nidx)
+        ctids = set(ctnbs)
+        ntids = set(ntnbs)
         try:
             cwf, cpos, ctid = cline[-1][0], cline[-1][1], cline[-1][2]    # last
             nwf, npos, ntid = nline[0][0], nline[0][1], nline[0][2]       # first
+            ctnb, ntnb = ctnbs[-1], ntnbs[0]
         except IndexError:
             cwf, cpos, ctid = "", "", ""
             nwf, npos, ntid = "", "", ""
-        # lemmas
-        try:
-            clemma = [te.get_lemma() for te in tree.term_layer
-                      if te.get_id() == ctid][0]
-            # nlemma = [te.get_lemma() for te in tree.term_layer
-            #           if te.get_id() == ntid][0]
-        except IndexError:
-            clemma = ""
-        clemmas = [te.get_lemma() for te in tree.term_layer
-                   if te.get_id() in ctids]
-        # check if any lemma in cline is verb which can take 'suplemento' complement
-        suplemento_lemma = [lem for lem in clemmas if lem in lxinfo["suplemento"]]
+            ctnb, ntnb = None, None
         # will need to use the penult and second in some cases
         # for higher indexes i'm just accessing nline[idx > 1] directly
         try:
             pwf, ppos, ptid = cline[-2][0], cline[-2][1], cline[-2][2]            # penult
             swf, spos, stid = nline[1][0], nline[1][1], nline[1][2]               # second
+            ptnb = ctnbs[-2]
         except IndexError:
             print ur"Line has less than two tokens: {}".format(cline)
             pwf, ppos, ptid = "", "", ""
             swf, spos, stid = "", "", ""
-        # RULES USING WORD-FORM ONLY ==========================================
-        # tmesis (no se da en _Noche_)
-        #   note: tokenizer errors with ".-" (different in each tok version)
-        if len(cwf) > 1 and cwf[-1] == "-" and cwf != ".-":
-            ut.update_span(detections, idx, "tmesis", "t001", dones, m14)
-            has_enca = True
-        # RULES WITHOUT SYNTAX ================================================
-        # noun + adjective // + noun
-        elif tuple(sorted((ppos, cpos, npos))) == ("G", "N", "N"):
-            ut.update_span(detections, idx, "sirrem_adj_noun", "pp01", dones, m14)
-            has_enca = True
-        # noun + adjective ----------------------------------------------------
-        elif tuple(sorted((cpos, npos))) == ("G", "N"):
-            ut.update_span(detections, idx, "sirrem_adj_noun", "pp02", dones, m14)
-            has_enca = True
-        # noun // + adv + adjective (e.g. monumento nunca oprimido)
-        elif True and tuple(sorted((cpos, npos, spos))) == ("A", "G", "N"):
-            ut.update_span(detections, idx, "sirrem_adj_noun", "pp03", dones, m14)
-            has_enca = True
-        # adj // + noun + adj with misanalysis of adj/participle as adv
-        # (e.g. apasionada corona liberal)
-        elif (True and tuple(sorted((cpos, npos, spos))) == ("A", "G", "N") and
-              cwf.endswith("ada")):
-            ut.update_span(detections, idx, "sirrem_adj_noun", "pp04", dones, m14)
-            has_enca = True
-        # noun + adj // + prep-de ---------------------------------------------
-        elif (tuple(sorted((ppos, cpos, npos))) == ("G", "N", "P") and
-              nwf.lower() in ("de", "del")):
-            ut.update_span(detections, idx, "sirrem_noun_prep-de", "pp05", dones, m14)
-            has_enca = True
-        # noun + prep ---------------------------------------------------------
-        elif (ppos, cpos, npos) == ("N", "P", "D") and cwf.lower() in ("de", "del"):
-            ut.update_span(detections, idx, "sirrem_noun_prep-de", "pp06", dones, m14)
-            has_enca = True
-        elif (cpos, npos) == ("N", "P") and nwf.lower() in ("de", "del"):
-            ut.update_span(detections, idx, "sirrem_noun_prep-de", "pp06.1", dones, m14)
-            has_enca = True
-        # adj + prep-de -------------------------------------------------------
-        elif (cpos, npos) == ("G", "P") and nwf.lower() in ("de", "del"):
-            ut.update_span(detections, idx, "sirrem_adj_prep-de", "pp07", dones, m14)
-            has_enca = True
-        # adj + adv -----------------------------------------------------------
-        elif False and tuple(sorted((cpos, npos))) == ("A", "G"):       # overapplies
-            ut.update_span(detections, idx, "sirrem_adj_adv", "pp08", dones, m14)
-            has_enca = True
-        # work around pos errors (participles tagged as A)
-        elif (cpos, npos) == ("A", "G") and not re.search(r"[ai]d[oa]s?$", cwf):
-            ut.update_span(detections, idx, "sirrem_adj_adv", "pp09", dones, m14)
-            has_enca = True
-        #avoid errors like 'azul dentro de' being tagged as enjambment
-        elif ((cpos, npos) == ("G", "A") and swf not in ("de", "del") and not
-                re.search(r"[ai]d[oa]s?$", nwf)):
-            ut.update_span(detections, idx, "sirrem_adj_adv", "pp10", dones, m14)
-            has_enca = True
-
-        # verb + adverb -------------------------------------------------------
-        elif tuple(sorted((cpos, npos))) == ("A", "V"):
-            ut.update_span(detections, idx, "sirrem_verb_adv", "pp11", dones, m14)
-            has_enca = True
-        # palabra de relación -------------------------------------------------
-        #   pron átonos ---------------
-        elif cpos == "Q" and cwf.lower() in PRON_ATONO:
-            ut.update_span(detections, idx, "sirrem_pal-rel~clitic", "pp12", dones, m14)
-            has_enca = True
-        # adverbial clause
-        elif ppos == "O" and cwf.lower() in ("cuando", "donde") and npos == "V":
-            ut.update_span(detections, idx, "sirrem_pal-rel~conj", "pp13", dones, m14)
-            has_enca = True
-
-        #   conjunción ----------------
-        elif cpos == "C":
-            ut.update_span(detections, idx, "sirrem_pal-rel~conj", "pp14", dones, m14)
-            has_enca = True
-        #   preposition ---------------
-        elif cpos == "P":
-            if cwf in PREPS:
-                ut.update_span(detections, idx, "sirrem_pal-rel~prep", "pp15", dones, m14)
+            ptnb = None
+        # RULES USING WORD-FORM, POS OR LEMMA ONLY ===========================
+        #   (precomputed for the whole batch if lexhits given)
+        if lexhits is not None:
+            lexrid, lexetype = lexhits[idx]
+        else:
+            # lemmas
+            clemma = tid2lemma.get(ctnb, "")
+            clemmas = [tid2lemma[tnb] for tnb in ctnbs if tnb in tid2lemma]
+            # check if any lemma in cline is verb which can take 'suplemento' complement
+            suplemento_lemma = [lem for lem in clemmas if lem in lxinfo["suplemento"]]
+            lexrid, lexetype = lexical_rule(
+                (pwf, ppos, ptid), (cwf, cpos, ctid), (nwf, npos, ntid),
+                (swf, spos, stid), nline, clemma, suplemento_lemma, lxinfo,
+                disabled)
+        rid = lexrid
+        if lexrid is not None:
+            if lexetype is not None:
+                ut.update_span(detections, idx, lexetype, lexrid, dones, m14)
                 has_enca = True
-        #   determiners ---------------
-        #   (needs to precede noun, adj, adverb, determiner)
-        elif cpos == "D" and npos in ("N", "G", "A", "D"):
-            ut.update_span(detections, idx, "sirrem_pal-rel~det", "pp16", dones, m14)
-            has_enca = True
-        # verb + verb (perífrasis verbal o tiempo compuesto etc.) -------------
-        elif False and (cpos, npos) == ("V", "V"):              # overapplies
-            ut.update_span(detections, idx, "sirrem_perif_verb", "pp17", dones, m14)
-            has_enca = True
-        # verb + prep + verb (perífrasis verbal)
-        elif False and (cpos, npos, spos) == ("V", "P", "V"):   # overapplies
-            ut.update_span(detections, idx, "sirrem_perif_verb", "pp18", dones, m14)
-            has_enca = True
-        # new periphrasis rules (dictionary-based)
-        #   [verb // prep + verb] or [verb // prep + clitic + verb]
-        elif (clemma in lxinfo["periphrases"] and
-              nwf in lxinfo["periphrases"][clemma]["ponly"] and
-              # [// prep + V] or [// prep + preposed clitic + V (archaic)]
-              (spos == "V" or (spos == "Q" and nline[2][1] == "V"))):
-            ut.update_span(detections, idx, "sirrem_perif_verb", "pp19", dones, m14)
-            has_enca = True
-        #   [verb // verb|participle] ("G" possible participle for pos-errors)
-        elif (clemma in lxinfo["periphrases"] and not
-              lxinfo["periphrases"][clemma]["ponly"] and
-              ((npos == "V") or ("G" in lxinfo["periphrases"][clemma]["tonly"]
-                                 and npos == "G"))):
-            ut.update_span(detections, idx, "sirrem_perif_verb", "pp20", dones, m14)
-            has_enca = True
-        # [verb // verb], general rule for any aux verb in list
-        elif (clemma in lxinfo["periphrases"] and
-              lxinfo["periphrases"][clemma]["tonly"] and
-              npos == "V"):
-            ut.update_span(detections, idx, "sirrem_perif_verb", "pp21", dones, m14)
-            has_enca = True
-
-        # verbo + suplemento --------------------------------------------------
-        # aproximación [verbo + prep_de] overapplies
-        elif False and (cpos, npos) == ("V", "P") and nwf.lower() in ("de", "del"):
-            ut.update_span(detections, idx, "sirrem_verb_supl", "pp22", dones, m14)
-            has_enca = True
-        # (aproximación: verbo + prep if verb lemma and prep in
-        #  a configurable list in lxinfo)
-        elif (cpos, npos) == ("V", "P") and (clemma in lxinfo["suplemento"] and
-                nwf in lxinfo["suplemento"][clemma]):
-            ut.update_span(detections, idx, "sirrem_verb_supl", "pp23", dones, m14)
-            has_enca = True
-        elif (cpos, npos) == ("G", "P") and (clemma in lxinfo["suplemento"] and
-                nwf in lxinfo["suplemento"][clemma]):
-            ut.update_span(detections, idx, "sirrem_verb_supl", "pp24", dones, m14)
-            has_enca = True
-        elif (clemma in lxinfo["suplemento"] and
-                nwf in lxinfo["suplemento"][clemma]):
-            ut.update_span(detections, idx, "sirrem_verb_supl", "pp25", dones, m14)
-            has_enca = True
-        elif (len(suplemento_lemma) > 0 and nwf.lower()
-              in lxinfo["suplemento"][suplemento_lemma[0]]):
-            ut.update_span(detections, idx, "sirrem_verb_supl", "pp26", dones, m14)
-            has_enca = True
-
-        # oracional -----------------------------------------------------------
-        elif (cpos in ("G", "N", "Q", "R") and npos == "Q"
-              and nwf.lower() in ("que", "cuyo", "cuya", "cuyos",
-                                  "cuyas", "donde")):
-                                  # 'adonde' many errors in xv-xvii
-            etypes = {"comp-noun": ["G", "N", "R"], "comp-pron": ["Q"]}
-            etype = [ke for ke, va in etypes.items() if cpos in va][0]
-            ut.update_span(detections, idx, "oracional_{}".format(etype), "cp01", dones, m14)
-            has_enca = True
-        #   adverbial clause (a quien, con quien ...)
-        elif False and (cpos in ("G", "N", "Q", "R") and spos == "Q"
-              and npos == "P"
-              and swf.lower() in ("que", "cuyo", "cuya", "cuyos",
-                                  "cuyas", "donde")):
-                                  # 'adonde' many errors in xv-xvii
-            etypes = {"comp-noun": ["G", "N", "R"], "comp-pron": ["Q"]}
-            etype = [ke for ke, va in etypes.items() if cpos in va][0]
-            ut.update_span(detections, idx, "oracional_{}".format(etype), "cp02", dones, m14)
-            has_enca = True
-
         # RULES THAT NEED CONSTITUENCY INFO ====================================
         # complemento del nombre (noun seguido de prep (salvo 'de')
         # en mismo constituyente)
-        elif useconst and tuple((cpos, npos)) == ("N", "P"):
-            for chunk_type, tid_list in extractor.get_all_chunks_for_term(
-                    ctid):
-                if (chunk_type == "GRUP.NOM" and ntid in tid_list
+        elif (useconst and "pc01" not in disabled and
+              tuple((cpos, npos)) == ("N", "P")):
+            rid = "pc01"
+            if (ntid in chunks.get(ctid, {}).get("GRUP.NOM", ())
                     and nwf not in ("de", "del")):
-                    ut.update_span(detections, idx,
-                                   "sirrem_noun_prep-{}".format(nwf), "pc01",
-                                   dones, m14)
-                    has_enca = True
+                ut.update_span(detections, idx,
+                               "sirrem_noun_prep-{}".format(nwf), "pc01",
+                               dones, m14)
+                has_enca = True
         # complemento del adjetivo (adj seguido de prep (salvo 'de')
         # en mismo constituyente)
-        elif useconst and tuple((cpos, npos)) == ("G", "P"):
-            for chunk_type, tid_list in extractor.get_all_chunks_for_term(
-                    ctid):
-                if (chunk_type == "GRUP.A" and ntid in tid_list
+        elif (useconst and "pc02" not in disabled and
+              tuple((cpos, npos)) == ("G", "P")):
+            rid = "pc02"
+            if (ntid in chunks.get(ctid, {}).get("GRUP.A", ())
                     and nwf not in ("de", "del")):
-                    ut.update_span(detections, idx,
-                                   "sirrem_adj_prep-{}".format(nwf), "pc02",
-                                   dones, m14)
-                    has_enca = True
+                ut.update_span(detections, idx,
+                               "sirrem_adj_prep-{}".format(nwf), "pc02",
+                               dones, m14)
+                has_enca = True
         # RULES USING DEPS ====================================================
         #TODO keepdep thing is repetitive, refactor
         # análisis como agente de pasiva (puede haber errores)
-        elif usedep and [hd for hd in deps if hd.get_function() == "cag"
-              and hd.get_from() == ctid]:
+        elif usedep and "pd01" not in disabled and [
+                hd for frm, to, hd in deps.get("cag", ()) if frm == ctnb]:
+            rid = "pd01"
             ut.update_span(detections, idx,
                            u"sirrem_{}_prep-{}".format(REPS[cpos], nwf),
                            "pd01", dones, m14)
             has_enca = True
             # logging
-            keepdep = [hd for hd in deps if hd.get_function() == "cag"
-                       and hd.get_from() == ctid]
-            cfg.LOG or lf is not None and ut.logdep(
-                fn, tree, lf, idx, "pd01", (cwf, cpos, ctid), (nwf, npos, ntid),
-                (pwf, ppos, ptid), (swf, spos, stid), keepdep[0])
+            if trace:
+                logidx = logidx or ut.index_tree_for_log(tree)
+                keepdep = [hd for frm, to, hd in deps.get("cag", ())
+                           if frm == ctnb]
+                ut.logdep(
+                    fn, tree, lf, idx, "pd01", (cwf, cpos, ctid), (nwf, npos, ntid),
+                    (pwf, ppos, ptid), (swf, spos, stid), keepdep[0], logidx)
         # complementos preposicionales de n/adj no introducidos por 'de(l)'
         # n/adj precede a prep
-        elif usedep and [hd for hd in deps if hd.get_function() == "sp"
-                and hd.get_to() == ntid and nwf.lower() not in ("de", "del")
+        elif usedep and "pd02" not in disabled and [
+                hd for frm, to, hd in deps.get("sp", ())
+                if to == ntnb and nwf.lower() not in ("de", "del")
                 # remove restriction on nwf to repro errors when REPS had N G only
                 and nwf.lower() in PREPS
-                and hd.get_from() in (ctid, ptid) and cpos in ("N", "G")]:
+                and frm in (ctnb, ptnb) and cpos in ("N", "G")]:
+            rid = "pd02"
             ut.update_span(detections, idx,
                            u"sirrem_{}_prep-{}".format(REPS[cpos],
                            nwf.lower()), "pd02", dones, m14)
             has_enca = True
             # logging
-            keepdep = [hd for hd in deps if hd.get_function() == "sp"
-                and hd.get_to() == ntid and nwf.lower() not in ("de", "del")
-                # remove restriction on nwf to repro errors when REPS had N G only
-                and nwf.lower() in PREPS
-                and hd.get_from() in (ctid, ptid) and cpos in ("N", "G")][0]
-            cfg.LOG or lf is not None and ut.logdep(
-                fn, tree, lf, idx, "pd02", (cwf, cpos, ctid), (nwf, npos, ntid),
-                (pwf, ppos, ptid), (swf, spos, stid), keepdep)
+            if trace:
+                logidx = logidx or ut.index_tree_for_log(tree)
+                keepdep = [hd for frm, to, hd in deps.get("sp", ())
+                    if to == ntnb and nwf.lower() not in ("de", "del")
+                    # remove restriction on nwf to repro errors when REPS had N G only
+                    and nwf.lower() in PREPS
+                    and frm in (ctnb, ptnb) and cpos in ("N", "G")][0]
+                ut.logdep(
+                    fn, tree, lf, idx, "pd02", (cwf, cpos, ctid), (nwf, npos, ntid),
+                    (pwf, ppos, ptid), (swf, spos, stid), keepdep, logidx)
         # prep precede a n/adj
-        elif usedep and [hd for hd in deps if hd.get_function() == "sn"
-              and hd.get_to() == ntid and cwf not in ("de", "del") and pwf.lower()
+        elif usedep and "pd03" not in disabled and [
+              hd for frm, to, hd in deps.get("sn", ())
+              if to == ntnb and cwf not in ("de", "del") and pwf.lower()
               not in ("de", "del")
-              and hd.get_from() in (ctid, ptid) and "P" in (cpos, ppos)]:
+              and frm in (ctnb, ptnb) and "P" in (cpos, ppos)]:
+            rid = "pd03"
             if ((cpos == "P" and cwf in PREPS and npos in ("G", "N")) or
                     (ppos == "P" and pwf in PREPS and npos in ("G", "N"))):
                 wfo = cwf.lower() if cpos == "P" else pwf.lower()
@@ -430,45 +628,57 @@ def detect(fn, lf, tokp, naffn, lxinfo, lang, useconst, usedep, m14):
                                "pd03", dones, m14)
                 has_enca = True
                 # logging
-                keepdep = [hd for hd in deps if hd.get_function() == "sn"
-                           and hd.get_to() == ntid and cwf not in ("de", "del")
-                           and pwf.lower() not in ("de", "del")
-                           and hd.get_from() in (ctid, ptid) and "P" in (cpos, ppos)]
-                cfg.LOG or lf is not None and ut.logdep(
-                    fn, tree, lf, idx, "pd03", (cwf, cpos, ctid), (nwf, npos, ntid),
-                    (pwf, ppos, ptid), (swf, spos, stid), keepdep[0])
+                if trace:
+                    logidx = logidx or ut.index_tree_for_log(tree)
+                    keepdep = [hd for frm, to, hd in deps.get("sn", ())
+                               if to == ntnb and cwf not in ("de", "del")
+                               and pwf.lower() not in ("de", "del")
+                               and frm in (ctnb, ptnb) and "P" in (cpos, ppos)]
+                    ut.logdep(
+                        fn, tree, lf, idx, "pd03", (cwf, cpos, ctid), (nwf, npos, ntid),
+                        (pwf, ppos, ptid), (swf, spos, stid), keepdep[0], logidx)
         # enlaces -----------------------------------------
         elif usedep:
-            if [hd for hd in deps if hd.get_function() == "suj" and
+            if "ld01" not in disabled and [
+                  hd for frm, to, hd in deps.get("suj", ()) if
                   cwf not in punctuation and (
-                  (hd.get_from() in ctids and hd.get_to() in ntids) or
-                  (hd.get_to() in ctids and hd.get_from() in ntids))]:
+                  (frm in ctids and to in ntids) or
+                  (to in ctids and frm in ntids))]:
+                rid = "ld01"
                 ut.update_span(detections, idx, u"enlace_subj_verb", "ld01", dones, m14)
                 has_enca = True
                 # logging
-                keepdep = [hd for hd in deps if hd.get_function() == "suj" and
-                           cwf not in punctuation and (
-                           (hd.get_from() in ctids and hd.get_to() in ntids) or
-                           (hd.get_to() in ctids and hd.get_from() in ntids))]
-                cfg.LOG or lf is not None and ut.logdep(
-                    fn, tree, lf, idx, "ld01", (cwf, cpos, ctid), (nwf, npos, ntid),
-                    (pwf, ppos, ptid), (swf, spos, stid), keepdep[0])
-            elif [hd for hd in deps if hd.get_function() == "cd"
-                  and cwf not in punctuation and (
-                  (hd.get_from() in ctids and hd.get_to() in ntids) or
-                  (hd.get_to() in ctids and hd.get_from() in ntids))]:
+                if trace:
+                    logidx = logidx or ut.index_tree_for_log(tree)
+                    keepdep = [hd for frm, to, hd in deps.get("suj", ()) if
+                               cwf not in punctuation and (
+                               (frm in ctids and to in ntids) or
+                               (to in ctids and frm in ntids))]
+                    ut.logdep(
+                        fn, tree, lf, idx, "ld01", (cwf, cpos, ctid), (nwf, npos, ntid),
+                        (pwf, ppos, ptid), (swf, spos, stid), keepdep[0], logidx)
+            elif "ld02" not in disabled and [
+                  hd for frm, to, hd in deps.get("cd", ())
+                  if cwf not in punctuation and (
+                  (frm in ctids and to in ntids) or
+                  (to in ctids and frm in ntids))]:
+                rid = "ld02"
                 ut.update_span(detections, idx, u"enlace_od_verb", "ld02", dones, m14)
                 has_enca = True
                 # logging
-                keepdep = [hd for hd in deps if hd.get_function() == "cd"
-                           and cwf not in punctuation and (
-                           (hd.get_from() in ctids and hd.get_to() in ntids) or
-                           (hd.get_to() in ctids and hd.get_from() in ntids))]
-                cfg.LOG or lf is not None and ut.logdep(
-                    fn, tree, lf, idx, "ld02", (cwf, cpos, ctid), (nwf, npos, ntid),
-                    (pwf, ppos, ptid), (swf, spos, stid), keepdep[0])
+                if trace:
+                    logidx = logidx or ut.index_tree_for_log(tree)
+                    keepdep = [hd for frm, to, hd in deps.get("cd", ())
+                               if cwf not in punctuation and (
+                               (frm in ctids and to in ntids) or
+                               (to in ctids and frm in ntids))]
+                    ut.logdep(
+                        fn, tree, lf, idx, "ld02", (cwf, cpos, ctid), (nwf, npos, ntid),
+                        (pwf, ppos, ptid), (swf, spos, stid), keepdep[0], logidx)
 
         # RULES END ===========================================================
+        if fired is not None and rid is not None:
+            fired.add(rid)
         # postprocess bad tokenization cases
         #     deal with wrongly added annotations
         if cwf and cwf[-1] in punctuation:
@@ -496,35 +706,40 @@ def detect(fn, lf, tokp, naffn, lxinfo, lang, useconst, usedep, m14):
                     detections[idx+1].append(("O", "", "00"))
 
         # enjambment tag normalization (to use broad vs detailed tags)
-        if cfg.NORM_ETAGS:
-            normtags = [(annot[0], ut.normalize_enca_types(cfg, annot[1]), annot[2])
+        if norm:
+            normtags = [(annot[0], ut.normalize_enca_types(
+                            cfg, annot[1], lxinfo.get("tagnorm")), annot[2])
                         for annot in detections[idx]]
             detections[idx] = normtags
-            normtags1 = [(annot[0], ut.normalize_enca_types(cfg, annot[1]), annot[2])
+            normtags1 = [(annot[0], ut.normalize_enca_types(
+                             cfg, annot[1], lxinfo.get("tagnorm")), annot[2])
                          for annot in detections[idx+1]]
             detections[idx+1] = normtags1
         # translate enjambment tag to Spanish if needed
+        #   (lines get here twice, so leave already translated tags as is)
         if lang == "es":
-            transtags = [(annot[0], ut.translate_enca_tag(cfg, annot[1]), annot[2])
+            if "tagtrans" not in lxinfo:
+                lxinfo["tagtrans"] = ut.load_enca_tag_translations(cfg)
+            trdi = lxinfo["tagtrans"]
+            transtags = [(annot[0], trdi.get(annot[1], annot[1]), annot[2])
                          for annot in detections[idx]]
             detections[idx] = transtags
-            transtags1 = [(annot[0], ut.translate_enca_tag(cfg, annot[1]), annot[2])
+            transtags1 = [(annot[0], trdi.get(annot[1], annot[1]), annot[2])
                           for annot in detections[idx+1]]
             detections[idx+1] = transtags1
     return detections
 
 
-def write_out(toks, res, ofn, tsv=False, rids=False):
+def line_tags(toks, res):
     """
-    Writes out poems annotated for encabalgamiento and its type,
-    one file per poem.
-    Merges each line token list (toks) with the annotation for that line (res)
+    Format the tokens for each line in a poem and split its annotations by
+    position, as used by the output writers
     @param toks: poem lines as lists of tokens
     @param res: lists of lines with encabalgamiento annotation
-    @param ofn: name of output file
-    @param tsv: if True, formats output so that looks nicer on a spreadsheet
+    @return: list with (tokens as {word-form pos-tag}, I tags, B tags, O tags)
+    for each line
     """
-    ols = []
+    lines = []
     for idx, al in enumerate(toks):
         # write out each token as {word-for, pos-tag}
         otoks = " ".join([u"{{{} {}}}".format(info[0], info[1])
@@ -537,6 +752,17 @@ def write_out(toks, res, ofn, tsv=False, rids=False):
             btags = [it for it in res[idx] if it[0] == "B"]
         itags = [it for it in res[idx] if it[0] == "I"]
         otags = [it for it in res[idx] if it[0] == "O"]
+        lines.append((otoks, itags, btags, otags))
+    return lines
+
+
+def poem_rows(lines, tsv=False, rids=False):
+    """
+    Rows for the results file of a single poem (see L{write_out})
+    @param lines: line infos as output by L{line_tags}
+    """
+    ols = []
+    for otoks, itags, btags, otags in lines:
         posis = "".join([i[0] for i in itags] + [b[0] for b in btags] +
                          [o[0] for o in otags])
         if tsv:
@@ -553,44 +779,31 @@ def write_out(toks, res, ofn, tsv=False, rids=False):
         if rids:
             oinfos.append(ruleids)
         # out
-        ol = "\t".join(tuple(oinfos))
-        ols.append(ol)
-    with codecs.open(ofn, "w", "utf8") as ofd:
-        ofd.write("\n".join(ols))
+        ols.append("\t".join(tuple(oinfos)))
+    return ols
 
 
-def write_out_to_single_file(toks, res, title, ofn, write_header=False,
-                             tsv=False, rids=False):
+def corpus_header(rids=False):
+    """Header for the single results file for a corpus"""
+    header = u"title\tlnbr\tline\tenca_position\tenca_type"
+    if rids:
+        header += "\trule_ids"
+    return header
+
+
+def corpus_rows(lines, title, tsv=False, rids=False):
     """
-    Writes out poems annotated for encabalgamiento and its type to a single file
-    (can use to open with spreadsheet)
-    Merges each line token list (toks) with the annotation for that line (res)
-    @param toks: poem lines as lists of tokens
-    @param res: lists of lines with encabalgamiento annotation
-    @param title: each file-name in corpus (to get title for the poem)
-    @param ofn: name of output file
-    @param tsv: if True, formats output so that looks nicer on a spreadsheet
-    @param write_header: to add a header on first writing to the results file
+    Rows for a poem in the single results file for a corpus (see
+    L{write_out_to_single_file})
+    @param lines: line infos as output by L{line_tags}
+    @param title: file-name for the poem (to get title for the poem)
     """
-    if write_header:
-        ols = [u"title\tlnbr\tline\tenca_position\tenca_type"]
-        if rids:
-            ols[0] += "\trule_ids"
-    else:
-        ols = []
+    ols = []
     #clean_fn = re.sub("_.+", "", os.path.splitext(os.path.basename(title))[0])
     clean_fn = os.path.splitext(os.path.basename(title))[0]
-    for idx, al in enumerate(toks):
-        otoks = " ".join([u"{{{} {}}}".format(info[0], info[1])
-                          for info in al])
-        # collect the infos
-        #   no 'B' allowed in last line: filter out
-        if idx == len(toks) - 1:
-            btags = []
-        else:
-            btags = [it for it in res[idx] if it[0] == "B"]
-        itags = [it for it in res[idx] if it[0] == "I"]
-        otags = [it for it in res[idx] if it[0] == "O"]
+    if isinstance(clean_fn, str):
+        clean_fn = clean_fn.decode("utf8")
+    for idx, (otoks, itags, btags, otags) in enumerate(lines):
         posis = "".join([i[0] for i in itags] + [b[0] for b in btags] +
                         [o[0] for o in otags])
         if tsv:
@@ -607,31 +820,55 @@ def write_out_to_single_file(toks, res, title, ofn, write_header=False,
                 ruleids = ";".join([i[2] for i in itags] + [b[2] for b in btags] +
                                    [o[2] for o in otags])
         # out
-        if isinstance(clean_fn, str):
-            clean_fn_fmt = clean_fn.decode("utf8")
-        else:
-            clean_fn_fmt = clean_fn
-        oinfos = [clean_fn_fmt, str(idx + 1), otoks, posis, typetags]
+        oinfos = [clean_fn, str(idx + 1), otoks, posis, typetags]
         if rids:
             oinfos.append(ruleids)
-        ol = "\t".join(tuple(oinfos))
-        ols.append(ol)
-    with codecs.open(ofn, "a", "utf8") as ofd:
+        ols.append("\t".join(tuple(oinfos)))
+    return ols
+
+
+def write_out(toks, res, ofn, tsv=False, rids=False):
+    """
+    Writes out poems annotated for encabalgamiento and its type,
+    one file per poem.
+    Merges each line token list (toks) with the annotation for that line (res)
+    @param toks: poem lines as lists of tokens
+    @param res: lists of lines with encabalgamiento annotation
+    @param ofn: name of output file
+    @param tsv: if True, formats output so that looks nicer on a spreadsheet
+    """
+    ols = poem_rows(line_tags(toks, res), tsv=tsv, rids=rids)
+    with ut.open_file(ofn, "w", "utf8") as ofd:
+        ofd.write("\n".join(ols))
+
+
+def write_out_to_single_file(toks, res, title, ofn, write_header=False,
+                             tsv=False, rids=False):
+    """
+    Writes out poems annotated for encabalgamiento and its type to a single file
+    (can use to open with spreadsheet)
+    Merges each line token list (toks) with the annotation for that line (res)
+    @param toks: poem lines as lists of tokens
+    @param res: lists of lines with encabalgamiento annotation
+    @param title: each file-name in corpus (to get title for the poem)
+    @param ofn: name of output file
+    @param tsv: if True, formats output so that looks nicer on a spreadsheet
+    @param write_header: to add a header on first writing to the results file
+    """
+    ols = [corpus_header(rids)] if write_header else []
+    ols.extend(corpus_rows(line_tags(toks, res), title, tsv=tsv, rids=rids))
+    with ut.open_file(ofn, "a", "utf8") as ofd:
         ofd.write("\n".join(ols))
         ofd.write("\n")
 
 
-def write_standoff(di, fn, of, rids=False):
+def standoff_spans(di):
     """
-    Write standoff annotations in neleval format (github.com/wikilinks/neleval)
-    Format is Title\tLineNbr1\LineNbr2\ttype\tDummyNr\ttype.
-    Using both the link column (4) and type column (last) to write the type,
-    that way can better evaluate type errors with ./nel analyze
-    @param di: dict with encabalgamiento infos
-    @param fn: input file name
-    @param of: output file name
+    Get the enjambed line spans in annotations di, as
+    (first line number, second line number, type, rule-id), 1-indexed
+    @param di: dict with encabalgamiento infos, as output by L{detect}
     """
-    outs = []
+    spans = []
     # skip last (superfluous)
     sinfos = sorted(di.items()[0:-1])
     for idx, (ke, infos) in enumerate(sinfos):
@@ -643,34 +880,253 @@ def write_standoff(di, fn, of, rids=False):
             for posi, ttype, rid in infos:
                 for posi2, ttype2, rid2 in sinfos[idx+1][1]:
                     if (posi, posi2) == ("B", "I") and ttype == ttype2:
-                        oinfos = [fn.replace("_annot.txt", ""),
-                                  ke+1, ke+2, ttype, 1, ttype]
-                        if rids:
-                            assert rid == rid2
-                            oinfos.append(rid)
-                        outs.append(tuple(oinfos))
+                        assert rid == rid2
+                        spans.append((ke+1, ke+2, ttype, rid))
         except IndexError:
             pass
-    with codecs.open(of, "a", "utf8") as outf:
-        for ol in outs:
-            #outf.write("\t".join([unicode(it) for it in ol]))
-            outf.write("\t".join([it.decode("utf8") if isinstance(it, str)
-                                  else it.encode("utf8").decode("utf8") if isinstance(it, unicode)
-                                  else str(it)
-                                  for it in ol]))
+    return spans
+
+
+def standoff_rows(fn, spans, rids=False):
+    """
+    Rows for the standoff annotations of a poem (see L{write_standoff})
+    @param fn: input file name
+    @param spans: spans as output by L{standoff_spans}
+    @return: list of rows, as tuples of unicode fields
+    """
+    if isinstance(fn, str):
+        fn = fn.decode("utf8")
+    outs = []
+    for start, end, ttype, rid in spans:
+        oinfos = [fn.replace("_annot.txt", ""), start, end, ttype, 1, ttype]
+        if rids:
+            oinfos.append(rid)
+        outs.append(tuple(it.decode("utf8") if isinstance(it, str)
+                          else it if isinstance(it, unicode)
+                          else unicode(it) for it in oinfos))
+    return outs
+
+
+def write_standoff(di, fn, of, rids=False, spans=None):
+    """
+    Write standoff annotations in neleval format (github.com/wikilinks/neleval)
+    Format is Title\tLineNbr1\LineNbr2\ttype\tDummyNr\ttype.
+    Using both the link column (4) and type column (last) to write the type,
+    that way can better evaluate type errors with ./nel analyze
+    @param di: dict with encabalgamiento infos
+    @param fn: input file name
+    @param of: output file name
+    @param spans: spans in di if already known (see L{standoff_spans})
+    """
+    if spans is None:
+        spans = standoff_spans(di)
+    with ut.open_file(of, "a", "utf8") as outf:
+        for ol in standoff_rows(fn, spans, rids):
+            outf.write("\t".join(ol))
             outf.write("\n")
 
 
+def corpus_output_paths(single_f):
+    """
+    Paths for the corpus-level outputs, given the path for the single
+    results file (txt). If that path ends in .gz or .zst, all outputs are
+    compressed
+    @return: dict with path for 'txt', 'tsv', standoff ('sto') and standoff
+    without rule ids ('norules')
+    """
+    ext = ut.compression_ext(single_f)
+    base = ut.strip_compression_ext(single_f)
+    return {"txt": single_f,
+            "tsv": re.sub("\.txt$", ".tsv", base) + ext,
+            "sto": re.sub("\.txt$", "_sto.txt", base) + ext,
+            "norules": re.sub("\.txt$", "_sto_norules.txt", base) + ext}
+
+
+def open_corpus_outputs(single_f, rids=False):
+    """
+    Open the corpus-level outputs for writing, overwriting previous versions,
+    and write the headers. They are kept open for the whole corpus, see
+    L{write_poem_outputs}
+    @param single_f: path for the single results file (see
+    L{corpus_output_paths} for the others)
+    @return: dict with an open file handle for each output, and, if they are
+    not compressed, with the byte ranges per poem to index them
+    (L{result_index}) under 'index'
+    """
+    outs = {}
+    index = {}
+    for kind, path in corpus_output_paths(single_f).items():
+        outs[kind] = ut.open_file(path, "w", "utf8")
+        if not (ut.compression_ext(path) or ut.split_archive_path(path)[0]):
+            index[kind] = {"path": path, "header": None, "poems": {}}
+    for kind in ("txt", "tsv"):
+        outs[kind].write(corpus_header(rids))
+        outs[kind].write("\n")
+        if kind in index:
+            index[kind]["header"] = (0, outs[kind].tell())
+    if index:
+        outs["index"] = index
+    return outs
+
+
+def write_poem_outputs(outs, result, ofn, rids=False):
+    """
+    Write a poem's results to its own file (as L{write_out}) and to the
+    corpus-level outputs in outs: single file in txt and tsv format (as
+    L{write_out_to_single_file}) and standoff with and without rule ids
+    (as L{write_standoff}). Line infos are collected only once for all
+    @param outs: open corpus-level outputs (see L{open_corpus_outputs})
+    @param result: detection results for the poem (see L{detect_many})
+    @param ofn: path for the poem's results file, None to skip it
+    """
+    fn, toks, ana = result["id"], result["tokens"], result["annotations"]
+    lines = line_tags(toks, ana)
+    if ofn is not None:
+        with ut.open_file(ofn, "w", "utf8") as ofd:
+            ofd.write("\n".join(poem_rows(lines, rids=rids)))
+    index = outs.get("index", {})
+    starts = dict((kind, outs[kind].tell()) for kind in index)
+    for kind, tsv in (("txt", False), ("tsv", True)):
+        ols = corpus_rows(lines, fn, tsv=tsv, rids=rids)
+        outs[kind].write("\n".join(ols))
+        outs[kind].write("\n")
+    sto = standoff_rows(fn, result["spans"], rids=rids)
+    outs["sto"].write(u"".join(u"\t".join(ol) + u"\n" for ol in sto))
+    outs["norules"].write(u"".join(u"\t".join(ol[0:6]) + u"\n" for ol in sto))
+    for kind, start in starts.items():
+        end = outs[kind].tell()
+        if end > start:
+            ri.add_range(index[kind]["poems"], ri.poem_key(fn), start, end)
+
+
+def close_corpus_outputs(outs):
+    """
+    Close the handles opened with L{open_corpus_outputs}, and write the
+    index for each output (L{result_index.write_index})
+    """
+    index = outs.pop("index", {})
+    for ofd in outs.values():
+        ofd.close()
+    for entry in index.values():
+        ri.write_index(entry["path"], entry["header"], entry["poems"])
+
+
+def load_resources(cf=cfg):
+    """
+    Load the lexicons and tag maps needed by L{detect}, once per process
+    (later calls return the same dict)
+    @param cf: config for app, at L{config.py}
+    @return: dict with 'suplemento' and 'periphrases' lexicons (see
+    L{utils.read_suplemento}, L{utils.read_periphrases}, loaded from their
+    snapshot, L{utils.load_lexicons}), and 'tagnorm'
+    and 'tagtrans' tag maps (see L{utils.load_enca_tag_normalization},
+    L{utils.load_enca_tag_translations})
+    """
+    key = (cf.suplemento, cf.periphrases, cf.entagnorm, cf.tag_translation)
+    if key not in RESOURCES:
+        RESOURCES[key] = ut.load_lexicons(cf)
+        RESOURCES[key].update({
+            "tagnorm": ut.load_enca_tag_normalization(cf),
+            "tagtrans": ut.load_enca_tag_translations(cf)})
+    return RESOURCES[key]
+
+
+def detect_many(poems, lxinfo=None, lang="en", useconst=cfg.USE_CONSTITUENCY,
+                usedep=cfg.USE_DEP, m14=cfg.MORE14, lf=None, vectorized=False,
+                norm=None, disabled=OFF_RULES):
+    """
+    Apply L{detect} to several poems, without reading or writing any files
+    (other than NAF files given as paths, and the log if any).
+    @param poems: iterable of (poem-id, tokens, naf) for each poem. Tokens as
+    read by L{utils.read_pos_tagged_poem} (or lists of lines of tokens), naf
+    a path to the NAF file or the already parsed
+    L{KafNafParserPy.KafNafParser}
+    @param lxinfo: lexicons and tag maps, see L{load_resources} (the default)
+    @param lf: log filehandle open to write (for rule details)
+    @param vectorized: apply the rules not needing syntax to batches of
+    L{config.VECTOR_BATCH} poems at once, with NumPy (see L{boundaries})
+    @param norm: normalize enjambment tags, see L{detect}
+    @param disabled: ids of the rules not to apply, see L{detect}
+    @return: generator with a dict per poem, in input order: 'id' (poem-id),
+    'tokens' (a L{utils.TaggedPoem}), 'annotations' (as returned by
+    L{detect}, i.e. (B/I/O position, type, rule-id) tuples for each line
+    index) and 'spans' (as returned by L{standoff_spans})
+    """
+    if lxinfo is None:
+        lxinfo = load_resources()
+    if vectorized:
+        import boundaries as bd
+    step = cfg.VECTOR_BATCH if vectorized else 1
+    poems = iter(poems)
+    while True:
+        batch = list(itertools.islice(poems, step))
+        if not batch:
+            break
+        batch = [(pid, toks if isinstance(toks, ut.TaggedPoem)
+                  else ut.TaggedPoem(toks), naf)
+                 for pid, toks, naf in batch]
+        if vectorized:
+            # each tree is reduced to its features (see naf_features) as soon
+            # as it is parsed, so only one tree is alive at a time
+            records = []
+            for pid, toks, naf in batch:
+                tree = naf
+                if isinstance(naf, basestring):
+                    tree = ut.read_naf(naf.replace(".txt", ".xml"))
+                if not isinstance(tree, dict):
+                    tree = naf_features(toks, tree, useconst)
+                records.append((pid, toks, tree))
+            feats = bd.extract_features(records, lxinfo)
+            # with a log, detect reads the NAF again for the rule details
+            if lf is None:
+                batch = records
+            batch_hits = bd.lexical_hits_by_poem(
+                feats, bd.lexical_hits(feats, lxinfo, disabled))
+        else:
+            batch_hits = [None] * len(batch)
+        for (pid, toks, naf), lexhits in zip(batch, batch_hits):
+            ana = detect(pid, lf, toks, naf, lxinfo, lang, useconst, usedep,
+                         m14, lexhits=lexhits, norm=norm, disabled=disabled)
+            yield {"id": pid, "tokens": toks, "annotations": ana,
+                   "spans": standoff_spans(ana)}
+
+
+def read_poems(fns, idn, nafdir):
+    """
+    Read pos-tagged poems as input for L{detect_many}
+    @param fns: filenames for the poems (ending in L{config.possfx})
+    @param idn: dir with poems annotated w pos and term-id
+    @param nafdir: dir with the NAF for each poem
+    @return: generator of (filename, tokens, NAF path). Filenames are given
+    without compression extension (poems and NAF can be compressed, see
+    L{utils.open_file})
+    """
+    for fn in fns:
+        fn = ut.strip_compression_ext(fn)
+        if isinstance(fn, str):
+            fnfmt = fn.decode("utf8")
+        else:
+            fnfmt = fn
+        #print ur"- Detect: {}".format(fn)
+        print ur"- Detect: {}".format(repr(fnfmt))
+        ffn = ut.find_file(os.path.join(idn, fn))
+        yield (fn, ut.read_pos_tagged_poem(ffn),
+               os.path.join(nafdir, fn.replace(cfg.possfx, cfg.nlpsfx)))
+
+
 def run_dir(idn, odn, single_f, nafdir, lang, useconst, usedep, m14=cfg.MORE14,
             logfn=None, sorter_list_fn=None, restrict_to_list_fn=None,
-            print_rule_ids=None):
+            print_rule_ids=None, vectorized=False, dbfn=None, authors=None,
+            poems=None):
     """
     Runs other functions in the module
-    @param idn: dir with poems annotated w pos and term-id
-    @param odn: output dir
+    @param idn: dir with poems annotated w pos and term-id (can be a zip or tar
+    archive, see L{utils.split_archive_path})
+    @param odn: output dir (a zip archive is created if it ends in .zip, see
+    L{utils.make_output_dir})
     @param single_f: path for single path output
     @param nafdir: naf annotations are in this dir (used for constituents
-    and dependencies)
+    and dependencies); can also be an archive
     @param useconst: use constituency or not
     @type useconst: bool
     @param usedep: use dependency or not
@@ -682,95 +1138,77 @@ def run_dir(idn, odn, single_f, nafdir, lang, useconst, usedep, m14=cfg.MORE14,
     @param print_rule_ids: will add column with rule ids to results, with
     L{cfg.PRINT_RULEIDS} as default
     @type print_rule_ids: bool
+    @param vectorized: apply the rules not needing syntax to batches of poems
+    at once, with NumPy (see L{boundaries})
+    @type vectorized: bool
+    @param dbfn: path for a SQLite database to also store the results in
+    (see L{results_db}), replacing any previous one
+    @param authors: author-id ranges to analyze (see
+    L{selection.parse_id_ranges}), all if None
+    @param poems: poem-id ranges to analyze, all if None
     """
-    ## debug
-    global lexinfo
-    ##
-    if not os.path.exists(odn):
-        os.makedirs(odn)
-    # remove previous versions of files in append mode
-    if os.path.exists(single_f):
-        os.remove(single_f)
-    # paths to tsv and sto
-    tsvfile = re.sub("\.txt$", ".tsv", single_f)
-    standoff = re.sub("\.txt$", "_sto.txt", single_f)
-    norules = re.sub("_sto.txt", "_sto_norules.txt", standoff)
-    if os.path.exists(standoff):
-        os.remove(standoff)
-    if os.path.exists(tsvfile):
-        os.remove(tsvfile)
-    # output sorting
-    if sorter_list_fn is not None:
-        # custom (files to skip will move to end, they start with '__')
-        sorter_list = ut.file_to_ordered_list(sorter_list_fn)
-        sorted_outfile_list = sorted(
-            os.listdir(idn), key=lambda finame: sorter_list.index(
-            re.sub("_.*", "", finame)))
-    else:
-        # standard
-        sorted_outfile_list = sorted(os.listdir(idn))
-    # check filenames to analyze
-    if restrict_to_list_fn is not None:
-        keeplist = ut.read_filenames_to_restrict_detection(restrict_to_list_fn)
-    else:
-        keeplist = sorted_outfile_list
+    ut.make_output_dir(odn)
+    outpaths = corpus_output_paths(single_f)
+    # filenames to analyze, in output order
+    keeplist = sel.select_files(idn, sorter_list_fn, restrict_to_list_fn,
+                                authors, poems)
     # open log
     if logfn is not None:
         logfh = codecs.open(logfn, "w", "utf8")
     else:
         logfh = None
     # load lexical infos
-    lexinfo = dict()
-    lexinfo["suplemento"] = ut.read_suplemento(cfg)
-    lexinfo["periphrases"] = ut.read_periphrases(cfg)
+    lexinfo = load_resources()
     # process
-    dones = 0
     print u"- Allow rule application beyond 17 lines (0=n 1=y): [{}]".format(
         int(m14))
-    # for fn in sorted_outfile_list:
+    # files to process
+    todo = []
     for fn in keeplist:
-        if isinstance(fn, str):
-            fnfmt = fn.decode("utf8")
-        else:
-            fnfmt = fn
         if fn.startswith("__"):
+            fnfmt = fn.decode("utf8") if isinstance(fn, str) else fn
             print u"! Skipping (manually) [{}]".format(fnfmt)
             continue
-        #print ur"- Detect: {}".format(fn)
-        print ur"- Detect: {}".format(repr(fnfmt))
-        ffn = os.path.join(idn, fn)
-        naffn = os.path.join(nafdir, fn.replace("_annot.txt", "_parsed.xml"))
-        ofn = os.path.join(odn, fn.replace("_annot.txt", "_results.txt"))
-        # processing
-        toks = ut.read_pos_tagged_poem(ffn)
-        ana = detect(fn, logfh, toks, naffn, lexinfo, lang, useconst, usedep, m14)
-        # write to individual files per poem
-        write_out(toks, ana, ofn, rids=print_rule_ids)
-        # write all to a single file (to open in spreadsheet, tsv reads nicer)
-        if dones == 0:
-            write_out_to_single_file(toks, ana, fn, single_f,
-                                     write_header=True, rids=print_rule_ids)
-            write_out_to_single_file(toks, ana, fn, tsvfile,
-                                     write_header=True, tsv=True,
-                                     rids=print_rule_ids)
-        else:
-            write_out_to_single_file(toks, ana, fn, single_f,
-                                     rids=print_rule_ids)
-            write_out_to_single_file(toks, ana, fn, tsvfile, tsv=True,
-                                     rids=print_rule_ids)
-        dones += 1
-        # standoff annotations
-        write_standoff(ana, fn, standoff, rids=print_rule_ids)
+        todo.append(fn)
+    mt.set_total(len(todo))
+    # corpus-level outputs are kept open and written in a single pass
+    outs = open_corpus_outputs(single_f, rids=print_rule_ids)
+    if dbfn is not None:
+        import results_db as rdb
+        conn = rdb.create_db(dbfn)
+    try:
+        for result in detect_many(read_poems(todo, idn, nafdir), lexinfo,
+                                  lang, useconst, usedep, m14, lf=logfh,
+                                  vectorized=vectorized):
+            # compressed like the corpus-level outputs, if they are
+            ofn = os.path.join(
+                odn, result["id"].replace("_annot.txt", "_results.txt") +
+                ut.compression_ext(single_f))
+            write_poem_outputs(outs, result, ofn, rids=print_rule_ids)
+            if dbfn is not None:
+                rdb.add_poem(conn, result)
+            if logfh is not None:
+                logfh.flush()
+            pf.poem_done(result["id"])
+            mt.poem_done(result["id"], inpaths=(
+                os.path.join(idn, result["id"]),
+                os.path.join(nafdir, result["id"].replace(
+                    cfg.possfx, cfg.nlpsfx))), outpaths=(ofn,))
+    finally:
+        close_corpus_outputs(outs)
+        ut.close_archives()
+        if dbfn is not None:
+            conn.commit()
+            conn.close()
         if logfh is not None:
-            logfh.flush()
-    if logfh is not None:
-        logfh.close()
-    os.system("cut -f1-6 {} > {}".format(standoff, norules))
-    print u"- Wrote single file to [{}]".format(single_f)
-    print u"- Wrote single file TSV to [{}]".format(tsvfile)
-    print u"- Wrote standoff to [{}]".format(standoff)
-    print u"- Wrote norules to [{}]".format(norules)
+            logfh.close()
+    print u"- Wrote single file to [{}]".format(outpaths["txt"])
+    print u"- Wrote single file TSV to [{}]".format(outpaths["tsv"])
+    print u"- Wrote standoff to [{}]".format(outpaths["sto"])
+    print u"- Wrote norules to [{}]".format(outpaths["norules"])
     print u"- Wrote log to [{}]".format(logfn)
+    if dbfn is not None:
+        print u"- Wrote database to [{}]".format(dbfn)
 
 
 def main():
@@ -779,6 +1217,10 @@ def main():
         print "Enter a valid batch name (using the default " + \
               "'DEF' is not allowed)"
         sys.exit(2)
+    if argus.profile is not None:
+        pf.install(argus.profile, "detect", argus.batchname)
+    if argus.metrics is not None:
+        mt.install(argus.metrics, "detect", argus.batchname)
     if 'customsort' in argus and argus.customsort:
         sorter = argus.sorter
     else:
@@ -796,7 +1238,8 @@ def main():
             argus.nlpdir, argus.lang, argus.constituency, argus.dependency,
             argus.m14, logpath,
             sorter_list_fn=sorter, restrict_to_list_fn=shortlist,
-            print_rule_ids=printruleids)
+            print_rule_ids=printruleids, vectorized=argus.vectorized,
+            dbfn=argus.dbfile, authors=argus.authors, poems=argus.poems)
 
 
 if __name__ == "__main__":
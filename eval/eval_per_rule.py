@@ -3,6 +3,9 @@
 """
 Compare standoff with rule-ids with reference, output whether rule matched span and type
 besides accuracy per rule.
+L{evaluate} streams both files, sorted in the order of the poems in the results,
+and joins their spans by merging, so that corpus-sized files are not held in
+memory (L{read_data} and L{compare} do the same in memory).
 @note: Assumes a single type per span. May need to refactor to treat multiple types per span.
 """
 
@@ -13,6 +16,8 @@ __email__ = 'pabloruizfabo@gmail.com'
 
 import argparse
 import codecs
+import io
+import itertools
 
 
 RULE_SORTER = ["t", "pp", "pc", "pd", "cp", "cc", "cd", "ld"]
@@ -28,6 +33,7 @@ def run_argparse():
     parser.add_argument('-r', '--rffile', help='Reference file')
     parser.add_argument('-o', '--outfile', help='Output file')
     parser.add_argument('-s', '--stats', help='Stats file')
+    parser.add_argument('-t', '--typestats', help='Stats per type file')
     return parser.parse_args()
 
 
@@ -124,18 +130,12 @@ def write_compared_standoff(di, ifn, ofn):
     @note: assumes one type per span
     """
     # read input file to get filename order
-    filename_order = []
-    with codecs.open(ifn, "r", "utf8") as infi:
-        line = infi.readline()
-        while line:
-            sl = line.strip().split("\t")
-            filename_order.append(sl[0])
-            line = infi.readline()
+    filename_order = rank_filenames(ifn)
     # write out compared results
     with codecs.open(ofn, "w", "utf8") as oufi:
         ols = ["\t".join(HEADER)]
         for fn, infos in sorted(
-                di.items(), key=lambda fn2infos: filename_order.index(fn2infos[0])):
+                di.items(), key=lambda fn2infos: filename_order[fn2infos[0]]):
             for span, infos2 in sorted(infos.items()):
                 ol = [fn, span[0], span[1],
                       ";".join(infos2["etypes"]), 1,
@@ -158,7 +158,7 @@ def write_per_rule(di, ofn):
     with codecs.open(ofn, "w", "utf8") as oufi:
         oufi.write("".join(("\t".join(header), "\n")))
         for ke, vals in sorted(di.items(),
-            key=lambda tu: (RULE_SORTER.index(tu[0][0:2]), int(tu[0][2:]))):
+            key=lambda tu: (RULE_SORTER.index(tu[0][0:2]), float(tu[0][2:]))):
             total = vals["ok"] + vals["ko"]
             ol = [ke, total, vals["ok"], vals["ko"],
                   100 * (float(vals["ok"]) / total),
@@ -168,17 +168,163 @@ def write_per_rule(di, ofn):
     print u"- Wrote stats per rule to [{}]".format(ofn)
 
 
+def write_per_type(di, ofn):
+    """
+    Write accuracy stats for each enjambment type in the results, sorted by
+    type, in the format of L{write_per_rule}
+    """
+    header = ["type", "#", "#ok", "#ko", "%ok", "%ko"]
+    ols = []
+    with codecs.open(ofn, "w", "utf8") as oufi:
+        oufi.write("".join(("\t".join(header), "\n")))
+        for ke, vals in sorted(di.items()):
+            total = vals["ok"] + vals["ko"]
+            ol = [ke, total, vals["ok"], vals["ko"],
+                  100 * (float(vals["ok"]) / total),
+                  100 * (float(vals["ko"]) / total)]
+            ols.append("\t".join([unicode(x) for x in ol]))
+        oufi.write("\n".join(ols))
+    print u"- Wrote stats per type to [{}]".format(ofn)
+
+
+def rank_filenames(dt):
+    """
+    Rank the poems in a standoff file by their first line in it
+    @return: dict {filename: rank}
+    """
+    rank = {}
+    # io is faster than codecs to iterate over lines
+    with io.open(dt, "r", encoding="utf8") as dtf:
+        for line in dtf:
+            rank.setdefault(line.strip().split("\t")[0], len(rank))
+    return rank
+
+
+def read_records(dt, mode, rank):
+    """
+    Read the lines of a standoff file for the poems in rank
+    @param mode: 'res' for results (with rule-ids), 'ref' for the reference
+    @param rank: rank for each filename (see L{rank_filenames})
+    @return: generator of (rank, start, end, filename, etype, rule-id)
+    tuples, rule-id None for the reference
+    """
+    assert mode in ("ref", "res")
+    with io.open(dt, "r", encoding="utf8") as dtf:
+        for line in dtf:
+            sl = line.strip().split("\t")
+            if sl[0] not in rank:
+                continue
+            yield (rank[sl[0]], int(sl[1]), int(sl[2]), sl[0], sl[3],
+                   sl[6] if mode == "res" else None)
+
+
+def sorted_records(dt, mode, rank):
+    """
+    Records as in L{read_records}, sorted by poem rank and span. Streamed
+    from the file if already in that order (as detect.py writes results, or
+    the -sorted reference files when the results are in filename order),
+    else sorted in memory
+    """
+    last = None
+    for rec in read_records(dt, mode, rank):
+        if last is not None and rec[:3] < last:
+            # stable, keeps file order for lines with the same span
+            return iter(sorted(read_records(dt, mode, rank),
+                               key=lambda rec: rec[:3]))
+        last = rec[:3]
+    return read_records(dt, mode, rank)
+
+
+def group_spans(records):
+    """
+    Group sorted records (see L{sorted_records}) by span
+    @return: generator of ((rank, start, end), filename, etypes, rule-ids)
+    @note: as in L{read_data}, the rule-ids for a span repeated in the
+    results are those in its last line only
+    """
+    for key, recs in itertools.groupby(records, key=lambda rec: rec[:3]):
+        recs = list(recs)
+        yield key, recs[0][3], [rec[4] for rec in recs], [recs[-1][5]]
+
+
+def merge_spans(res, ref):
+    """
+    Join the spans in results and reference, both as output by
+    L{group_spans}
+    @return: generator of (filename, span, etypes, rule-ids, reference
+    etypes) for each span in the results, reference etypes None if the span
+    is not in the reference
+    """
+    refspan = next(ref, None)
+    for key, fn, etypes, rids in res:
+        while refspan is not None and refspan[0] < key:
+            refspan = next(ref, None)
+        if refspan is not None and refspan[0] == key:
+            yield fn, key[1:], etypes, rids, refspan[2]
+        else:
+            yield fn, key[1:], etypes, rids, None
+
+
+def evaluate(ifn, rfn, ofn, sfn, tfn=None):
+    """
+    Compare results and reference like L{compare}, streaming both files,
+    and write the outputs of L{write_compared_standoff}, L{write_per_rule}
+    and, if tfn given, L{write_per_type}
+    @param ifn: results file
+    @param rfn: reference file
+    @param ofn: path for the evaluated standoff results
+    @param sfn: path for the stats per rule
+    @param tfn: path for the stats per type
+    @return: analysis per rule (see L{compare})
+    """
+    rank = rank_filenames(ifn)
+    rulean = {}
+    typean = {}
+    spans = merge_spans(group_spans(sorted_records(ifn, "res", rank)),
+                        group_spans(sorted_records(rfn, "ref", rank)))
+    with codecs.open(ofn, "w", "utf8") as oufi:
+        oufi.write("\t".join(HEADER))
+        for fn, span, etypes, rids, reftypes in spans:
+            for rid in rids:
+                rulean.setdefault(rid, {"ok": 0, "ko": 0})
+                # span in system but not in reference
+                if reftypes is None:
+                    rulean[rid]["ko"] += 1
+                else:
+                    rulean[rid]["ok"] += len(set(etypes).intersection(
+                        set(reftypes)))
+                    rulean[rid]["ko"] += len(set(etypes).difference(
+                        set(reftypes)))
+                    rulean[rid]["ko"] += len(set(reftypes).difference(
+                        set(etypes)))
+            if reftypes is None:
+                spaneval, typeseval = 0, [0 for rid in rids]
+            else:
+                assert len(etypes) == len(reftypes)
+                spaneval = 1
+                typeseval = [1 if systype == reftype else 0 for
+                             (systype, reftype) in zip(etypes, reftypes)]
+            for etype in etypes:
+                typean.setdefault(etype, {"ok": 0, "ko": 0})
+                typean[etype]["ok" if reftypes is not None and
+                              etype in reftypes else "ko"] += 1
+            ol = [fn, span[0], span[1], ";".join(etypes), 1,
+                  ";".join(etypes), ";".join(rids), spaneval,
+                  ";".join([unicode(x) for x in typeseval])]
+            oufi.write("\n" + "\t".join([unicode(x) for x in ol]))
+    print u"- Wrote evaluated standoff results to [{}]".format(ofn)
+    write_per_rule(rulean, sfn)
+    if tfn is not None:
+        write_per_type(typean, tfn)
+    return rulean
+
+
 def main():
     if DEBUG:
-        global ref
-        global sr
         global ana
     argus = run_argparse()
-    ref = read_data(argus.rffile, "ref")
-    sr = read_data(argus.infile, "res")
-    ana = compare(ref, sr)
-    write_compared_standoff(sr, argus.infile, argus.outfile)
-    write_per_rule(ana, argus.stats)
+    ana = evaluate(argus.infile, argus.rffile, argus.outfile, argus.stats,
+                   argus.typestats)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,152 @@
+# coding: utf-8
+
+"""
+Score standoff results against a reference, without running neleval:
+precision, recall and F1 for span matching (strong_mention_match: same
+poem and lines) and type matching (strong_typed_mention_match: same poem,
+lines and type), overall and per enjambment type, with the columns of
+eval/eval_per_type.sh.
+Rows are encoded as integer (poem, start, end, type) keys in NumPy arrays,
+and matched with set operations on them.
+Per type, for span matching, precision counts the results of that type whose
+span is in the reference with any type, and recall the reference spans of
+that type found with any type in the results (hence ptp and rtp can differ).
+"""
+
+__author__ = 'Pablo Ruiz'
+__date__ = '19/10/26'
+__email__ = 'pabloruizfabo@gmail.com'
+
+
+import argparse
+import codecs
+import io
+import sys
+
+import numpy
+
+
+HEADER = ["etype", "ptp", "fp", "rtp", "fn", "precis", "recall", "fscore",
+          "measure"]
+SPAN_MATCH = "strong_mention_match"
+TYPED_MATCH = "strong_typed_mention_match"
+# etype for the scores over all types
+ALL_TYPES = u"ALL"
+
+
+def run_argparse():
+    """CLI parser"""
+    parser = argparse.ArgumentParser(
+        description="Scores enjambment detection results (P/R/F1)")
+    parser.add_argument('-i', '--infile', help='Results (standoff) file')
+    parser.add_argument('-r', '--rffile', help='Reference (standoff) file')
+    parser.add_argument('-o', '--outfile', help='Output file (else stdout)')
+    return parser.parse_args()
+
+
+def read_rows(dt):
+    """
+    Read a standoff file (see L{detect.write_standoff})
+    @return: generator of rows as lists of fields (poem, start, end, type,
+    ...)
+    """
+    with io.open(dt, "r", encoding="utf8") as dtf:
+        for line in dtf:
+            sl = line.strip().split("\t")
+            if len(sl) >= 4:
+                yield sl
+
+
+def encode(rowsets):
+    """
+    Encode standoff rows as integers
+    @param rowsets: list of iterables of rows (see L{read_rows})
+    @return: list with an array per rowset, with rows poem, start, end and
+    type codes, one column per standoff row; and the type for each code
+    """
+    poems, types = {}, {}
+    arrays = []
+    for rows in rowsets:
+        cols = ([], [], [], [])
+        for row in rows:
+            cols[0].append(poems.setdefault(row[0], len(poems)))
+            cols[1].append(int(row[1]))
+            cols[2].append(int(row[2]))
+            cols[3].append(types.setdefault(row[3], len(types)))
+        arrays.append(numpy.array(cols, dtype=numpy.int64).reshape(4, -1))
+    return arrays, sorted(types, key=types.get)
+
+
+def counts(ptp, fp, rtp, fn, etype, measure):
+    """Score row with precision, recall and F1 from the counts"""
+    precis = float(ptp) / (ptp + fp) if ptp + fp else 0.0
+    recall = float(rtp) / (rtp + fn) if rtp + fn else 0.0
+    fscore = (2 * precis * recall / (precis + recall)
+              if precis + recall else 0.0)
+    return (etype, int(ptp), int(fp), int(rtp), int(fn), precis, recall,
+            fscore, measure)
+
+
+def score(sysrows, refrows):
+    """
+    Score results against the reference
+    @param sysrows: rows for the results (see L{read_rows}, or
+    L{detect.standoff_rows})
+    @param refrows: rows for the reference
+    @return: list of score rows (see L{HEADER}): span and type matching over
+    all types (L{ALL_TYPES}) first, then for each type, sorted
+    """
+    (sysa, refa), typenames = encode([sysrows, refrows])
+    nlines = max([arr[1:3].max() for arr in (sysa, refa) if arr.size] or
+                 [0]) + 1
+    ntypes = max(len(typenames), 1)
+    sysspan = (sysa[0] * nlines + sysa[1]) * nlines + sysa[2]
+    refspan = (refa[0] * nlines + refa[1]) * nlines + refa[2]
+    systyped = sysspan * ntypes + sysa[3]
+    reftyped = refspan * ntypes + refa[3]
+    allsys, allref = numpy.unique(sysspan), numpy.unique(refspan)
+    scores = []
+    for measure, skeys, rkeys in ((SPAN_MATCH, allsys, allref),
+                                  (TYPED_MATCH, numpy.unique(systyped),
+                                   numpy.unique(reftyped))):
+        tp = numpy.intersect1d(skeys, rkeys, assume_unique=True).size
+        scores.append(counts(tp, skeys.size - tp, tp, rkeys.size - tp,
+                             ALL_TYPES, measure))
+    for code, etype in sorted(enumerate(typenames), key=lambda ct: ct[1]):
+        smask, rmask = sysa[3] == code, refa[3] == code
+        skeys, rkeys = numpy.unique(sysspan[smask]), numpy.unique(refspan[rmask])
+        ptp = numpy.in1d(skeys, allref, assume_unique=True).sum()
+        rtp = numpy.in1d(rkeys, allsys, assume_unique=True).sum()
+        scores.append(counts(ptp, skeys.size - ptp, rtp, rkeys.size - rtp,
+                             etype, SPAN_MATCH))
+        skeys = numpy.unique(systyped[smask])
+        rkeys = numpy.unique(reftyped[rmask])
+        tp = numpy.intersect1d(skeys, rkeys, assume_unique=True).size
+        scores.append(counts(tp, skeys.size - tp, tp, rkeys.size - tp,
+                             etype, TYPED_MATCH))
+    return scores
+
+
+def format_scores(scores):
+    """Scores as TSV lines, header first"""
+    ols = ["\t".join(HEADER)]
+    for row in scores:
+        ols.append(u"{}\t{}\t{}\t{}\t{}\t{:.4f}\t{:.4f}\t{:.4f}\t{}".format(
+            *row))
+    return ols
+
+
+def main():
+    argus = run_argparse()
+    scores = score(read_rows(argus.infile), read_rows(argus.rffile))
+    out = u"\n".join(format_scores(scores)) + u"\n"
+    if argus.outfile is None:
+        sys.stdout.write(out.encode("utf8"))
+    else:
+        with codecs.open(argus.outfile, "w", "utf8") as oufi:
+            oufi.write(out)
+        print u"- Wrote scores to [{}]".format(argus.outfile)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,23 +10,26 @@ __date__ = '16/01/16'
 __email__ = 'pabloruizfabo@gmail.com'
 
 
+import sys
+if "--import-time" in sys.argv:
+    # before the other imports, to time them
+    import importtime
+    importtime.install()
+
 import argparse
-import codecs
-from lxml.etree import XMLSyntaxError
 import os
-from KafNafParserPy import KafNafParser as np
 
 
 # add current dir to sys.path
-import inspect
-import sys
-
-here = os.path.dirname(os.path.abspath(
-    inspect.getfile(inspect.currentframe())))
+here = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(here)
 
 # app specific imports
 import config as cfg
+import metrics as mt
+import profiling as pf
+import selection as sel
+import utils as ut
 
 
 def run_argparse():
@@ -63,6 +66,27 @@ def run_argparse():
                         default=os.path.join(
                             os.path.join(cfg.baselogdir, partargs.batchname),
                             cfg.line_positions.format(batch=partargs.batchname)))
+    parser.add_argument('--import-time', action='store_true',
+                        help='Report time spent importing modules (stderr)')
+    parser.add_argument('--profile', nargs='?', metavar='DIR',
+                        const=os.path.join(cfg.baselogdir,
+                                           partargs.batchname),
+                        help='Profile the run, writing the reports to DIR '
+                             '(see profiling.py; default: the batch log dir)')
+    parser.add_argument('--metrics', nargs='?', metavar='DIR',
+                        const=os.path.join(cfg.baselogdir,
+                                           partargs.batchname),
+                        help='Write per-poem events and a Prometheus textfile '
+                             'to DIR (see metrics.py; default: the batch log '
+                             'dir)')
+    parser.add_argument('--authors', type=sel.parse_id_ranges,
+                        help='Only poems by these author ids (from the '
+                             'file names), e.g. 321,400-420')
+    parser.add_argument('--poems', type=sel.parse_id_ranges,
+                        help='Only poems with these poem ids (from the file '
+                             'names), e.g. 1000-1099')
+    parser.add_argument('-z', '--compress', choices=('gz', 'zst'),
+                        help='Compress the output files (gzip or zstandard)')
     return parser.parse_args()
 
 
@@ -72,7 +96,7 @@ def read_positions(pf):
     @return: dict with positions by title and line number
     """
     pd = {}
-    with codecs.open(pf, "r", "utf8") as fni:
+    with ut.open_file(pf, "r", "utf8") as fni:
         ll = [l.strip() for l in fni.readlines()]
         for line in ll:
             sl = line.split("\t")
@@ -90,20 +114,33 @@ def tag_by_line(psd, pd):
     """
     Get part-of-speech info for words in a line based on parsed file psd
     and a dict with line-position info pf
-    @param psd: file with part-of-speech info (NAF format)
+    @param psd: file with part-of-speech info (NAF format, can be compressed)
     @param pd: dict with positions per line
     """
-    title = os.path.splitext(os.path.basename(psd))[0].replace("_parsed", ".txt")
+    title = os.path.splitext(os.path.basename(ut.strip_compression_ext(psd)))[
+        0].replace("_parsed", ".txt")
     # title = os.path.splitext(os.path.basename(psd))[0].replace(".xml", ".txt")
     title = title if isinstance(title, unicode) else title.decode("utf8")
     assert title in pd
-    tree = np(psd)
+    tree = ut.read_naf(psd)
+    return tag_tree_by_line(tree, pd[title])
+
+
+def tag_tree_by_line(tree, lnposis):
+    """
+    Get part-of-speech info for words in each line of a parsed poem
+    @param tree: NAF tree for the poem
+    @type tree: L{KafNafParserPy.KafNafParser}
+    @param lnposis: dict with (start, end) positions per line number, for
+    the poem (see L{read_positions})
+    @return: dict with a list of [word-form, pos, term-id] per line number
+    """
     ln2terms = {}
     for term in tree.term_layer:
         span_ids = term.get_span().get_span_ids()
         assert len(span_ids) == 1
         wf = tree.get_token(span_ids[0])
-        for lnbr, lposis in pd[title].items():
+        for lnbr, lposis in lnposis.items():
             ln2terms.setdefault(lnbr, [])
             if (int(wf.get_offset()) >= lposis[0] and int(wf.get_offset()) +
                 int(len(wf.get_text())) <= lposis[1]):
@@ -128,38 +165,62 @@ def write_tagged_lines(tl, fno, use_tid=True):
             ol = [cfg.TOKFMT.format(info[0], info[1])
                   for info in infos]
         ols.append(" ".join(ol))
-    with codecs.open(fno, "w", "utf8") as fdo:
+    with ut.open_file(fno, "w", "utf8") as fdo:
         fdo.write("\n".join(ols))
 
 
-def run_dir(idn, odn, posis):
+def run_dir(idn, odn, posis, compress=None, authors=None, poems=None):
     """
     Apply L{tag_by_line} and L{write_tagged_lines} to each file in dir dn
-    @param idn: directory name to run
-    @param odn: directory name for output
+    @param idn: directory name to run (or a zip or tar archive, see
+    L{utils.split_archive_path})
+    @param odn: directory name for output (or a zip archive to create, see
+    L{utils.make_output_dir})
     @param posis: dict with positions per line
+    @param compress: compress outputs with gzip ('gz') or zstandard ('zst')
+    @param authors: author-id ranges to run (see
+    L{selection.parse_id_ranges}), all if None
+    @param poems: poem-id ranges to run, all if None
     """
-    if not os.path.exists(odn):
-        os.makedirs(odn)
-    for fn in sorted(os.listdir(idn)):
+    from lxml.etree import XMLSyntaxError
+    ut.make_output_dir(odn)
+    fns = sel.select_files(idn, authors=authors, poems=poems)
+    mt.set_total(len(fns))
+    for fn in fns:
         #ofn = os.path.join(odn, fn.replace())
         print ur"- Annotations: {}".format(repr(fn))
         try:
             lnbr2terms = tag_by_line(os.path.join(idn, fn), posis)
-        except XMLSyntaxError:
+        except XMLSyntaxError as exc:
             print u"! Error with file {}".format(repr(fn))
+            mt.poem_done(fn, inpaths=(os.path.join(idn, fn),),
+                         error=u"XMLSyntaxError: {}".format(exc))
             continue
-        write_tagged_lines(lnbr2terms, os.path.join(
-            odn, fn.replace(cfg.nlpsfx, cfg.possfx)))
+        # NAF can be compressed and end in cfg.nafext (see ut.find_naf)
+        ofn = ut.strip_compression_ext(fn).replace(
+            os.path.splitext(cfg.nlpsfx)[0] + cfg.nafext, cfg.nlpsfx).replace(
+            cfg.nlpsfx, cfg.possfx)
+        if compress is not None:
+            ofn += "." + compress
+        write_tagged_lines(lnbr2terms, os.path.join(odn, ofn))
+        pf.poem_done(fn)
+        mt.poem_done(fn, inpaths=(os.path.join(idn, fn),),
+                     outpaths=(os.path.join(odn, ofn),))
+    ut.close_archives()
 
 
 def main():
     #cli args
     argus = run_argparse()
+    if argus.profile is not None:
+        pf.install(argus.profile, "extract_pos", argus.batchname)
+    if argus.metrics is not None:
+        mt.install(argus.metrics, "extract_pos", argus.batchname)
     # get position info
     posis = read_positions(argus.posifile)
     # recover and tag lines for all files
-    run_dir(argus.inname, argus.outdir, posis)
+    run_dir(argus.inname, argus.outdir, posis, compress=argus.compress,
+            authors=argus.authors, poems=argus.poems)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,239 @@
+# coding: utf-8
+
+"""
+Store the inputs to the detection rules for a corpus: the pos-tagged poems
+and the features from their NAF (lemmas, dependencies and constituents
+shared across line boundaries, see L{detect.naf_features}), in a single
+marshal file. The rules can then be rerun on the corpus, e.g. after editing
+them in L{detect.detect}, without parsing NAF or reading the _annot files.
+Each poem's features are keyed by a hash of the content of its NAF and
+_annot files: when extracting again into the same store, only poems whose
+files changed are parsed.
+Usage:
+    - extract: write the features for the poems in a dir (-i) and their NAF
+      (-n) to the store
+    - detect: apply the rules to the poems in the store, writing the outputs
+      as detect.py does
+"""
+
+__author__ = 'Pablo Ruiz'
+__date__ = '19/10/26'
+__email__ = 'pabloruizfabo@gmail.com'
+
+
+import argparse
+import hashlib
+import marshal
+import os
+import time
+
+# add current dir
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(here)
+
+# app specific imports
+import config as cfg
+import detect as dt
+import utils as ut
+
+
+# format version for store files
+STORE_VERSION = 1
+
+
+def run_argparse():
+    """
+    Run the argparse-based cli parser for options or defaults
+    """
+    parser = argparse.ArgumentParser(
+        description="Store the inputs to the detection rules, and apply "
+                    "the rules from them",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('store', help='Feature store file')
+    sub = parser.add_subparsers(dest='command')
+    extract = sub.add_parser('extract', help='Extract features into the store')
+    extract.add_argument('-i', '--input', dest='inname', required=True,
+                         help='Input dir (contains PoS and term-id '
+                              'annotations)')
+    extract.add_argument('-n', '--nlpdir', required=True,
+                         help='Dir containing NLP output (NAF from IXA pipes)')
+    extract.add_argument('-c', '--constituency', action='store_true',
+                         help='Also store constituency info (needed to '
+                              'detect with -c)')
+    detect = sub.add_parser('detect', help='Apply the rules to the store')
+    detect.add_argument('-o', '--outdir',
+                        help='Output dir for the results of each poem')
+    detect.add_argument('-f', '--singlefile', required=True,
+                        help='Name for single file that will hold results '
+                             'for complete corpus (tsv and standoff are '
+                             'named after it)')
+    detect.add_argument('-l', '--lang', default='en',
+                        help='Language for enjambment tags (English or '
+                             'Spanish)')
+    detect.add_argument('-c', '--constituency', action='store_true',
+                        help='Use constituency info')
+    detect.add_argument('-d', '--dependency', action='store_true',
+                        help='Use dependency info')
+    detect.add_argument('-u', '--ruleid', action='store_true',
+                        help='Print out rule ids')
+    detect.add_argument('-5', '--m14', action='store_true',
+                        help='Allow rule application above 14 lines')
+    detect.add_argument('-x', '--vectorized', action='store_true',
+                        help='Apply rules not needing syntax to batches of '
+                             'poems at once (requires NumPy)')
+    detect.set_defaults(constituency=cfg.USE_CONSTITUENCY,
+                        dependency=cfg.USE_DEP, ruleid=cfg.PRINT_RULEIDS,
+                        m14=cfg.MORE14)
+    return parser.parse_args()
+
+
+def content_key(*paths):
+    """Hash of the content of the files in paths (decompressed)"""
+    sha = hashlib.sha1()
+    for path in paths:
+        with ut.open_file(path, "r", None) as fd:
+            sha.update(fd.read())
+        sha.update("\0")
+    return sha.hexdigest()
+
+
+def new_store(useconst=False):
+    """
+    Empty store
+    @return: dict with 'version', 'useconst' (whether constituents were
+    extracted), 'poems' (list of (poem filename, key) in corpus order) and
+    'records' (dict with tokens and features for each key, see L{add_poem})
+    """
+    return {"version": STORE_VERSION, "useconst": useconst, "poems": [],
+            "records": {}}
+
+
+def read_store(path):
+    """The store in file path, or an empty one if missing or outdated"""
+    try:
+        with open(path, "rb") as fd:
+            store = marshal.load(fd)
+    except (IOError, EOFError, ValueError, TypeError):
+        return new_store()
+    if store.get("version") != STORE_VERSION:
+        return new_store()
+    return store
+
+
+def write_store(path, store):
+    """Write store to path (see L{utils.atomic_write})"""
+    ut.atomic_write(path, marshal.dumps(store))
+
+
+def add_poem(store, fn, key, toks, tree):
+    """
+    Add a poem to the store
+    @param fn: file name for the poem (in the pos dir)
+    @param key: content key for the poem (see L{content_key})
+    @param toks: the poem, a L{utils.TaggedPoem}
+    @param tree: its NAF tree
+    """
+    record = dt.naf_features(toks, tree, store["useconst"])
+    record["tokens"] = toks.to_tuple()
+    store["records"][key] = record
+    store["poems"].append((fn, key))
+
+
+def extract(idn, nafdir, path, useconst=False):
+    """
+    Extract the features for the poems in idn (skipping files starting with
+    '__', like L{detect.run_dir}) into the store at path. Poems whose
+    content key is already in the store are not parsed again
+    @param idn: dir with poems annotated w pos and term-id (or an archive)
+    @param nafdir: dir with the NAF for each poem (or an archive)
+    @param useconst: also extract constituency info
+    @return: number of poems, and of poems parsed
+    """
+    old = read_store(path)
+    if useconst and not old["useconst"]:
+        old = new_store()
+    store = new_store(useconst)
+    parsed = 0
+    for fn in sorted(ut.list_dir(idn)):
+        if fn.startswith("__"):
+            continue
+        fn = ut.strip_compression_ext(fn)
+        ffn = ut.find_file(os.path.join(idn, fn))
+        naffn = ut.find_naf(os.path.join(
+            nafdir, fn.replace(cfg.possfx, cfg.nlpsfx)))
+        key = content_key(ffn, naffn)
+        if key in old["records"]:
+            store["records"][key] = old["records"][key]
+            store["poems"].append((fn, key))
+            continue
+        add_poem(store, fn, key, ut.read_pos_tagged_poem(ffn),
+                 ut.read_naf(naffn))
+        parsed += 1
+    ut.close_archives()
+    write_store(path, store)
+    return len(store["poems"]), parsed
+
+
+def read_poems(store):
+    """
+    Poems in the store as input for L{detect.detect_many}
+    @return: generator of (filename, tokens, features)
+    """
+    for fn, key in store["poems"]:
+        record = store["records"][key]
+        yield fn, ut.TaggedPoem.from_tuple(record["tokens"]), record
+
+
+def detect(store, single_f, odn=None, lang="en",
+           useconst=cfg.USE_CONSTITUENCY, usedep=cfg.USE_DEP,
+           m14=cfg.MORE14, rids=False, vectorized=False):
+    """
+    Apply the rules to the poems in store, writing the outputs as
+    L{detect.run_dir}
+    @param single_f: path for the single results file (see
+    L{detect.corpus_output_paths} for the others)
+    @param odn: output dir for the results file of each poem (or a zip
+    archive, see L{utils.make_output_dir}), None to skip them
+    """
+    if useconst and not store["useconst"]:
+        raise ValueError("Store has no constituency info, extract it with -c")
+    if odn is not None:
+        ut.make_output_dir(odn)
+    outs = dt.open_corpus_outputs(single_f, rids=rids)
+    try:
+        for result in dt.detect_many(read_poems(store), lang=lang,
+                                     useconst=useconst, usedep=usedep,
+                                     m14=m14, vectorized=vectorized):
+            if odn is not None:
+                ofn = os.path.join(
+                    odn, result["id"].replace("_annot.txt", "_results.txt") +
+                    ut.compression_ext(single_f))
+            else:
+                ofn = None
+            dt.write_poem_outputs(outs, result, ofn, rids=rids)
+    finally:
+        dt.close_corpus_outputs(outs)
+        ut.close_archives()
+
+
+def main():
+    argus = run_argparse()
+    start = time.time()
+    if argus.command == "extract":
+        npoems, parsed = extract(argus.inname, argus.nlpdir, argus.store,
+                                 useconst=argus.constituency)
+        print u"- Stored {} poems ({} parsed) to [{}] in {:.1f} s".format(
+            npoems, parsed, argus.store, time.time() - start)
+        return
+    store = read_store(argus.store)
+    detect(store, argus.singlefile, argus.outdir, argus.lang,
+           argus.constituency, argus.dependency, argus.m14, argus.ruleid,
+           argus.vectorized)
+    print u"- Detected on {} poems from [{}] in {:.1f} s".format(
+        len(store["poems"]), argus.store, time.time() - start)
+
+
+if __name__ == "__main__":
+    main()
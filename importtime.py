@@ -0,0 +1,65 @@
+"""
+Time the imports of a tool (option --import-time of detect.py and
+extract_pos.py), like Python 3's -X importtime. Installed before the tool's
+own imports, and reported on stderr at exit, so that imports done only when
+needed (e.g. KafNafParserPy at the first NAF file) are also included.
+For each module loaded: time including the modules it imports (cumulative)
+and excluding them (self), indented by import depth.
+"""
+
+__author__ = 'Pablo Ruiz'
+__date__ = '19/10/26'
+__email__ = 'pabloruizfabo@gmail.com'
+
+
+import __builtin__
+import atexit
+import sys
+import time
+
+
+START = time.time()
+# (depth, module name, cumulative secs, self secs), in completion order
+TIMES = []
+# time spent in imports nested in the ones in progress, one entry per level
+NESTED = [0.0]
+
+
+def timed_import(name, globs=None, locs=None, fromlist=None, level=-1):
+    """__import__ recording the time taken by imports that load modules"""
+    # in Python 2, 'import sys' in a package also adds 'package.sys' (None)
+    # to sys.modules: skip names already loaded
+    nmods = len(sys.modules) if name not in sys.modules else None
+    NESTED.append(0.0)
+    start = time.time()
+    try:
+        return ORIGINAL_IMPORT(name, globs, locs, fromlist, level)
+    finally:
+        elapsed = time.time() - start
+        nested = NESTED.pop()
+        # only imports that loaded modules, not lookups in sys.modules
+        if nmods is not None and len(sys.modules) > nmods:
+            TIMES.append((len(NESTED) - 1, name, elapsed, elapsed - nested))
+            NESTED[-1] += elapsed
+
+
+ORIGINAL_IMPORT = __builtin__.__import__
+
+
+def install():
+    """Start timing imports, report at exit"""
+    if __builtin__.__import__ is not timed_import:
+        __builtin__.__import__ = timed_import
+        atexit.register(report)
+
+
+def report(out=None):
+    """Write the import times (ms) and their total to out (stderr)"""
+    out = out or sys.stderr
+    out.write("import time: cumulative ms | self ms | module\n")
+    for depth, name, cumul, own in TIMES:
+        out.write("import time: {:>10.2f} | {:>7.2f} | {}{}\n".format(
+            1000 * cumul, 1000 * own, "  " * depth, name))
+    total = sum(cumul for depth, name, cumul, own in TIMES if depth == 0)
+    out.write("import time: {:.2f} ms in imports, {:.2f} ms run "
+              "time\n".format(1000 * total, 1000 * (time.time() - START)))
@@ -0,0 +1,264 @@
+"""
+Progress and throughput metrics for a stage (option --metrics of prepro.py,
+extract_pos.py, detect.py and run_anja.py), written to a dir (the batch log
+dir by default):
+    - one JSON object per line for each poem done, appended to
+      L{config.metrics_events}: time, batch, stage, poem, secs (since the
+      previous poem was done, or since the stage started), in_bytes,
+      out_bytes (sizes of the poem's input and output files; null if
+      unknown, e.g. for archive members) and error (null if none)
+    - a Prometheus textfile (L{config.metrics_prom}, for node_exporter's
+      textfile collector) per stage, rewritten every
+      L{config.METRICS_INTERVAL} secs and at exit: poems done, errors,
+      bytes, poems/s, a histogram of the secs per poem, poems still queued
+      and the estimated secs left
+run_anja.py passes the option to the Python steps; for the NLP step, which
+is a shell script, it counts the NAF files written (see L{run_watched}).
+"""
+
+__author__ = 'Pablo Ruiz'
+__date__ = '19/10/26'
+__email__ = 'pabloruizfabo@gmail.com'
+
+
+import atexit
+import json
+import os
+import sys
+import time
+
+import config as cfg
+
+
+# settings and running totals, set by install
+STATE = {}
+
+PROM_METRICS = (
+    ("anja_poems_done_total", "counter", "Poems done by the stage"),
+    ("anja_poem_errors_total", "counter", "Poems with errors"),
+    ("anja_poem_bytes_in_total", "counter", "Bytes read for the poems done"),
+    ("anja_poem_bytes_out_total", "counter",
+     "Bytes written for the poems done"),
+    ("anja_poems_per_second", "gauge", "Poems done per second since start"),
+    ("anja_poems_queued", "gauge", "Poems not done yet"),
+    ("anja_eta_seconds", "gauge",
+     "Estimated seconds left for the stage, at the current rate"),
+    ("anja_stage_running", "gauge", "1 while the stage runs, 0 when over"),
+    ("anja_stage_start_time_seconds", "gauge",
+     "Unix time the stage started"),
+    ("anja_last_update_time_seconds", "gauge",
+     "Unix time the file was written"))
+
+
+def install(outdir, stage, batch, total=None):
+    """
+    Start recording a stage, write its final metrics at exit
+    @param outdir: dir for the outputs (the batch log dir), created if needed
+    @param stage: stage name, used as label and for the textfile name
+    @param total: number of poems the stage will do, if known (see
+    L{set_total})
+    """
+    if STATE:
+        return
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    now = time.time()
+    STATE.update({
+        "stage": stage, "batch": batch, "total": total, "start": now,
+        "last": now, "written": now, "done": 0, "errors": 0,
+        "in_bytes": 0, "out_bytes": 0,
+        "buckets": [0] * len(cfg.METRICS_BUCKETS), "secs": 0.0,
+        "events": open(os.path.join(outdir, cfg.metrics_events.format(
+            batch=batch)), "a"),
+        "prom": os.path.join(outdir, cfg.metrics_prom.format(
+            batch=batch, stage=stage))})
+    STATE["excepthook"], sys.excepthook = sys.excepthook, failed
+    write_prom()
+    atexit.register(finish)
+
+
+def set_total(total):
+    """Set the number of poems the stage will do (for queue and ETA)"""
+    if STATE:
+        STATE["total"] = total
+        write_prom()
+
+
+def file_size(path):
+    """
+    Size of path, or of a compressed version of it (or of a NAF file with
+    the alternative extension, see L{utils.find_naf}); None if not found
+    """
+    import utils as ut
+    for find in (ut.find_file, ut.find_naf):
+        try:
+            return os.path.getsize(find(path))
+        except (OSError, UnicodeError):
+            continue
+    return None
+
+
+def paths_size(paths):
+    """Sum of the sizes of paths (see L{file_size}), None if any is unknown"""
+    sizes = [file_size(path) for path in paths]
+    if not sizes or None in sizes:
+        return None
+    return sum(sizes)
+
+
+def write_event(poem, secs, in_bytes, out_bytes, error):
+    """Append an event to the events file"""
+    if isinstance(poem, str):
+        poem = poem.decode("utf8", "replace")
+    STATE["events"].write(json.dumps(
+        {"time": round(time.time(), 3), "batch": STATE["batch"],
+         "stage": STATE["stage"], "poem": poem,
+         "secs": None if secs is None else round(secs, 6),
+         "in_bytes": in_bytes, "out_bytes": out_bytes, "error": error},
+        sort_keys=True) + "\n")
+    STATE["events"].flush()
+
+
+def poem_done(poem, inpaths=(), outpaths=(), error=None, secs=None,
+              out_bytes=None):
+    """
+    Record a poem done by the stage, if recording
+    @param inpaths: paths to the poem's input files (for in_bytes)
+    @param outpaths: paths to its output files (for out_bytes, unless
+    given)
+    @param error: error message, if the poem failed
+    @param secs: time taken (default: since the previous poem was done)
+    """
+    if not STATE:
+        return
+    now = time.time()
+    if secs is None:
+        secs = now - STATE["last"]
+    STATE["last"] = now
+    in_bytes = paths_size(inpaths)
+    if out_bytes is None:
+        out_bytes = paths_size(outpaths)
+    write_event(poem, secs, in_bytes, out_bytes, error)
+    STATE["done"] += 1
+    STATE["errors"] += error is not None
+    STATE["in_bytes"] += in_bytes or 0
+    STATE["out_bytes"] += out_bytes or 0
+    STATE["secs"] += secs
+    for idx, bound in enumerate(cfg.METRICS_BUCKETS):
+        if secs <= bound:
+            STATE["buckets"][idx] += 1
+            break
+    if now - STATE["written"] >= cfg.METRICS_INTERVAL:
+        write_prom()
+
+
+def prom_value(value):
+    """Number in Prometheus text format"""
+    if value is None:
+        return "NaN"
+    if isinstance(value, (int, long)):
+        return str(value)
+    return repr(float(value))
+
+
+def write_prom(running=True):
+    """
+    Write the textfile (see L{utils.atomic_write}, so that the collector
+    never reads half a file)
+    """
+    import utils as ut
+    now = time.time()
+    STATE["written"] = now
+    elapsed = now - STATE["start"]
+    rate = STATE["done"] / elapsed if elapsed > 0 else None
+    queued = eta = None
+    if STATE["total"] is not None:
+        queued = max(STATE["total"] - STATE["done"], 0)
+        if rate:
+            eta = queued / rate
+        elif not queued:
+            eta = 0
+    labels = u'batch="{}",stage="{}"'.format(
+        STATE["batch"].replace("\\", "\\\\").replace('"', '\\"'),
+        STATE["stage"])
+    values = dict(zip([name for name, typ, hlp in PROM_METRICS], (
+        STATE["done"], STATE["errors"], STATE["in_bytes"],
+        STATE["out_bytes"], rate, queued, eta, int(running), STATE["start"],
+        now)))
+    ols = []
+    for name, typ, hlp in PROM_METRICS:
+        ols.append(u"# HELP {} {}".format(name, hlp))
+        ols.append(u"# TYPE {} {}".format(name, typ))
+        ols.append(u"{}{{{}}} {}".format(name, labels, prom_value(
+            values[name])))
+    name = "anja_poem_duration_seconds"
+    ols.append(u"# HELP {} Seconds per poem".format(name))
+    ols.append(u"# TYPE {} histogram".format(name))
+    cumul = 0
+    for bound, count in zip(cfg.METRICS_BUCKETS, STATE["buckets"]):
+        cumul += count
+        ols.append(u'{}_bucket{{{},le="{}"}} {}'.format(name, labels, bound,
+                                                       cumul))
+    ols.append(u'{}_bucket{{{},le="+Inf"}} {}'.format(name, labels,
+                                                     STATE["done"]))
+    ols.append(u"{}_sum{{{}}} {}".format(name, labels,
+                                         prom_value(STATE["secs"])))
+    ols.append(u"{}_count{{{}}} {}".format(name, labels, STATE["done"]))
+    ut.atomic_write(STATE["prom"], u"\n".join(ols).encode("utf8") + "\n")
+
+
+def failed(typ, value, tb):
+    """sys.excepthook: record the error that stopped the stage"""
+    if STATE:
+        write_event(None, None, None, None, u"{}: {}".format(
+            typ.__name__, value))
+        STATE["errors"] += 1
+    STATE["excepthook"](typ, value, tb)
+
+
+def finish():
+    """Write the final textfile and close the events file"""
+    if not STATE:
+        return
+    write_prom(running=False)
+    STATE["events"].close()
+    sys.excepthook = STATE["excepthook"]
+    STATE.clear()
+
+
+def run_watched(cmd, outdir, stage, batch, total, count_done):
+    """
+    Run a shell command for a stage, recording its progress while it runs
+    from the number of output files, read every L{config.METRICS_INTERVAL}
+    secs. Each output file found is recorded as a poem done, with the time
+    since the previous check split evenly among the new files
+    @param outdir: dir for the outputs, see L{install}
+    @param total: number of poems to do
+    @param count_done: function returning the list of paths to the output
+    files written so far
+    @return: the command's exit status
+    """
+    import subprocess
+    install(outdir, stage, batch, total)
+    proc = subprocess.Popen(cmd, shell=True)
+    seen = set(count_done())
+    try:
+        while True:
+            status = proc.poll()
+            new = [path for path in count_done() if path not in seen]
+            if new:
+                secs = (time.time() - STATE["last"]) / len(new)
+                for path in sorted(new):
+                    seen.add(path)
+                    poem_done(os.path.basename(path), secs=secs,
+                              out_bytes=file_size(path))
+            write_prom()
+            if status is not None:
+                return status
+            # the output dir is listed every interval, but the command's
+            # end is noticed sooner
+            deadline = time.time() + cfg.METRICS_INTERVAL
+            while proc.poll() is None and time.time() < deadline:
+                time.sleep(0.2)
+    finally:
+        finish()
@@ -0,0 +1,229 @@
+# coding: utf-8
+
+"""
+Parse a long poem in chunks: the poem on a single line (as output by
+prepro/prepro.py) is split at stanza breaks or sentence ends into chunks of
+at most L{config.NLP_CHUNK_CHARS} characters (see L{split_text}), the
+chunks are parsed concurrently with the NLP command, and their NAF is
+stitched back into a single document for the poem (see L{stitch}): word,
+term, constituent, SRL etc. ids are renumbered so that they are unique,
+and references to them (spans, dependencies, tree edges) follow; word
+offsets are moved to the position of the chunk in the poem, so that the
+line positions from prepro still apply; sentence numbers go on from the
+previous chunk. Paragraph numbers are kept as the parser gives them (the
+poem is a single line, so its NAF is a single paragraph).
+Used by run_nlp.sh for poems longer than NLP_CHUNK_CHARS, if set. Poems
+that fit in a single chunk are parsed as usual.
+"""
+
+__author__ = 'Pablo Ruiz'
+__date__ = '19/10/26'
+__email__ = 'pabloruizfabo@gmail.com'
+
+
+import argparse
+import codecs
+import re
+from multiprocessing.pool import ThreadPool
+
+# add current dir
+import os
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(here)
+
+# app specific imports
+import config as cfg
+import utils as ut
+
+
+# prepro joins lines with a space, so an empty line leaves two or more
+STANZA_BREAK = re.compile(ur"\s{2,}", re.UNICODE)
+SENTENCE_END = re.compile(ur"(?:[.!?;:]|\.\.\.|…)[\"'»”’)\]]*\s+", re.UNICODE)
+SPACE = re.compile(ur"\s+", re.UNICODE)
+# ids like w12, t3, nter40, tre7, pr2, rl5: a prefix and a number
+NAF_ID = re.compile(r"^([A-Za-z_]+)(\d+)$")
+# attributes referring to an element by id
+ID_ATTRS = ("id", "from", "to", "head")
+
+
+def run_argparse():
+    """
+    Run the argparse-based cli parser for options or defaults
+    """
+    parser = argparse.ArgumentParser(
+        description="Parse a long one-line poem in chunks and stitch their "
+                    "NAF",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-i', '--infile',
+                        help='One-line poem (default: stdin)')
+    parser.add_argument('-o', '--outfile', help='NAF output (default: stdout)')
+    parser.add_argument('-m', '--nlpcmd',
+                        help='Shell command reading a one-line text on stdin '
+                             'and writing NAF to stdout (default: the IXA '
+                             'clients, from run_nlp.sh --print-cmd def '
+                             'only_deps)')
+    parser.add_argument('-c', '--chars', type=int, default=cfg.NLP_CHUNK_CHARS,
+                        help='Max characters per chunk')
+    parser.add_argument('-w', '--workers', type=int,
+                        default=cfg.NLP_CHUNK_WORKERS,
+                        help='Chunks parsed at once')
+    return parser.parse_args()
+
+
+def last_boundary(regex, text, start, end):
+    """
+    Offset right after the last match of regex in text[start:end], None if
+    no match
+    """
+    found = None
+    for match in regex.finditer(text, start, end):
+        if match.end() < end:
+            found = match.end()
+    return found
+
+
+def split_text(text, max_chars=cfg.NLP_CHUNK_CHARS):
+    """
+    Split text into chunks of at most max_chars, ending at a stanza break if
+    there is one in the second half of the chunk, else at a sentence end,
+    else at any stanza break, else at a space (a word longer than max_chars
+    is cut)
+    @return: list of (offset of the chunk in text, chunk)
+    """
+    chunks = []
+    start = 0
+    while len(text) - start > max_chars:
+        end = start + max_chars
+        cut = last_boundary(STANZA_BREAK, text, start + max_chars // 2, end)
+        for regex in (SENTENCE_END, STANZA_BREAK, SPACE):
+            if cut is not None:
+                break
+            cut = last_boundary(regex, text, start, end)
+        if cut is None or cut <= start:
+            cut = end
+        chunks.append((start, text[start:cut]))
+        start = cut
+    if start < len(text):
+        chunks.append((start, text[start:]))
+    return chunks
+
+
+def id_numbers(root):
+    """Highest number for each id prefix in the elements under root"""
+    from lxml import etree
+    highest = {}
+    for elem in root.iter(tag=etree.Element):
+        match = NAF_ID.match(elem.get("id") or "")
+        if match is not None:
+            prefix, nbr = match.group(1), int(match.group(2))
+            highest[prefix] = max(highest.get(prefix, 0), nbr)
+    return highest
+
+
+def renumber(root, shifts, offset, sent_shift):
+    """
+    Renumber the ids in a chunk's NAF root, and the references to them, by
+    adding the shift for their prefix; move word offsets by offset and
+    sentence numbers by sent_shift
+    """
+    from lxml import etree
+    for elem in root.iter(tag=etree.Element):
+        for attr in ID_ATTRS:
+            val = elem.get(attr)
+            if val is None:
+                continue
+            match = NAF_ID.match(val)
+            if match is not None and match.group(1) in shifts:
+                elem.set(attr, u"{}{}".format(match.group(1), int(
+                    match.group(2)) + shifts[match.group(1)]))
+        if elem.tag == "wf":
+            if elem.get("offset") is not None:
+                elem.set("offset", str(int(elem.get("offset")) + offset))
+            if elem.get("sent") is not None:
+                elem.set("sent", str(int(elem.get("sent")) + sent_shift))
+
+
+def stitch(nafs, text):
+    """
+    Stitch the NAF for the chunks of a text into the NAF for the text
+    @param nafs: list of (offset of the chunk in text, NAF for the chunk as
+    a utf8 string), in text order
+    @param text: the complete text
+    @return: NAF as a utf8 string
+    """
+    from lxml import etree
+    parser = etree.XMLParser(remove_blank_text=True)
+    doc = None
+    shifts = {}
+    sent_shift = 0
+    for offset, naf in nafs:
+        root = etree.fromstring(naf, parser)
+        highest = id_numbers(root)
+        renumber(root, shifts, offset, sent_shift)
+        for prefix, nbr in highest.items():
+            shifts[prefix] = shifts.get(prefix, 0) + nbr
+        sent_shift = max([sent_shift] + [int(wf.get("sent"))
+                                         for wf in root.iter("wf")
+                                         if wf.get("sent") is not None])
+        if doc is None:
+            doc = root
+            continue
+        # layers are appended to the same layer in the document (the header
+        # of the first chunk is kept)
+        for layer in root:
+            if not isinstance(layer.tag, basestring) or \
+                    layer.tag in ("nafHeader", "raw"):
+                continue
+            target = doc.find(layer.tag)
+            if target is None:
+                doc.append(layer)
+            else:
+                target.extend(list(layer))
+    raw = doc.find("raw")
+    if raw is not None:
+        raw.text = etree.CDATA(text)
+    return etree.tostring(doc, xml_declaration=True, encoding="UTF-8",
+                          pretty_print=True)
+
+
+def parse(text, nlpcmd=None, max_chars=cfg.NLP_CHUNK_CHARS,
+          workers=cfg.NLP_CHUNK_WORKERS):
+    """
+    Parse text with nlpcmd (see L{utils.run_nlp}; L{utils.nlp_command} if
+    None), in chunks if longer than max_chars
+    @param workers: chunks parsed at once
+    @return: NAF as a utf8 string
+    """
+    nlpcmd = nlpcmd or ut.nlp_command()
+    chunks = split_text(text, max_chars)
+    if len(chunks) == 1:
+        return ut.run_nlp(text, nlpcmd)
+    pool = ThreadPool(max(min(workers, len(chunks)), 1))
+    try:
+        nafs = pool.map(lambda chunk: ut.run_nlp(chunk, nlpcmd),
+                        [chunk for offset, chunk in chunks])
+    finally:
+        pool.close()
+        pool.join()
+    return stitch(zip([offset for offset, chunk in chunks], nafs), text)
+
+
+def main():
+    argus = run_argparse()
+    if argus.infile is None:
+        text = sys.stdin.read().decode("utf8")
+    else:
+        with codecs.open(argus.infile, "r", "utf8") as fd:
+            text = fd.read()
+    naf = parse(text, argus.nlpcmd, argus.chars, argus.workers)
+    if argus.outfile is None:
+        sys.stdout.write(naf)
+    else:
+        with open(argus.outfile, "wb") as fd:
+            fd.write(naf)
+
+
+if __name__ == "__main__":
+    main()
@@ -13,18 +13,18 @@ import re
 
 
 # add current dir and parent to sys.path
-import inspect
 import os
 import sys
 
-here = os.path.dirname(os.path.abspath(
-    inspect.getfile(inspect.currentframe())))
+here = os.path.dirname(os.path.abspath(__file__))
 appbasedir = os.path.join(here, os.pardir)
 sys.path.append(appbasedir)
 
 # app specific imports
 import utils as ut
 import config as cfg
+import metrics as mt
+import profiling as pf
 
 
 def BatchnamePattern(stg):
@@ -78,6 +78,12 @@ def run_argparse():
                         default=os.path.join(
                             os.path.join(cfg.baseoutdir, partargs.batchname),
                             cfg.oneline.format(batch=partargs.batchname)))
+    parser.add_argument('--profile', nargs='?', metavar='DIR', const='',
+                        help='Profile the run, writing the reports to DIR '
+                             '(see profiling.py; default: the log dir)')
+    parser.add_argument('--metrics', nargs='?', metavar='DIR', const='',
+                        help='Write per-poem events and a Prometheus textfile '
+                             'to DIR (see metrics.py; default: the log dir)')
     return parser.parse_args()
 
 
@@ -88,12 +94,17 @@ def main():
         print "Enter a valid batch name (using the default " + \
               "'xix-DUMMY' is not allowed)"
         sys.exit(2)
+    if argus.profile is not None:
+        pf.install(argus.profile or argus.logs, "prepro", argus.batchname)
+    if argus.metrics is not None:
+        mt.install(argus.metrics or argus.logs, "prepro", argus.batchname)
     from pprint import pprint
     pprint(argus)
     for dname in [argus.oneline, argus.logs]:
         if not os.path.exists(dname):
             os.makedirs(dname)
     ti2te = ut.read_dir_into_ttl2txt_dict(argus.inname)
+    mt.set_total(len(ti2te))
     ut.merge_lines_and_get_line_positions(ti2te, argus.oneline, argus.logs,
                                           argus.batchname)
 
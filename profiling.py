@@ -0,0 +1,173 @@
+"""
+Profile a tool (option --profile of prepro.py, extract_pos.py, detect.py and
+run_anja.py). Installed at the start of the tool's main function and
+reported at exit, to files in the batch log dir named after
+L{config.profile_prefix}:
+    - .pstats: cProfile stats, for pstats, snakeviz etc.
+    - .collapsed: stacks sampled every L{config.PROFILE_INTERVAL} secs of
+      CPU time, one line per stack with its count, as read by flamegraph.pl
+      or speedscope
+    - _poems.tsv: time and change in resident memory for each poem (or
+      stage for run_anja.py), in processing order
+    - _report.txt: slowest poems, poems adding most resident memory,
+      functions with most cumulative time, and live objects by type
+Python 2 has no tracemalloc: memory is reported as the process' resident
+size after each poem, and as counts of the objects tracked by the garbage
+collector (containers and instances, not strings or numbers) per type, at
+the start and at exit.
+"""
+
+__author__ = 'Pablo Ruiz'
+__date__ = '19/10/26'
+__email__ = 'pabloruizfabo@gmail.com'
+
+
+import atexit
+import codecs
+import gc
+import os
+import resource
+import signal
+import sys
+import time
+
+import config as cfg
+
+
+# settings and running totals, set by install
+STATE = {}
+# (poem, secs, resident KB change), in processing order
+TIMES = []
+# sampled stacks ("file:function" from the outermost frame, joined by ";")
+STACKS = {}
+# labels for code objects, for the sampler
+LABELS = {}
+
+
+def rss_kb():
+    """Resident size of the process in KB (peak size if no /proc)"""
+    try:
+        with open("/proc/self/statm") as fd:
+            pages = int(fd.read().split()[1])
+        return pages * resource.getpagesize() // 1024
+    except (IOError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def object_counts():
+    """Number of objects tracked by the garbage collector, by type"""
+    counts = {}
+    for obj in gc.get_objects():
+        typ = type(obj)
+        counts[typ] = counts.get(typ, 0) + 1
+    return dict((u"{}.{}".format(typ.__module__, typ.__name__), count)
+                for typ, count in counts.items())
+
+
+def sample(signum, frame):
+    """SIGPROF handler: count the stack being run"""
+    labels = []
+    while frame is not None:
+        code = frame.f_code
+        label = LABELS.get(code)
+        if label is None:
+            label = LABELS[code] = "{}:{}".format(
+                os.path.basename(code.co_filename), code.co_name)
+        labels.append(label)
+        frame = frame.f_back
+    stack = ";".join(reversed(labels))
+    STACKS[stack] = STACKS.get(stack, 0) + 1
+
+
+def install(logdir, tool, batch, top=cfg.PROFILE_TOP,
+            interval=cfg.PROFILE_INTERVAL):
+    """
+    Start profiling, report at exit
+    @param logdir: dir for the outputs (the batch log dir), created if needed
+    @param tool: tool name, for the output names (see
+    L{config.profile_prefix})
+    @param top: rows in each ranking of the report
+    @param interval: CPU secs between stack samples
+    """
+    import cProfile
+    if STATE:
+        return
+    if not os.path.exists(logdir):
+        os.makedirs(logdir)
+    STATE.update({
+        "prefix": os.path.join(logdir, cfg.profile_prefix.format(
+            batch=batch, tool=tool)),
+        "top": top, "objects": object_counts(), "start": time.time(),
+        "start_rss": rss_kb()})
+    STATE["last"], STATE["last_rss"] = STATE["start"], STATE["start_rss"]
+    signal.signal(signal.SIGPROF, sample)
+    # restart reads etc. interrupted by the sampler instead of raising EINTR
+    signal.siginterrupt(signal.SIGPROF, False)
+    signal.setitimer(signal.ITIMER_PROF, interval, interval)
+    STATE["profiler"] = cProfile.Profile()
+    STATE["profiler"].enable()
+    atexit.register(report)
+
+
+def poem_done(name):
+    """
+    Record the time and resident memory change since the previous poem
+    was done (or since install), if profiling
+    """
+    if not STATE:
+        return
+    now, rss = time.time(), rss_kb()
+    TIMES.append((name, now - STATE["last"], rss - STATE["last_rss"]))
+    STATE["last"], STATE["last_rss"] = now, rss
+
+
+def name_text(name):
+    """Poem name as unicode"""
+    if isinstance(name, str):
+        return name.decode("utf8", "replace")
+    return name
+
+
+def report():
+    """Stop profiling and write the outputs (see module docstring)"""
+    import pstats
+    if "profiler" not in STATE:
+        return
+    STATE["profiler"].disable()
+    signal.setitimer(signal.ITIMER_PROF, 0, 0)
+    prefix, top = STATE["prefix"], STATE["top"]
+    end, end_rss = time.time(), rss_kb()
+    STATE["profiler"].dump_stats(prefix + ".pstats")
+    with open(prefix + ".collapsed", "w") as fd:
+        for stack, count in sorted(STACKS.items()):
+            fd.write("{} {}\n".format(stack, count))
+    with codecs.open(prefix + "_poems.tsv", "w", "utf8") as fd:
+        fd.write(u"poem\tsecs\trss_kb_diff\n")
+        for name, secs, kbs in TIMES:
+            fd.write(u"{}\t{:.6f}\t{}\n".format(name_text(name), secs, kbs))
+    objects = object_counts()
+    growth = sorted(((count - STATE["objects"].get(typ, 0), count, typ)
+                     for typ, count in objects.items()), reverse=True)
+    ols = [u"{} poems in {:.2f} s; resident KB: {} at start, {} at exit, "
+           u"{} peak".format(len(TIMES), end - STATE["start"],
+                             STATE["start_rss"], end_rss,
+                             resource.getrusage(
+                                 resource.RUSAGE_SELF).ru_maxrss)]
+    ols.append(u"\n# Slowest {} poems (secs)".format(top))
+    ols.extend(u"{:.4f}\t{}".format(secs, name_text(name)) for name, secs, kbs
+               in sorted(TIMES, key=lambda rec: -rec[1])[:top])
+    ols.append(u"\n# {} poems adding most resident memory (KB)".format(top))
+    ols.extend(u"{}\t{}".format(kbs, name_text(name)) for name, secs, kbs
+               in sorted(TIMES, key=lambda rec: -rec[2])[:top])
+    ols.append(u"\n# Objects tracked by gc: top {} types by increase "
+               u"(increase, count at exit, type)".format(top))
+    ols.extend(u"{:+d}\t{}\t{}".format(diff, count, typ)
+               for diff, count, typ in growth[:top])
+    ols.append(u"\n# Top {} functions by cumulative time".format(top))
+    with open(prefix + "_report.txt", "w") as fd:
+        fd.write(u"\n".join(ols).encode("utf8") + "\n")
+        stats = pstats.Stats(prefix + ".pstats", stream=fd)
+        stats.sort_stats("cumulative").print_stats(top)
+    STATE.clear()
+    sys.stderr.write("profile: wrote [{}] .pstats, .collapsed, _poems.tsv "
+                     "and _report.txt\n".format(prefix.encode("utf8")))
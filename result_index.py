@@ -0,0 +1,269 @@
+# coding: utf-8
+
+"""
+Byte-offset indexes for the corpus-level result files written by detect.py
+(single file txt and tsv, standoff with and without rule ids), to read the
+rows for some poems without scanning the whole file.
+The index for a file is a sidecar next to it (same path plus L{INDEX_SUFFIX}),
+mapping each poem to the byte range(s) of its rows. detect.py writes it with
+the (uncompressed) results; for other files it is built at the first use, and
+rebuilt if the file changed since. Files are memory-mapped for reading
+(L{ResultFile}).
+Usage:
+    - build: write the index for result files
+    - get: rows for poems (-p, or a list of poems in a file, -l), after the
+      header if the file has one
+Poems are named as in the standoff (no _annot or .txt suffix), but those
+suffixes are also accepted.
+"""
+
+__author__ = 'Pablo Ruiz'
+__date__ = '19/10/26'
+__email__ = 'pabloruizfabo@gmail.com'
+
+
+import argparse
+import codecs
+import marshal
+import mmap
+import os
+import re
+import time
+
+# add current dir
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(here)
+
+# app specific imports
+import utils as ut
+
+
+INDEX_SUFFIX = ".idx"
+# format version for the index files
+INDEX_VERSION = 1
+# first column in the header of the txt and tsv result files
+HEADER_START = "title\t"
+
+
+def run_argparse():
+    """
+    Run the argparse-based cli parser for options or defaults
+    """
+    parser = argparse.ArgumentParser(
+        description="Index corpus result files by poem, and read poems "
+                    "from them",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    sub = parser.add_subparsers(dest='command')
+    build = sub.add_parser('build', help='Write the index for result files')
+    build.add_argument('files', nargs='+', help='Result files')
+    get = sub.add_parser('get', help='Rows for poems')
+    get.add_argument('file', help='Result file')
+    get.add_argument('-p', '--poems', nargs='+', default=[],
+                     help='Poems')
+    get.add_argument('-l', '--list', dest='listfile',
+                     help='File with a poem per line')
+    get.add_argument('-o', '--outfile', help='Output file (else stdout)')
+    return parser.parse_args()
+
+
+def poem_key(name):
+    """Poem id used in the index: file name without _annot and .txt"""
+    if isinstance(name, str):
+        name = name.decode("utf8")
+    return re.sub(ur"(?:_annot)?(?:\.txt)?$", u"", name)
+
+
+def index_path(path):
+    """Path for the index of result file path"""
+    return path + INDEX_SUFFIX
+
+
+def index_stamp(path):
+    """Stamp to tell if an index is up to date with its result file"""
+    stat = os.stat(path)
+    return INDEX_VERSION, marshal.version, stat.st_size, stat.st_mtime
+
+
+def add_range(poems, key, start, end):
+    """Add byte range start-end to poem key, merged with the last if contiguous"""
+    ranges = poems.setdefault(key, [])
+    if ranges and ranges[-1][1] == start:
+        ranges[-1] = (ranges[-1][0], end)
+    else:
+        ranges.append((start, end))
+
+
+def row_complete(row, ncols):
+    """
+    Whether a tsv row (see L{detect.corpus_rows}) is complete: the type and
+    rule-id fields are quoted and can span several lines
+    """
+    fields = row.rstrip("\n").split("\t")
+    if len(fields) < ncols:
+        return False
+    return not fields[-1].startswith('"') or (
+        len(fields[-1]) > 1 and fields[-1].endswith('"'))
+
+
+def scan_index(path):
+    """
+    Index a result file by reading it
+    @return: (start, end) of the header (None if no header), and dict with a
+    list of (start, end) byte ranges for each poem (see L{poem_key})
+    """
+    header = None
+    poems = {}
+    multiline = path.endswith(".tsv")
+    with open(path, "rb") as fd:
+        offset = 0
+        row, row_start = "", None
+        # rows for a poem are consecutive: a range is added when the poem
+        # changes, starting at kstart
+        name, key, kstart = None, None, 0
+        for line in fd:
+            if offset == 0 and line.startswith(HEADER_START):
+                header = (0, len(line))
+                ncols = line.count("\t") + 1
+                offset += len(line)
+                continue
+            offset += len(line)
+            if multiline and header is not None:
+                if row_start is None:
+                    row, row_start = line, offset - len(line)
+                else:
+                    row += line
+                if not row_complete(row, ncols):
+                    continue
+                line, start = row, row_start
+                row_start = None
+            else:
+                start = offset - len(line)
+            if name is None or not line.startswith(name):
+                if name is not None:
+                    add_range(poems, key, kstart, start)
+                name = line.split("\t", 1)[0] + "\t"
+                key, kstart = poem_key(name[:-1]), start
+        if name is not None:
+            add_range(poems, key, kstart, offset)
+    return header, poems
+
+
+def write_index(path, header, poems):
+    """
+    Write the index for result file path (see L{scan_index} for the
+    arguments), see L{utils.atomic_write}
+    """
+    ut.atomic_write(index_path(path), marshal.dumps(
+        (index_stamp(path), header, poems)))
+
+
+def load_index(path):
+    """
+    Load the index for result file path, building it first (L{scan_index})
+    if missing or out of date
+    @return: header range and byte ranges per poem, see L{scan_index}
+    """
+    try:
+        with open(index_path(path), "rb") as fd:
+            stamp, header, poems = marshal.load(fd)
+        if stamp == index_stamp(path):
+            return header, poems
+    except (IOError, EOFError, ValueError, TypeError):
+        pass
+    header, poems = scan_index(path)
+    try:
+        write_index(path, header, poems)
+    except (IOError, OSError):
+        # e.g. read-only dir: use the index without saving it
+        pass
+    return header, poems
+
+
+class ResultFile(object):
+    """
+    Corpus result file, memory-mapped, with the rows for a poem read
+    from their byte ranges in the index (see L{load_index})
+    """
+
+    def __init__(self, path):
+        if ut.compression_ext(path):
+            raise ValueError(u"Can't index a compressed file [{}]".format(
+                path))
+        self.path = path
+        self.header_range, self.poems = load_index(path)
+        self.fd = open(path, "rb")
+        if os.fstat(self.fd.fileno()).st_size:
+            self.data = mmap.mmap(self.fd.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        else:
+            self.data = ""
+
+    def header(self):
+        """Header row (with its line-break), None if the file has none"""
+        if self.header_range is None:
+            return None
+        return self.data[slice(*self.header_range)].decode("utf8")
+
+    def __contains__(self, poem):
+        return poem_key(poem) in self.poems
+
+    def get(self, poem):
+        """
+        Rows for poem, as in the file (each ending in a line-break)
+        @return: unicode, None if the poem is not in the file
+        """
+        ranges = self.poems.get(poem_key(poem))
+        if ranges is None:
+            return None
+        return u"".join(self.data[start:end].decode("utf8")
+                        for start, end in ranges)
+
+    def close(self):
+        if not isinstance(self.data, str):
+            self.data.close()
+        self.fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main():
+    argus = run_argparse()
+    if argus.command == "build":
+        for path in argus.files:
+            start = time.time()
+            header, poems = scan_index(path)
+            write_index(path, header, poems)
+            print u"- Indexed {} poems in [{}] in {:.1f} ms".format(
+                len(poems), path, 1000 * (time.time() - start))
+        return
+    poems = [poem.decode("utf8") for poem in argus.poems]
+    if argus.listfile is not None:
+        poems.extend(ut.file_to_ordered_list(argus.listfile))
+    if argus.outfile is not None:
+        out = codecs.open(argus.outfile, "w", "utf8")
+    else:
+        out = codecs.getwriter("utf8")(sys.stdout)
+    try:
+        with ResultFile(argus.file) as results:
+            if results.header() is not None:
+                out.write(results.header())
+            for poem in poems:
+                rows = results.get(poem)
+                if rows is None:
+                    sys.stderr.write(u"! Poem not in results [{}]\n".format(
+                        poem).encode("utf8"))
+                    continue
+                out.write(rows)
+    finally:
+        if argus.outfile is not None:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,335 @@
+# coding: utf-8
+
+"""
+Store enjambment detection results in a SQLite database, to query a corpus
+by enjambment type, rule-id, author or poem without scanning the flat
+result files. detect.py writes the database with its -q option.
+The database can also regenerate the flat formats written by detect.py
+(per-poem results, corpus txt and tsv, standoff with and without rule ids).
+Usage, with the database as first argument:
+    - lines: corpus result lines having an enjambment of a type (-t) or
+      found by a rule (-r), for an author (-a) or poem (-p)
+    - spans: standoff rows (enjambed line pairs), with the same filters
+    - counts: enjambment counts per type and rule-id
+    - export: write the flat formats
+Filter values containing '%' are applied as SQL LIKE patterns.
+"""
+
+__author__ = 'Pablo Ruiz'
+__date__ = '19/10/26'
+__email__ = 'pabloruizfabo@gmail.com'
+
+
+import argparse
+import codecs
+import json
+import os
+import re
+import sqlite3
+
+# add current dir
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(here)
+
+# app specific imports
+import detect as dt
+import utils as ut
+
+
+SCHEMA = u"""
+CREATE TABLE poems (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL,
+    author TEXT,
+    nlines INTEGER NOT NULL
+);
+CREATE TABLE lines (
+    poem_id INTEGER NOT NULL REFERENCES poems(id),
+    lnbr INTEGER NOT NULL,
+    tokens TEXT NOT NULL,
+    text TEXT NOT NULL,
+    PRIMARY KEY (poem_id, lnbr)
+);
+CREATE TABLE hits (
+    poem_id INTEGER NOT NULL REFERENCES poems(id),
+    lnbr INTEGER NOT NULL,
+    ord INTEGER NOT NULL,
+    position TEXT NOT NULL,
+    type TEXT NOT NULL,
+    rule_id TEXT NOT NULL
+);
+CREATE TABLE spans (
+    poem_id INTEGER NOT NULL REFERENCES poems(id),
+    start INTEGER NOT NULL,
+    end INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    rule_id TEXT NOT NULL
+);
+CREATE INDEX poems_author ON poems(author);
+CREATE INDEX hits_poem ON hits(poem_id, lnbr);
+CREATE INDEX hits_type ON hits(type);
+CREATE INDEX hits_rule ON hits(rule_id);
+CREATE INDEX spans_poem ON spans(poem_id);
+CREATE INDEX spans_type ON spans(type);
+CREATE INDEX spans_rule ON spans(rule_id);
+"""
+
+
+def run_argparse():
+    """
+    Run the argparse-based cli parser for options or defaults
+    """
+    parser = argparse.ArgumentParser(
+        description="Query enjambment results stored in SQLite "
+                    "(see detect.py -q)",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('db', help='Results database')
+    sub = parser.add_subparsers(dest='command')
+    filters = argparse.ArgumentParser(add_help=False)
+    filters.add_argument('-t', '--type', help='Enjambment type')
+    filters.add_argument('-r', '--rule', help='Rule-id')
+    filters.add_argument('-a', '--author',
+                         help='Author, as in file names (e.g. '
+                              'Agustini,_Delmira)')
+    filters.add_argument('-p', '--poem',
+                         help='Poem, as its file name in the pos dir')
+    lines = sub.add_parser('lines', parents=[filters],
+                           help='Corpus result lines (as in the txt file)')
+    lines.add_argument('-s', '--tsv', action='store_true',
+                       help='Format as in the tsv file')
+    lines.add_argument('-u', '--ruleid', action='store_true',
+                       help='Print out rule ids')
+    sub.add_parser('spans', parents=[filters],
+                   help='Standoff rows (as in the _sto file)')
+    sub.add_parser('counts', parents=[filters],
+                   help='Enjambment counts per type and rule-id')
+    export = sub.add_parser('export', help='Write the flat result formats')
+    export.add_argument('-f', '--singlefile', required=True,
+                        help='Name for single file that will hold results '
+                             'for complete corpus (tsv and standoff are '
+                             'named after it)')
+    export.add_argument('-o', '--outdir',
+                        help='Output dir for the results of each poem')
+    export.add_argument('-u', '--ruleid', action='store_true',
+                        help='Print out rule ids')
+    return parser.parse_args()
+
+
+def author_from_filename(fn):
+    """
+    Author in a file name following AuthorLast_First__AuthorID~~Title__TitleID
+    (see L{utils.read_dir_into_ttl2txt_dict}), None if not in that format
+    """
+    if u"~~" not in fn:
+        return None
+    return re.sub(ur"__[^_]*$", u"", fn.split(u"~~")[0])
+
+
+def create_db(dbfn):
+    """
+    Create the results database at dbfn, replacing any previous one
+    @return: connection to the database
+    """
+    if os.path.exists(dbfn):
+        os.remove(dbfn)
+    conn = sqlite3.connect(dbfn)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def add_poem(conn, result):
+    """
+    Store the detection results for a poem (call conn.commit() when done)
+    @param conn: connection to the database (see L{create_db})
+    @param result: detection results for the poem (see
+    L{detect.detect_many})
+    """
+    name = result["id"]
+    if isinstance(name, str):
+        name = name.decode("utf8")
+    toks, ana = result["tokens"], result["annotations"]
+    cur = conn.execute(
+        u"INSERT INTO poems (name, author, nlines) VALUES (?, ?, ?)",
+        (name, author_from_filename(name), len(toks)))
+    poem_id = cur.lastrowid
+    conn.executemany(
+        u"INSERT INTO lines VALUES (?, ?, ?, ?)",
+        [(poem_id, idx + 1, json.dumps(toklist),
+          u" ".join(tok[0] for tok in toklist))
+         for idx, toklist in enumerate(toks)])
+    # annotations may include a line index past the last line
+    conn.executemany(
+        u"INSERT INTO hits VALUES (?, ?, ?, ?, ?, ?)",
+        [(poem_id, idx + 1, nbr, posi, etype, rid)
+         for idx, infos in ana.items()
+         for nbr, (posi, etype, rid) in enumerate(infos)])
+    conn.executemany(
+        u"INSERT INTO spans VALUES (?, ?, ?, ?, ?)",
+        [(poem_id,) + tuple(span) for span in result["spans"]])
+    return poem_id
+
+
+def load_poem(conn, poem_id):
+    """
+    Read back the detection results for a poem
+    @return: dict with the same keys as L{detect.detect_many} results, the
+    poem-id as a utf8 string (like file names read from the pos dir)
+    """
+    name, nlines = conn.execute(
+        u"SELECT name, nlines FROM poems WHERE id = ?", (poem_id,)).fetchone()
+    toks = [[tuple(tok) for tok in json.loads(tokens)] for (tokens,)
+            in conn.execute(u"SELECT tokens FROM lines WHERE poem_id = ? "
+                            u"ORDER BY lnbr", (poem_id,))]
+    assert len(toks) == nlines
+    ana = {}
+    for lnbr, posi, etype, rid in conn.execute(
+            u"SELECT lnbr, position, type, rule_id FROM hits "
+            u"WHERE poem_id = ? ORDER BY lnbr, ord", (poem_id,)):
+        ana.setdefault(lnbr - 1, []).append((posi, etype, rid))
+    spans = [tuple(span) for span in conn.execute(
+        u"SELECT start, end, type, rule_id FROM spans WHERE poem_id = ? "
+        u"ORDER BY rowid", (poem_id,))]
+    return {"id": name.encode("utf8"), "tokens": toks, "annotations": ana,
+            "spans": spans}
+
+
+def match_clause(col, value):
+    """SQL condition and parameters to match column col against value"""
+    if u"%" in value:
+        return u"{} LIKE ?".format(col), [value]
+    return u"{} = ?".format(col), [value]
+
+
+def filter_clauses(etype=None, rid=None, author=None, poem=None, table="hits"):
+    """
+    SQL conditions and parameters for the query filters, on table (hits or
+    spans) joined with poems
+    """
+    conds, params = [], []
+    for col, value in ((table + u".type", etype), (table + u".rule_id", rid),
+                       (u"poems.author", author), (u"poems.name", poem)):
+        if value is not None:
+            cond, cparams = match_clause(col, value)
+            conds.append(cond)
+            params.extend(cparams)
+    return conds, params
+
+
+def query_lines(conn, etype=None, rid=None, author=None, poem=None,
+                tsv=False, rids=False):
+    """
+    Corpus result lines (see L{detect.corpus_rows}) matching the filters.
+    Lines only match a type or rule-id filter if they are part of an
+    enjambment of that type or found by that rule
+    @return: generator with a row per line, in corpus order
+    """
+    conds, params = filter_clauses(etype, rid, author, poem)
+    if etype is not None or rid is not None:
+        conds.append(u"hits.position != 'O'")
+        sql = (u"SELECT DISTINCT hits.poem_id, hits.lnbr FROM hits "
+               u"JOIN poems ON poems.id = hits.poem_id")
+    else:
+        sql = (u"SELECT lines.poem_id, lines.lnbr FROM lines "
+               u"JOIN poems ON poems.id = lines.poem_id")
+    if conds:
+        sql += u" WHERE " + u" AND ".join(conds)
+    sql += u" ORDER BY 1, 2"
+    wanted = {}
+    for poem_id, lnbr in conn.execute(sql, params):
+        wanted.setdefault(poem_id, []).append(lnbr)
+    for poem_id in sorted(wanted):
+        result = load_poem(conn, poem_id)
+        rows = dt.corpus_rows(
+            dt.line_tags(result["tokens"], result["annotations"]),
+            result["id"], tsv=tsv, rids=rids)
+        for lnbr in wanted[poem_id]:
+            if lnbr <= len(rows):
+                yield rows[lnbr - 1]
+
+
+def query_spans(conn, etype=None, rid=None, author=None, poem=None):
+    """
+    Standoff rows (see L{detect.standoff_rows}) matching the filters
+    @return: generator with a row per span, in corpus order
+    """
+    conds, params = filter_clauses(etype, rid, author, poem, table="spans")
+    sql = (u"SELECT poems.name, spans.start, spans.end, spans.type, "
+           u"spans.rule_id FROM spans JOIN poems ON poems.id = spans.poem_id")
+    if conds:
+        sql += u" WHERE " + u" AND ".join(conds)
+    sql += u" ORDER BY spans.poem_id, spans.rowid"
+    for name, start, end, etype, rid in conn.execute(sql, params):
+        for row in dt.standoff_rows(name, [(start, end, etype, rid)],
+                                    rids=True):
+            yield row
+
+
+def query_counts(conn, etype=None, rid=None, author=None, poem=None):
+    """
+    Number of enjambed spans per type and rule-id matching the filters
+    @return: list of (type, rule-id, count), most frequent first
+    """
+    conds, params = filter_clauses(etype, rid, author, poem, table="spans")
+    sql = (u"SELECT spans.type, spans.rule_id, COUNT(*) FROM spans "
+           u"JOIN poems ON poems.id = spans.poem_id")
+    if conds:
+        sql += u" WHERE " + u" AND ".join(conds)
+    sql += u" GROUP BY spans.type, spans.rule_id ORDER BY 3 DESC, 1, 2"
+    return conn.execute(sql, params).fetchall()
+
+
+def export(conn, single_f, odn=None, rids=False):
+    """
+    Write the flat result formats, as L{detect.run_dir} does
+    @param single_f: path for the single results file (see
+    L{detect.corpus_output_paths} for the others)
+    @param odn: output dir for the results file of each poem (or a zip
+    archive, see L{utils.make_output_dir}), None to skip them
+    """
+    if odn is not None:
+        ut.make_output_dir(odn)
+    outs = dt.open_corpus_outputs(single_f, rids=rids)
+    try:
+        for (poem_id,) in conn.execute(
+                u"SELECT id FROM poems ORDER BY id").fetchall():
+            result = load_poem(conn, poem_id)
+            if odn is not None:
+                ofn = os.path.join(
+                    odn, result["id"].replace("_annot.txt", "_results.txt") +
+                    ut.compression_ext(single_f))
+            else:
+                ofn = None
+            dt.write_poem_outputs(outs, result, ofn, rids=rids)
+    finally:
+        dt.close_corpus_outputs(outs)
+        ut.close_archives()
+
+
+def main():
+    argus = run_argparse()
+    conn = sqlite3.connect(argus.db)
+    out = codecs.getwriter("utf8")(sys.stdout)
+    decode = lambda val: val if val is None else val.decode("utf8")
+    if argus.command == "export":
+        export(conn, argus.singlefile, argus.outdir, rids=argus.ruleid)
+        print u"- Wrote results to [{}]".format(
+            decode(os.path.dirname(os.path.abspath(argus.singlefile))))
+        return
+    filters = (decode(argus.type), decode(argus.rule), decode(argus.author),
+               decode(argus.poem))
+    if argus.command == "lines":
+        for row in query_lines(conn, *filters, tsv=argus.tsv,
+                               rids=argus.ruleid):
+            out.write(row + u"\n")
+    elif argus.command == "spans":
+        for row in query_spans(conn, *filters):
+            out.write(u"\t".join(row) + u"\n")
+    elif argus.command == "counts":
+        for etype, rid, count in query_counts(conn, *filters):
+            out.write(u"{}\t{}\t{}\n".format(etype, rid, count))
+
+
+if __name__ == "__main__":
+    main()
@@ -12,15 +12,15 @@ import os
 
 
 # add current dir to sys.path
-import inspect
 import sys
 
-here = os.path.dirname(os.path.abspath(
-    inspect.getfile(inspect.currentframe())))
+here = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(here)
 
 # app specific imports
 import config as cfg
+import metrics as mt
+import profiling as pf
 
 
 def run_argparse():
@@ -75,27 +75,67 @@ def run_argparse():
                             cfg.resudir.format(batch=partargs.batchname,
                                                useconst=int(cfg.USE_CONSTITUENCY),
                                                usedep=int(cfg.USE_DEP)))))
+    parser.add_argument('-k', '--checkpoints', dest='checkpoints',
+                        help='Keep the NAF of each NLP layer in this dir, and '
+                             'rerun only the layers whose input or model '
+                             'changed (see run_nlp.sh)')
+    parser.add_argument('-c', '--chunkchars', dest='chunkchars', type=int,
+                        help='Parse poems longer than this many characters '
+                             'in chunks (see nlp_chunks.py)')
+    parser.add_argument('--profile', action='store_true',
+                        help='Profile each step, writing the reports to the '
+                             'log dir (see profiling.py)')
+    parser.add_argument('--metrics', action='store_true',
+                        help='Write per-poem events and a Prometheus textfile '
+                             'per step to the log dir (see metrics.py)')
     return parser.parse_args()
 
 
+def dir_paths(dn):
+    """Paths to the files in dir dn (none if it does not exist yet)"""
+    if not os.path.isdir(dn):
+        return []
+    return [os.path.join(dn, fn) for fn in os.listdir(dn)]
+
+
 def main():
     """Run"""
     argus = run_argparse()
+    if argus.profile:
+        # the python steps profile themselves; this records each step's time
+        pf.install(argus.logdir, "run_anja", argus.batchname)
+        stepopts = " --profile {}".format(argus.logdir)
+    else:
+        stepopts = ""
+    if argus.metrics:
+        stepopts += " --metrics {}".format(argus.logdir)
 
     # preprocessor
 
-    precmd = "python {} -b {} -i {} -o {} -l {}".format(
+    precmd = "python {} -b {} -i {} -o {} -l {}{}".format(
         cfg.preprocessor, argus.batchname, argus.inname,
-        argus.prepro, argus.logdir)
+        argus.prepro, argus.logdir, stepopts)
     print("- Preprocess: [{}]\n".format(precmd))
     os.popen(precmd)
+    pf.poem_done("preprocess")
 
     # run nlp
 
     nlpcmd = "{} {} {} def deponly".format(
         cfg.nlprunner, argus.prepro, argus.nlpdir)
+    if argus.checkpoints is not None:
+        nlpcmd = "NLP_CHECKPOINTS={} {}".format(argus.checkpoints, nlpcmd)
+    if argus.chunkchars is not None:
+        nlpcmd = "NLP_CHUNK_CHARS={} {}".format(argus.chunkchars, nlpcmd)
     print("- Run NLP: [{}]\n".format(nlpcmd))
-    os.popen(nlpcmd)
+    if argus.metrics:
+        # progress from the NAF files written
+        mt.run_watched(nlpcmd, argus.logdir, "nlp", argus.batchname,
+                       len(dir_paths(argus.prepro)),
+                       lambda: dir_paths(argus.nlpdir))
+    else:
+        os.popen(nlpcmd)
+    pf.poem_done("nlp")
 
     # extract pos
 
@@ -103,11 +143,12 @@ def main():
     line_positions = os.path.join(
         argus.logdir, "{}_line_positions.txt".format(argus.batchname))
 
-    poscmd = "python {} -b {} -i {} -o {} -p {}".format(
+    poscmd = "python {} -b {} -i {} -o {} -p {}{}".format(
         cfg.posextractor, argus.batchname, argus.nlpdir, argus.posdir,
-        line_positions)
+        line_positions, stepopts)
     print("- Extract PoS: [{}]\n".format(poscmd))
     os.popen(poscmd)
+    pf.poem_done("extract_pos")
 
     # detect enjambment
 
@@ -118,11 +159,12 @@ def main():
             useconst=int(cfg.USE_CONSTITUENCY),
             usedep=int(cfg.USE_DEP)))
 
-    detcmd = "python {} -b {} -i {} -n {} -o {} -f {} --ruleid -5".format(
+    detcmd = "python {} -b {} -i {} -n {} -o {} -f {} --ruleid -5{}".format(
         cfg.detector, argus.batchname, argus.posdir, argus.nlpdir,
-        argus.outdir, single_file_path)
+        argus.outdir, single_file_path, stepopts)
     print("- Detect: [{}]".format(detcmd))
     os.popen(detcmd)
+    pf.poem_done("detect")
 
 
 if __name__ == "__main__":
@@ -19,33 +19,60 @@ batchlog="./batchlog"
 
 usage(){
   echo -e "Usage:\n  $(basename $0) input_dir output_dir postagger_type(def|alt) [only_deps]"
+  echo -e "  $(basename $0) --print-cmd postagger_type(def|alt) [only_deps]"
   echo -e "  postagger_type can only be 'def' or 'alt'"
   echo -e "  Leave 'only_deps' blank if want to get SRL results besides dependency parsing"
+  echo -e "  Set NAF_COMPRESS=gz or NAF_COMPRESS=zst to write compressed NAF (_parsed.naf.gz/.zst)"
+  echo -e "  Set NLP_CHECKPOINTS=dir to keep each layer's NAF (tok, pos, parse, srl) in dir"
+  echo -e "    and resume each poem from the deepest layer already there for the same"
+  echo -e "    input and models (e.g. switching 'def' to 'alt' reruns pos, parse and srl only)"
+  echo -e "  Set NLP_CHUNK_CHARS=n to parse poems longer than n characters in chunks,"
+  echo -e "    NLP_CHUNK_WORKERS (default 2) at once, stitching their NAF (see nlp_chunks.py;"
+  echo -e "    no checkpoints are kept for those poems)"
+  echo -e "  --print-cmd prints the client chain used for each poem (text on stdin, NAF"
+  echo -e "    on stdout) without starting the servers; serve.py and nlp_chunks.py use"
+  echo -e "    it by default"
   exit
 }
 
 
 # IO
 
+[[ "$1" = "-h" ]] && usage
+
+# with --print-cmd, only print the client chain
+printcmd=""
+if [[ "$1" = "--print-cmd" ]]; then
+  printcmd=1
+  shift
+  set -- "" "" "$@"
+fi
+
 indir="$1"
 outdir="$2"
 postype="$3"  # "def", "alt" for alternative pos-tagger
 onlydeps="$4"
 
-[[ "$1" = "-h" ]] && usage
-
 if [ ! -z "$4" ]; then
     deps_or_srl="only-deps"
   else
     deps_or_srl=""
 fi
 
-if [ ! -d "$outdir" ]; then
+[[ "$postype" != "def" && "$postype" != "alt" ]] && usage
+
+if [ -z "$printcmd" ] && [ ! -d "$outdir" ]; then
   echo "- Creating dir: [$outdir]"
   mkdir -p "$outdir"
 fi
 
-[[ "$postype" != "def" && "$postype" != "alt" ]] && usage
+# output compression
+case "$NAF_COMPRESS" in
+  "") compressor="cat" ;;
+  gz) compressor="gzip -c" ;;
+  zst) compressor="zstd -qc" ;;
+  *) usage ;;
+esac
 
 
 # Pipes
@@ -71,6 +98,25 @@ posjaralt="$posdiralt/target/ixa-pipe-pos-1.4.6.jar"
 parsejar="$parsedir/target/ixa-pipe-parse-1.1.2.jar"
 srljar="$srldir/target/IXA-EHU-srl-3.0.jar"
 
+if [[ "$postype" = "alt" ]]; then
+  posport="$posportalt"
+  posjar="$posjaralt"
+fi
+
+# the complete chain (text on stdin, NAF on stdout), for nlp_chunks.py and
+# serve.py (see --print-cmd); srl messages go to $1
+client_chain(){
+  echo "java -jar $tokjar client -p $tokport | \
+java -jar $posjar client -p $posport | \
+java -jar $parsejar client -p $parseport | \
+java -Xms2500m -cp $srljar ixa.srl.SRLClient es $deps_or_srl 2>> $1"
+}
+
+if [ -n "$printcmd" ]; then
+  client_chain /dev/null
+  exit
+fi
+
 
 # Start servers if needed
 
@@ -84,10 +130,6 @@ if [[ -z $(netstat -tlnp | grep ":$tokport") ]] ; then
   echo "Started tokenizer server on $tokport"
 fi
 # pos
-if [[ "$postype" = "alt" ]]; then
-  posport="$posportalt"
-  posjar="$posjaralt"
-fi
 if [[ -z $(netstat -tlnp | grep ":$posport") ]] ; then
   if [[ "$postype" = "def" ]]; then
       java -jar "$posjar" server -l es -p "$posport" -m "$posmodel" \
@@ -128,6 +170,84 @@ if [[ -z $(netstat -tlnp | grep ":$srlport") ]] ; then
   echo -e " [DONE]"
 fi
 
+# Per-layer checkpoints
+# With NLP_CHECKPOINTS set, each layer's output is kept as
+# $NLP_CHECKPOINTS/<layer>/<key>.naf, where the key hashes the key of the
+# layer's input (the poem's text for tok) and the layer's model identity
+# (jars, models with their size and mtime, options)
+layers=(tok pos parse srl)
+
+model_id(){
+  for arg in "$@"; do
+    if [ -f "$arg" ]; then
+      echo "$arg $(stat -c '%s %Y' "$arg")"
+    else
+      echo "$arg"
+    fi
+  done | sha1sum | cut -d' ' -f1
+}
+
+if [ -n "$NLP_CHECKPOINTS" ]; then
+  if [[ "$postype" = "def" ]]; then
+    posid=$(model_id pos "$posjar" "$posmodel" "$lemmodel")
+  else
+    posid=$(model_id pos "$posjar" "$posmodelalt")
+  fi
+  layerids=($(model_id tok "$tokjar" es) "$posid" \
+            $(model_id parse "$parsejar" "$parsemodel") \
+            $(model_id srl "$srljar" "$srlmodel" "$deps_or_srl"))
+  for layer in "${layers[@]}"; do
+    mkdir -p "$NLP_CHECKPOINTS/$layer"
+  done
+fi
+
+# NAF (or text for tok) from stdin through a layer's client
+run_layer(){
+  case "$1" in
+    tok) java -jar "$tokjar" client -p "$tokport" ;;
+    pos) java -jar "$posjar" client -p "$posport" ;;
+    parse) java -jar "$parsejar" client -p "$parseport" ;;
+    srl) java -Xms2500m -cp "$srljar" ixa.srl.SRLClient es "$deps_or_srl" \
+           2>> "$batchlog" ;;
+  esac
+}
+
+# run the layers for poem $1 from the deepest checkpoint found, keeping the
+# new ones; prints the path to the srl checkpoint (nothing if a layer fails)
+run_checkpointed(){
+  local key keys=() start=0 src="$1" idx ckpt
+  key=$(sha1sum < "$1" | cut -d' ' -f1)
+  for idx in 0 1 2 3; do
+    key=$(echo "$key ${layerids[$idx]}" | sha1sum | cut -d' ' -f1)
+    keys[$idx]="$key"
+  done
+  for idx in 3 2 1 0; do
+    ckpt="$NLP_CHECKPOINTS/${layers[$idx]}/${keys[$idx]}.naf"
+    if [ -s "$ckpt" ]; then
+      start=$((idx + 1))
+      src="$ckpt"
+      echo "  resuming after ${layers[$idx]}" >> "$batchlog"
+      break
+    fi
+  done
+  for ((idx = start; idx < 4; idx++)); do
+    ckpt="$NLP_CHECKPOINTS/${layers[$idx]}/${keys[$idx]}.naf"
+    # written to a temporary file first, so that no partial NAF is reused
+    if ! run_layer "${layers[$idx]}" < "$src" > "$ckpt.$$.tmp" || \
+        [ ! -s "$ckpt.$$.tmp" ]; then
+      echo "! Layer ${layers[$idx]} failed for [$1]" >> "$batchlog"
+      rm -f "$ckpt.$$.tmp"
+      return 1
+    fi
+    mv "$ckpt.$$.tmp" "$ckpt"
+    src="$ckpt"
+  done
+  echo "$src"
+}
+
+nlpcmd="$(client_chain "$batchlog")"
+chunker="$(dirname "$0")/nlp_chunks.py"
+
 # run
 for fn in $(find "$indir" -type f) ; do
   if [ ! -s "$fn" ] ; then
@@ -139,11 +259,26 @@ for fn in $(find "$indir" -type f) ; do
   #outfn="$outdir/$(echo $(basename $fn)| sed -e 's/.txt/_parsed.xml/g')"
   #outfn="$outdir/$(echo $(basename $fn)| sed -e 's/\(_oneline\)\{0,1\}.txt/_parsed.xml/')"
   outfn="$outdir/$(echo $(basename $fn)| sed -e 's/\(.txt_oneline\)\{0,1\}.txt/_parsed.xml/')"
-  cat "$fn" | java -jar "$tokjar" client -p "$tokport" | \
-              java -jar "$posjar" client -p "$posport" | \
-              java -jar "$parsejar" client -p "$parseport" | \
-              java -Xms2500m -cp "$srljar" ixa.srl.SRLClient es "$deps_or_srl" > \
-              "$outfn" 2>> "$batchlog"
+  [[ -n "$NAF_COMPRESS" ]] && outfn="${outfn%.xml}.naf.$NAF_COMPRESS"
+  if [ -n "$NLP_CHUNK_CHARS" ] && \
+      [ "$(wc -m < "$fn")" -gt "$NLP_CHUNK_CHARS" ]; then
+    echo "  in chunks" >> "$batchlog"
+    python "$chunker" -i "$fn" -m "$nlpcmd" -c "$NLP_CHUNK_CHARS" \
+      -w "${NLP_CHUNK_WORKERS:-2}" 2>> "$batchlog" | $compressor > "$outfn"
+  elif [ -n "$NLP_CHECKPOINTS" ]; then
+    ckpt=$(run_checkpointed "$fn")
+    if [ -z "$ckpt" ]; then
+      echo "! FAILED $fn" | tee -a "$batchlog"
+      continue
+    fi
+    $compressor < "$ckpt" > "$outfn"
+  else
+    cat "$fn" | java -jar "$tokjar" client -p "$tokport" | \
+                java -jar "$posjar" client -p "$posport" | \
+                java -jar "$parsejar" client -p "$parseport" | \
+                java -Xms2500m -cp "$srljar" ixa.srl.SRLClient es "$deps_or_srl" \
+                2>> "$batchlog" | $compressor > "$outfn"
+  fi
   echo "- OUT $outfn" | tee -a "$batchlog"
 done
 
@@ -0,0 +1,165 @@
+"""
+Compare reading NAF files stored plain, gzip-compressed (.gz) and
+zstandard-compressed (.zst), with a cold and a warm page cache.
+Copies the NAF files in the input dir (repeated -r times, to get a larger
+corpus) to a work dir in each format, then times reading them (decompress
+only) and parsing them (L{utils.read_naf}). For the cold cache, the files are
+evicted from the page cache before each run (posix_fadvise, Linux only).
+"""
+
+__author__ = 'Pablo Ruiz'
+__date__ = '19/10/26'
+__email__ = 'pabloruizfabo@gmail.com'
+
+
+import argparse
+import ctypes
+import ctypes.util
+import os
+import shutil
+import tempfile
+import time
+
+# add app dir to sys.path
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+appbasedir = os.path.join(here, os.pardir)
+sys.path.append(appbasedir)
+
+# app specific imports
+import config as cfg
+import utils as ut
+
+
+FORMATS = {"plain": "", "gz": ".gz", "zst": ".zst"}
+POSIX_FADV_DONTNEED = 4
+
+
+def run_argparse():
+    """
+    Run the argparse-based cli parser for options or defaults
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark reading plain vs. compressed NAF",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-i', '--input', dest='inname',
+                        default=os.path.join(cfg.sample_outdir, "nlp"),
+                        help='Dir with (uncompressed) NAF files')
+    parser.add_argument('-w', '--workdir',
+                        help='Dir for the copies in each format (a temporary '
+                             'dir, removed at the end, if not given)')
+    parser.add_argument('-r', '--repeat', type=int, default=20,
+                        help='Copies of each input file')
+    parser.add_argument('-f', '--formats', nargs='+', default=["plain", "gz",
+                                                               "zst"],
+                        choices=sorted(FORMATS), help='Formats to compare')
+    return parser.parse_args()
+
+
+def make_copies(idn, odn, ext, repeat):
+    """
+    Write repeat copies of each file in idn to odn, compressed as per
+    extension ext (see L{utils.open_file})
+    @return: list of paths written
+    """
+    if not os.path.exists(odn):
+        os.makedirs(odn)
+    paths = []
+    for fn in sorted(os.listdir(idn)):
+        with open(os.path.join(idn, fn), "rb") as fd:
+            data = fd.read()
+        for nbr in range(repeat):
+            ofn = os.path.join(odn, "{:03d}_{}{}".format(nbr, fn, ext))
+            with ut.open_file(ofn, "w", encoding=None) as ofd:
+                ofd.write(data)
+            paths.append(ofn)
+    return paths
+
+
+def evict(paths):
+    """
+    Drop paths from the page cache
+    @return: False if not possible on this system
+    """
+    libc_name = ctypes.util.find_library("c")
+    if libc_name is None:
+        return False
+    libc = ctypes.CDLL(libc_name, use_errno=True)
+    if not hasattr(libc, "posix_fadvise"):
+        return False
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            if libc.posix_fadvise(fd, ctypes.c_int64(0), ctypes.c_int64(0),
+                                  POSIX_FADV_DONTNEED) != 0:
+                return False
+        finally:
+            os.close(fd)
+    return True
+
+
+def read_all(paths):
+    """Read (decompressed) contents of paths, return total bytes"""
+    total = 0
+    for path in paths:
+        with ut.open_file(path, "r", encoding=None) as fd:
+            total += len(fd.read())
+    return total
+
+
+def parse_all(paths):
+    """Parse paths as NAF, return number of terms (to use the trees)"""
+    return sum(len(list(ut.read_naf(path).get_terms())) for path in paths)
+
+
+def run_bench(paths, task, cold):
+    """
+    Time task (L{read_all} or L{parse_all}) on paths
+    @param cold: evict paths from page cache first, else read them once
+    before timing
+    @return: seconds taken, None if cold cache not available
+    """
+    if cold:
+        if not evict(paths):
+            return None
+    else:
+        read_all(paths)
+    start = time.time()
+    task(paths)
+    return time.time() - start
+
+
+def main():
+    argus = run_argparse()
+    workdir = argus.workdir or tempfile.mkdtemp(prefix="anja_bench_")
+    try:
+        print u"- Copies of [{}] x {} in [{}]".format(
+            argus.inname, argus.repeat, workdir)
+        print "\t".join(("format", "MB_disk", "cache", "task", "secs",
+                         "files/s", "MB/s"))
+        for fmt in argus.formats:
+            paths = make_copies(argus.inname, os.path.join(workdir, fmt),
+                                FORMATS[fmt], argus.repeat)
+            disk_mb = sum(os.path.getsize(path) for path in paths) / 1e6
+            data_mb = read_all(paths) / 1e6
+            for cache in ("cold", "warm"):
+                for tname, task in (("read", read_all), ("parse", parse_all)):
+                    secs = run_bench(paths, task, cache == "cold")
+                    if secs is None:
+                        print "\t".join((fmt, "{:.2f}".format(disk_mb), cache,
+                                         tname, "n/a", "n/a", "n/a"))
+                        continue
+                    print "\t".join((
+                        fmt, "{:.2f}".format(disk_mb), cache, tname,
+                        "{:.3f}".format(secs),
+                        "{:.1f}".format(len(paths) / secs),
+                        "{:.1f}".format(data_mb / secs)))
+    finally:
+        if argus.workdir is None:
+            shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+# coding: utf-8
+
+"""
+Time the workflow stages on a corpus made with
+scripts/make_synthetic_corpus.py, and record their peak memory:
+    - prepro: read the poems, write them on a single line and their line
+      positions (L{utils.merge_lines_and_get_line_positions})
+    - extract_pos: pos-tags per line from NAF (L{extract_pos.run_dir})
+    - detect: enjambment detection, with dependencies (L{detect.run_dir})
+    - eval: evaluation per rule against the corpus reference
+      (eval/eval_per_rule.py), and precision/recall/F1 (eval/score.py)
+Each stage runs in a child process (fork), so that its peak resident memory
+(maxrss) and CPU times are its own. The parent only loads the standard
+library and utils before forking (its own maxrss is 'base_maxrss_mb').
+Results are written as JSON, with the corpus counts and the environment
+(Python version, git commit) to compare runs; with -b, the times are also
+printed next to the ones in a previous results file.
+"""
+
+__author__ = 'Pablo Ruiz'
+__date__ = '19/10/26'
+__email__ = 'pabloruizfabo@gmail.com'
+
+
+import argparse
+import codecs
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+import traceback
+
+# add app dir to sys.path
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+appbasedir = os.path.join(here, os.pardir)
+sys.path.append(appbasedir)
+
+# app specific imports
+import config as cfg
+import utils as ut
+
+
+STAGES = ("prepro", "extract_pos", "detect", "eval")
+RESULTS_VERSION = 1
+
+
+def run_argparse():
+    """
+    Run the argparse-based cli parser for options or defaults
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark the workflow on a synthetic corpus",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('corpus', help='Corpus dir (see '
+                                       'scripts/make_synthetic_corpus.py)')
+    parser.add_argument('-o', '--output', default='bench_results.json',
+                        help='JSON file for the results')
+    parser.add_argument('-b', '--baseline',
+                        help='Results of a previous run, to compare with')
+    parser.add_argument('-w', '--workdir',
+                        help='Dir for the stage outputs (a temporary dir, '
+                             'removed at the end, if not given)')
+    parser.add_argument('-s', '--stages', nargs='+', choices=STAGES,
+                        default=list(STAGES),
+                        help='Stages to run (later stages use the outputs of '
+                             'earlier ones in the workdir)')
+    parser.add_argument('-x', '--vectorized', action='store_true',
+                        help='Run detection with the vectorized rules')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Show the output of the stages')
+    return parser.parse_args()
+
+
+def stage_paths(corpus, workdir):
+    """Inputs and outputs of the stages"""
+    with open(os.path.join(corpus, "corpus.json")) as fd:
+        batch = json.load(fd)["batch"]
+    posifn = cfg.line_positions.format(batch=batch)
+    return {
+        "poems": os.path.join(corpus, "in"),
+        "nlp": os.path.join(corpus, "out", "nlp"),
+        "positions": os.path.join(corpus, "out", "logs", posifn),
+        "ref": os.path.join(corpus, "ref_sto.txt"),
+        "prepro": os.path.join(workdir, "prepro"),
+        "logs": os.path.join(workdir, "logs"),
+        "pos": os.path.join(workdir, "pos"),
+        "out": os.path.join(workdir, "out"),
+        "results": os.path.join(workdir, "out", "corpus_results.txt"),
+        "sto": os.path.join(workdir, "out", "corpus_results_sto.txt"),
+        "evaluated": os.path.join(workdir, "eval_sto.txt"),
+        "per_rule": os.path.join(workdir, "eval_per_rule.txt"),
+        "per_type": os.path.join(workdir, "eval_per_type.txt"),
+        "scores": os.path.join(workdir, "eval_scores.txt"),
+        "batch": batch}
+
+
+def run_prepro(paths, argus):
+    for dname in (paths["prepro"], paths["logs"]):
+        if not os.path.exists(dname):
+            os.makedirs(dname)
+    ti2te = ut.read_dir_into_ttl2txt_dict(paths["poems"])
+    ut.merge_lines_and_get_line_positions(ti2te, paths["prepro"],
+                                          paths["logs"], paths["batch"])
+
+
+def run_extract_pos(paths, argus):
+    import extract_pos as ep
+    ep.run_dir(paths["nlp"], paths["pos"], ep.read_positions(paths["positions"]))
+
+
+def run_detect(paths, argus):
+    import detect as dt
+    dt.run_dir(paths["pos"], paths["out"], paths["results"], paths["nlp"],
+               "en", False, True, print_rule_ids=True,
+               vectorized=argus.vectorized)
+
+
+def run_eval(paths, argus):
+    sys.path.append(os.path.join(appbasedir, "eval"))
+    import eval_per_rule as epr
+    import score as sc
+    epr.evaluate(paths["sto"], paths["ref"], paths["evaluated"],
+                 paths["per_rule"], paths["per_type"])
+    with codecs.open(paths["scores"], "w", "utf8") as fd:
+        fd.write(u"\n".join(sc.format_scores(sc.score(
+            sc.read_rows(paths["sto"]), sc.read_rows(paths["ref"])))))
+
+
+RUNNERS = {"prepro": run_prepro, "extract_pos": run_extract_pos,
+           "detect": run_detect, "eval": run_eval}
+
+
+def run_stage(name, paths, argus):
+    """
+    Run a stage in a child process
+    @return: dict with wall-clock seconds, CPU seconds and peak memory, or
+    with the error if the stage failed
+    """
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # child: run the stage, send its time or error to the parent
+        os.close(rfd)
+        if not argus.verbose:
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, 1)
+            os.dup2(devnull, 2)
+        report = {}
+        try:
+            start = time.time()
+            RUNNERS[name](paths, argus)
+            report["secs"] = time.time() - start
+        except BaseException:
+            report["error"] = traceback.format_exc()
+        sys.stdout.flush()
+        os.write(wfd, json.dumps(report))
+        os.close(wfd)
+        os._exit(0)
+    os.close(wfd)
+    chunks = []
+    while True:
+        chunk = os.read(rfd, 65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.close(rfd)
+    status, rusage = os.wait4(pid, 0)[1:]
+    report = json.loads("".join(chunks) or "{}")
+    if status != 0 and "error" not in report:
+        report["error"] = "exit status {}".format(status)
+    report.update({"user_s": rusage.ru_utime, "sys_s": rusage.ru_stime,
+                   # kilobytes on Linux
+                   "maxrss_mb": rusage.ru_maxrss / 1024.0})
+    return report
+
+
+def environment():
+    """Python, platform and git commit, to tell runs apart"""
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=appbasedir,
+            stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"python": platform.python_version(), "platform": platform.platform(),
+            "machine": platform.machine(), "git_commit": commit}
+
+
+def compare(results, baseline):
+    """Print stage times and memory next to the ones in baseline"""
+    print "\t".join(("stage", "secs", "base_secs", "ratio", "maxrss_mb",
+                     "base_maxrss_mb"))
+    for name in STAGES:
+        if name not in results["stages"]:
+            continue
+        report = results["stages"][name]
+        old = baseline.get("stages", {}).get(name, {})
+        if "secs" not in report or "secs" not in old:
+            print "\t".join((name, str(report.get("secs", "n/a")),
+                             str(old.get("secs", "n/a")), "n/a",
+                             "{:.1f}".format(report["maxrss_mb"]), "n/a"))
+            continue
+        print "\t".join((name, "{:.3f}".format(report["secs"]),
+                         "{:.3f}".format(old["secs"]),
+                         "{:.2f}".format(report["secs"] / old["secs"]),
+                         "{:.1f}".format(report["maxrss_mb"]),
+                         "{:.1f}".format(old["maxrss_mb"])))
+
+
+def main():
+    argus = run_argparse()
+    workdir = argus.workdir or tempfile.mkdtemp(prefix="anja_bench_")
+    with open(os.path.join(argus.corpus, "corpus.json")) as fd:
+        corpus = json.load(fd)
+    paths = stage_paths(argus.corpus, workdir)
+    results = {"version": RESULTS_VERSION,
+               "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "environment": environment(),
+               "corpus": dict(corpus, path=os.path.abspath(argus.corpus)),
+               "options": {"vectorized": argus.vectorized},
+               "base_maxrss_mb": resource.getrusage(
+                   resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+               "stages": {}}
+    npoems = corpus["counts"]["poems"]
+    try:
+        for name in STAGES:
+            if name not in argus.stages:
+                continue
+            print u"- Running [{}]".format(name)
+            report = run_stage(name, paths, argus)
+            if "secs" in report:
+                report["poems_per_s"] = npoems / report["secs"]
+                print u"  {:.3f} s, {:.1f} poems/s, maxrss {:.1f} MB".format(
+                    report["secs"], report["poems_per_s"], report["maxrss_mb"])
+            else:
+                print u"! Stage [{}] failed:\n{}".format(name, report["error"])
+            results["stages"][name] = report
+    finally:
+        if argus.workdir is None:
+            shutil.rmtree(workdir)
+    with open(argus.output, "w") as fd:
+        json.dump(results, fd, indent=2, sort_keys=True)
+    print u"- Wrote results to [{}]".format(argus.output)
+    if argus.baseline is not None:
+        with open(argus.baseline) as fd:
+            compare(results, json.load(fd))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+Compile the lexical resources (suplemento and periphrases) into their
+snapshot (config.lexicon_snapshot), which the detection loads instead of
+parsing the sources. The snapshot is also rebuilt automatically when the
+sources change, this is to build it ahead of time (e.g. before starting
+several workers, or to ship it with a read-only install).
+"""
+
+__author__ = 'Pablo Ruiz'
+__date__ = '19/10/26'
+__email__ = 'pabloruizfabo@gmail.com'
+
+
+import argparse
+import os
+import time
+
+# add app dir to sys.path
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+appbasedir = os.path.join(here, os.pardir)
+sys.path.append(appbasedir)
+
+# app specific imports
+import config as cfg
+import utils as ut
+
+
+def run_argparse():
+    """
+    Run the argparse-based cli parser for options or defaults
+    """
+    parser = argparse.ArgumentParser(
+        description="Compile the lexicon snapshot",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-o', '--output', default=cfg.lexicon_snapshot,
+                        help='Snapshot path')
+    return parser.parse_args()
+
+
+def main():
+    argus = run_argparse()
+    start = time.time()
+    lexicons = ut.compile_lexicons(cfg, argus.output)
+    print u"- Compiled {} suplemento and {} periphrases entries " \
+          u"in {:.1f} ms".format(len(lexicons["suplemento"]),
+                                 len(lexicons["periphrases"]),
+                                 1000 * (time.time() - start))
+    start = time.time()
+    ut.load_lexicons(cfg, argus.output)
+    print u"- Loaded snapshot [{}] in {:.1f} ms".format(
+        argus.output, 1000 * (time.time() - start))
+
+
+if __name__ == "__main__":
+    main()
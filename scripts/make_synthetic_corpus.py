@@ -0,0 +1,354 @@
+# coding: utf-8
+
+"""
+Generate a synthetic corpus to benchmark the workflow at scale (see
+scripts/bench_pipeline.py), with the statistics of a sample of NAF files
+(by default the ones in data/sample/out/nlp):
+    - number of lines per poem and of tokens per line
+    - part-of-speech sequences (bigrams, also across line ends), and the
+      word-forms, lemmas and morphological tags seen for each part-of-speech
+    - the word-forms ending a sentence
+    - dependency functions and head part-of-speech per dependent
+      part-of-speech
+    - enjambment types, from a reference (by default the sonnets reference
+      in eval/ref)
+The output dir has the same layout as data/sample:
+    - in/: poems, one line per line
+    - out/prepro/: poems on a single line, and out/logs/: their line
+      positions, as written by prepro (L{utils.merge_lines_and_get_line_positions})
+    - out/nlp/: NAF with text, terms (lemma, pos, morphofeat) and deps layers
+      (no constituency layer: run detection with dependencies only)
+    - ref_sto.txt: standoff reference for eval/eval_per_rule.py, with
+      random spans and types (it is there to time the evaluation, the
+      scores on it mean nothing)
+    - corpus.json: generation options and counts
+"""
+
+__author__ = 'Pablo Ruiz'
+__date__ = '19/10/26'
+__email__ = 'pabloruizfabo@gmail.com'
+
+
+import argparse
+import codecs
+import json
+import os
+import random
+import time
+from xml.sax.saxutils import escape, quoteattr
+
+# add app dir to sys.path
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+appbasedir = os.path.join(here, os.pardir)
+sys.path.append(appbasedir)
+
+# app specific imports
+import config as cfg
+import utils as ut
+
+
+# poems, lines per poem (None: as in the sample)
+SCALES = {"1k": (1000, None), "10k": (10000, None), "100k": (100000, None),
+          "long": (20, 500)}
+BATCH = "synthetic"
+POEMS_PER_AUTHOR = 100
+# share of line pairs in the reference that are enjambed
+REF_RATE = 0.15
+# form-initial part-of-speech
+START = "^"
+# pos-tag for punctuation, attached to the previous token
+PUNCT_POS = "O"
+
+NAF_HEAD = u"""<?xml version="1.0" encoding="UTF-8"?>
+<NAF xml:lang="es" version="v1.naf">
+  <nafHeader>
+    <linguisticProcessors layer="text">
+      <lp name="synthetic" version="1" />
+    </linguisticProcessors>
+    <linguisticProcessors layer="terms">
+      <lp name="synthetic" version="1" />
+    </linguisticProcessors>
+    <linguisticProcessors layer="deps">
+      <lp name="synthetic" version="1" />
+    </linguisticProcessors>
+  </nafHeader>
+"""
+NAF_WF = u'    <wf id="w{}" offset="{}" length="{}" sent="{}" para="1">{}</wf>\n'
+NAF_TERM = (u'    <term id="t{}" type={} lemma={} pos={} morphofeat={}>\n'
+            u'      <span>\n        <target id="w{}" />\n      </span>\n'
+            u'    </term>\n')
+NAF_DEP = u'    <dep from="t{}" to="t{}" rfunc={} />\n'
+
+
+def run_argparse():
+    """
+    Run the argparse-based cli parser for options or defaults
+    """
+    parser = argparse.ArgumentParser(
+        description="Generate a synthetic corpus for benchmarks",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('outdir', help='Output dir')
+    parser.add_argument('-s', '--scale', choices=sorted(SCALES), default="1k",
+                        help='Number of poems (1k, 10k, 100k), or long poems '
+                             '(20 x 500 lines)')
+    parser.add_argument('-n', '--poems', type=int,
+                        help='Number of poems (overrides the scale)')
+    parser.add_argument('-m', '--lines', type=int,
+                        help='Lines per poem (overrides the scale)')
+    parser.add_argument('-i', '--input', dest='inname',
+                        default=os.path.join(cfg.sample_outdir, "nlp"),
+                        help='Dir with the NAF files to take statistics from')
+    parser.add_argument('-p', '--posifile',
+                        default=os.path.join(
+                            cfg.sample_outdir, "logs",
+                            cfg.line_positions.format(batch="batch-001")),
+                        help='Line positions for the NAF files')
+    parser.add_argument('-t', '--reffile',
+                        default=os.path.join(appbasedir, "eval", "ref",
+                                             "ref_sonnets-norm_sto.txt"),
+                        help='Standoff reference to take enjambment types from')
+    parser.add_argument('-r', '--seed', type=int, default=1,
+                        help='Random seed')
+    parser.add_argument('-z', '--compress', choices=('gz', 'zst'),
+                        help='Compress the NAF files (gzip or zstandard)')
+    return parser.parse_args()
+
+
+def collect_stats(idn, posifn, reffn):
+    """
+    Collect the statistics the synthetic poems are generated from
+    @param idn: dir with NAF files
+    @param posifn: line positions for the poems in idn (as written by
+    L{utils.merge_lines_and_get_line_positions})
+    @param reffn: standoff reference (format of eval/eval_per_rule.py)
+    @return: dict of lists; sampling an element uniformly from them follows
+    the frequencies in the NAF files
+    """
+    from lxml import etree
+    positions = {}
+    with ut.open_file(posifn, "r", "utf8") as fd:
+        for line in fd:
+            title, lnbr, posis = line.rstrip("\n").split("\t")
+            start, end = posis.split("~")[-1].split(",")
+            positions.setdefault(title, []).append((int(start), int(end)))
+    stats = {"lines": [], "tokens": [], "next": {}, "terms": {},
+             "sentend": set(), "deps": {}, "etypes": []}
+    with ut.open_file(reffn, "r", "utf8") as fd:
+        stats["etypes"] = [line.split("\t")[3].strip() for line in fd
+                           if line.strip()]
+    for fn in sorted(ut.list_dir(idn)):
+        title = ut.strip_compression_ext(fn).replace(cfg.nlpsfx, ".txt")
+        title = title if isinstance(title, unicode) else title.decode("utf8")
+        if title not in positions:
+            continue
+        with ut.open_file(os.path.join(idn, fn), "r", encoding=None) as fd:
+            root = etree.parse(fd).getroot()
+        wfs = dict((wf.get("id"), wf) for wf in root.iter("wf"))
+        tid2pos = {}
+        prev, prevsent = START, None
+        ntoks = [0] * len(positions[title])
+        for term in root.iter("term"):
+            wf = wfs[term.find("span/target").get("id")]
+            pos = term.get("pos")
+            tid2pos[term.get("id")] = pos
+            stats["next"].setdefault(prev, []).append(pos)
+            stats["terms"].setdefault(pos, []).append(
+                (wf.text, term.get("lemma"), term.get("morphofeat"),
+                 term.get("type")))
+            if prevsent is not None and wf.get("sent") != prevsent[0]:
+                stats["sentend"].add(prevsent[1])
+            prev, prevsent = pos, (wf.get("sent"), wf.text)
+            offset = int(wf.get("offset"))
+            for lnbr, (start, end) in enumerate(positions[title]):
+                if start <= offset < end:
+                    ntoks[lnbr] += 1
+                    break
+        if prevsent is not None:
+            stats["sentend"].add(prevsent[1])
+        stats["lines"].append(len(positions[title]))
+        stats["tokens"].extend(nbr for nbr in ntoks if nbr)
+        for dep in root.iter("dep"):
+            stats["deps"].setdefault(tid2pos[dep.get("to")], []).append(
+                (dep.get("rfunc"), tid2pos[dep.get("from")]))
+    stats["sentend"] = sorted(stats["sentend"])
+    return stats
+
+
+def make_poem(stats, nlines, rnd):
+    """
+    Generate a poem
+    @param nlines: number of lines, None to sample it
+    @return: list of lines, each a list of (form, lemma, pos, morphofeat,
+    type) tuples
+    """
+    if nlines is None:
+        nlines = rnd.choice(stats["lines"])
+    lines = []
+    prev = START
+    for _ in range(nlines):
+        line = []
+        for _ in range(rnd.choice(stats["tokens"])):
+            # no punctuation to start a line: it would attach to the previous
+            pos = rnd.choice(stats["next"].get(prev) or stats["next"][START])
+            while not line and pos == PUNCT_POS:
+                pos = rnd.choice(stats["next"][START])
+            form, lemma, morpho, ttype = rnd.choice(stats["terms"][pos])
+            line.append((form, lemma, pos, morpho, ttype))
+            prev = pos
+        lines.append(line)
+    return lines
+
+
+def line_text(line):
+    """Text for a line: tokens separated by spaces, except punctuation"""
+    return u"".join(tok[0] if (tok[2] == PUNCT_POS and idx > 0)
+                    else (u" " if idx > 0 else u"") + tok[0]
+                    for idx, tok in enumerate(line))
+
+
+def make_deps(sentence, stats, rnd):
+    """
+    Dependencies for a sentence: the first verb (else the first token) is the
+    root, other tokens depend on the closest token with a head part-of-speech
+    seen in the sample for their own part-of-speech, else on the root
+    @param sentence: list of (term number, pos) for the sentence
+    @return: list of (head term number, dependent term number, function)
+    """
+    if not sentence:
+        return []
+    root = next((tnbr for tnbr, pos in sentence if pos == "V"), sentence[0][0])
+    deps = []
+    for idx, (tnbr, pos) in enumerate(sentence):
+        if tnbr == root:
+            continue
+        cands = stats["deps"].get(pos)
+        if not cands:
+            continue
+        rfunc, hpos = rnd.choice(cands)
+        head = root
+        for dist in range(1, len(sentence)):
+            found = [sentence[jdx][0] for jdx in (idx - dist, idx + dist)
+                     if 0 <= jdx < len(sentence) and
+                     sentence[jdx][1] == hpos]
+            if found:
+                head = found[0]
+                break
+        deps.append((head, tnbr, rfunc))
+    return deps
+
+
+def write_naf(lines, ofn, stats, rnd):
+    """
+    Write NAF for a poem, with offsets in the poem joined into a single line
+    (see L{utils.get_line_positions})
+    """
+    wfs, terms, sentences = [], [], [[]]
+    offset, sent, tnbr = 0, 1, 0
+    for line in lines:
+        text = line_text(line)
+        lpos = 0
+        for idx, (form, lemma, pos, morpho, ttype) in enumerate(line):
+            tnbr += 1
+            lpos = text.index(form, lpos)
+            wfs.append(NAF_WF.format(tnbr, offset + lpos, len(form), sent,
+                                     escape(form)))
+            terms.append(NAF_TERM.format(
+                tnbr, quoteattr(ttype), quoteattr(lemma), quoteattr(pos),
+                quoteattr(morpho), tnbr))
+            sentences[-1].append((tnbr, pos))
+            lpos += len(form)
+            if form in stats["sentend"]:
+                sent += 1
+                sentences.append([])
+        offset += len(text) + 1
+    deps = []
+    for sentence in sentences:
+        deps.extend(NAF_DEP.format(head, dep, quoteattr(rfunc))
+                    for head, dep, rfunc in make_deps(sentence, stats, rnd))
+    with ut.open_file(ofn, "w", "utf8") as fd:
+        fd.write(NAF_HEAD)
+        fd.write(u"  <text>\n" + u"".join(wfs) + u"  </text>\n")
+        fd.write(u"  <terms>\n" + u"".join(terms) + u"  </terms>\n")
+        fd.write(u"  <deps>\n" + u"".join(deps) + u"  </deps>\n")
+        fd.write(u"</NAF>\n")
+
+
+def poem_name(nbr):
+    """Filename stem, in the corpus format (see L{utils.read_dir_into_ttl2txt_dict})"""
+    author = nbr // POEMS_PER_AUTHOR
+    return u"Synthetic,_Author_{0}__{0:04d}~~Poem_{1}__{1:06d}".format(
+        author, nbr)
+
+
+def make_corpus(odn, stats, npoems, nlines=None, seed=1, compress=None):
+    """
+    Write the synthetic corpus (see module doc for the layout)
+    @param npoems: number of poems
+    @param nlines: lines per poem, None to sample them
+    @param compress: compress NAF files with gzip ('gz') or zstandard ('zst')
+    @return: dict with counts
+    """
+    rnd = random.Random(seed)
+    dirs = dict((name, os.path.join(odn, *name.split("/")))
+                for name in ("in", "out/prepro", "out/logs", "out/nlp"))
+    for dname in dirs.values():
+        if not os.path.exists(dname):
+            os.makedirs(dname)
+    counts = {"poems": 0, "lines": 0, "terms": 0, "ref_spans": 0}
+    posfn = os.path.join(dirs["out/logs"],
+                         cfg.line_positions.format(batch=BATCH))
+    with codecs.open(posfn, "w", "utf8") as posfd, \
+            codecs.open(os.path.join(odn, "ref_sto.txt"), "w", "utf8") as reffd:
+        for nbr in range(npoems):
+            name = poem_name(nbr)
+            lines = make_poem(stats, nlines, rnd)
+            texts = [line_text(line) for line in lines]
+            with codecs.open(os.path.join(dirs["in"], name + u".txt"), "w",
+                             "utf8") as fd:
+                fd.write(u"\n".join(texts) + u"\n")
+            ntext, positions = ut.get_line_positions(texts)
+            with codecs.open(os.path.join(dirs["out/prepro"], u"{}.txt_oneline"
+                             u".txt".format(name)), "w", "utf8") as fd:
+                fd.write(ntext)
+            for lnbr, posis in sorted(positions.items()):
+                posfd.write(u"{}.txt\t{}\t{}\n".format(name, lnbr + 1, u"~".join(
+                    u"{},{}".format(start, end) for start, end in posis)))
+            write_naf(lines, os.path.join(dirs["out/nlp"], name + cfg.nlpsfx +
+                      ("." + compress if compress else "")), stats, rnd)
+            for lnbr in range(1, len(lines)):
+                if rnd.random() < REF_RATE:
+                    reffd.write(u"{}\t{}\t{}\t{}\n".format(
+                        name, lnbr, lnbr + 1, rnd.choice(stats["etypes"])))
+                    counts["ref_spans"] += 1
+            counts["poems"] += 1
+            counts["lines"] += len(lines)
+            counts["terms"] += sum(len(line) for line in lines)
+    return counts
+
+
+def main():
+    argus = run_argparse()
+    npoems, nlines = SCALES[argus.scale]
+    if argus.poems is not None:
+        npoems = argus.poems
+    if argus.lines is not None:
+        nlines = argus.lines
+    start = time.time()
+    stats = collect_stats(argus.inname, argus.posifile, argus.reffile)
+    counts = make_corpus(argus.outdir, stats, npoems, nlines, argus.seed,
+                         argus.compress)
+    custom = argus.poems is not None or argus.lines is not None
+    meta = {"scale": "custom" if custom else argus.scale, "poems": npoems, "lines_per_poem": nlines,
+            "seed": argus.seed, "compress": argus.compress,
+            "sample": os.path.abspath(argus.inname), "batch": BATCH,
+            "counts": counts}
+    with open(os.path.join(argus.outdir, "corpus.json"), "w") as fd:
+        json.dump(meta, fd, indent=2, sort_keys=True)
+    print u"- Wrote {poems} poems, {lines} lines, {terms} terms to [{}] " \
+          u"in {:.1f} s".format(argus.outdir, time.time() - start, **counts)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Stand-in for the IXA pipes NLP chain (see run_nlp.sh), to test the tools
+without the NLP servers. Reads a poem on a single line (as output by
+prepro/prepro.py) from stdin and writes NAF to stdout.
+With -r, writes the NAF file in the given dir whose tokens match the input
+(e.g. data/sample/out/nlp). Otherwise, or if no file matches, tokenizes
+on whitespace and punctuation and writes placeholder pos-tags and lemmas,
+without syntactic layers.
+"""
+
+__author__ = 'Pablo Ruiz'
+__date__ = '19/10/26'
+__email__ = 'pabloruizfabo@gmail.com'
+
+
+import argparse
+import os
+import re
+import sys
+
+from lxml import etree
+
+
+TOKRE = re.compile(ur"\w+-?|[^\w\s]+", re.UNICODE)
+SENT_END = (u".", u"?", u"!", u"...")
+
+
+def run_argparse():
+    """CLI parser"""
+    parser = argparse.ArgumentParser(
+        description="Stand-in for the NLP chain: one-line poem in, NAF out")
+    parser.add_argument('-r', '--replay', dest='replay',
+                        help='Dir with NAF files to return when their '
+                             'tokens match the input')
+    return parser.parse_args()
+
+
+def naf_key(tokens):
+    """Key to match a text with a NAF: its tokens (or words) joined"""
+    return u"".join(tokens)
+
+
+def index_naf_dir(dn):
+    """
+    Index the NAF files in dir dn by their tokens
+    @return: dict with the path for each key (see L{naf_key})
+    """
+    idx = {}
+    for fn in sorted(os.listdir(dn)):
+        ffn = os.path.join(dn, fn)
+        tokens = [el.text or u"" for _, el in etree.iterparse(
+            ffn, tag="wf")]
+        idx.setdefault(naf_key(tokens), ffn)
+    return idx
+
+
+def make_naf(text):
+    """
+    Create NAF for text with the token and term layers only, with pos 'O' for
+    punctuation and 'N' otherwise, and lowercased word-forms as lemmas
+    @return: NAF as a utf8 string
+    """
+    root = etree.Element("NAF", version="v1.naf")
+    root.set("{http://www.w3.org/XML/1998/namespace}lang", "es")
+    etree.SubElement(root, "nafHeader")
+    textl = etree.SubElement(root, "text")
+    terms = etree.SubElement(root, "terms")
+    sent = 1
+    for nbr, match in enumerate(TOKRE.finditer(text)):
+        tok = match.group(0)
+        wf = etree.SubElement(textl, "wf", id="w{}".format(nbr + 1),
+                              offset=str(match.start()), length=str(len(tok)),
+                              sent=str(sent), para="1")
+        wf.text = tok
+        is_word = re.match(ur"\w", tok, re.UNICODE) is not None
+        term = etree.SubElement(terms, "term", id="t{}".format(nbr + 1),
+                                type="open" if is_word else "close",
+                                lemma=tok.lower(),
+                                pos="N" if is_word else "O")
+        etree.SubElement(etree.SubElement(term, "span"), "target",
+                         id="w{}".format(nbr + 1))
+        if tok in SENT_END:
+            sent += 1
+    return etree.tostring(root, xml_declaration=True, encoding="UTF-8",
+                          pretty_print=True)
+
+
+def main():
+    argus = run_argparse()
+    text = sys.stdin.read().decode("utf8")
+    if argus.replay is not None:
+        ffn = index_naf_dir(argus.replay).get(naf_key(text.split()))
+        if ffn is not None:
+            with open(ffn, "rb") as fd:
+                sys.stdout.write(fd.read())
+            return
+        sys.stderr.write("! No NAF in replay dir for input, tokenizing\n")
+    sys.stdout.write(make_naf(text))
+
+
+if __name__ == "__main__":
+    main()
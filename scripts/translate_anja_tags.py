@@ -1,5 +1,9 @@
 """
 Translate enjambment tags in results files or in evaluation files using config info.
+All tags are matched with a single regex (see
+L{utils.load_enca_tag_translations_as_single_regex}). The file is read in
+chunks of whole lines, which can be translated by a pool of processes (-w);
+they are written in the same order.
 """
 
 __author__ = 'Pablo Ruiz'
@@ -7,16 +11,15 @@ __date__ = '04/11/16'
 __email__ = 'pabloruizfabo@gmail.com'
 
 
-import codecs
+import argparse
+import itertools
+import multiprocessing
 import os
-import re
 
 # add current dir
-import inspect
 import sys
 
-here = os.path.dirname(os.path.abspath(
-    inspect.getfile(inspect.currentframe())))
+here = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(here)
 sys.path.append(os.path.join(here, os.pardir))
 
@@ -25,28 +28,92 @@ import config as cfg
 import utils as ut
 
 
-try:
-    infn = sys.argv[1]
-except IndexError:
-    infn = ""
-
-ofn = infn + ".trans.txt"
-
-
-def translate(cf, ffn):
-    etags = ut.load_enca_tag_translations_as_regex(cf)
-    with codecs.open(ffn, "r", "utf8") as ifd,\
-         codecs.open(ofn, "w", "utf8") as ofd:
-        line = ifd.readline()
-        while line:
-            nline = ut.apply_enca_tag_translation_dict_with_regex(etags, line)
-            ofd.write(nline)
-            line = ifd.readline()
+# regex and translations, set before starting the pool for workers to inherit
+TRANSLATOR = {}
+
+
+def run_argparse():
+    """
+    Run the argparse-based cli parser for options or defaults
+    """
+    parser = argparse.ArgumentParser(
+        description="Translate enjambment tags in results files",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('infile', help='Results or evaluation file')
+    parser.add_argument('-o', '--outfile',
+                        help='Output file (default: infile + .trans.txt)')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Processes translating chunks')
+    parser.add_argument('-c', '--chunk-mb', type=float, default=4,
+                        help='Size of the chunks read (MB)')
+    return parser.parse_args()
+
+
+def read_chunks(fd, size):
+    """
+    Read bytes from fd in chunks of about size bytes ending at a line-break
+    (except for the last one)
+    """
+    rest = ""
+    while True:
+        data = fd.read(size)
+        if not data:
+            break
+        data = rest + data
+        cut = data.rfind("\n") + 1
+        if not cut:
+            rest = data
+            continue
+        rest = data[cut:]
+        yield data[:cut]
+    if rest:
+        yield rest
+
+
+def translate_chunk(chunk):
+    """Translate the tags in a chunk of utf8 bytes"""
+    return ut.apply_enca_tag_translation_single_regex(
+        TRANSLATOR["regex"], TRANSLATOR["tags"],
+        chunk.decode("utf8")).encode("utf8")
+
+
+def translate(cf, ffn, ofn=None, workers=1, chunk_size=4 * 1024 * 1024):
+    """
+    Translate the tags in file ffn into ofn (ffn + .trans.txt by default)
+    @param workers: number of processes translating chunks
+    @param chunk_size: bytes read at a time
+    """
+    if ofn is None:
+        ofn = ffn + ".trans.txt"
+    TRANSLATOR["regex"], TRANSLATOR["tags"] = \
+        ut.load_enca_tag_translations_as_single_regex(cf)
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    try:
+        with ut.open_file(ffn, "r", None) as ifd, \
+                ut.open_file(ofn, "w", None) as ofd:
+            chunks = read_chunks(ifd, chunk_size)
+            if pool is None:
+                for chunk in chunks:
+                    ofd.write(translate_chunk(chunk))
+                return
+            # a few chunks per worker at a time, to bound memory
+            while True:
+                group = list(itertools.islice(chunks, 2 * workers))
+                if not group:
+                    break
+                for tchunk in pool.map(translate_chunk, group):
+                    ofd.write(tchunk)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def main():
+    argus = run_argparse()
+    translate(cfg, argus.infile, argus.outfile, argus.workers,
+              int(argus.chunk_mb * 1024 * 1024))
 
 
 if __name__ == "__main__":
-    translate(cfg, infn)
-
-
-
-
+    main()
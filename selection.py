@@ -0,0 +1,148 @@
+"""
+Select and order the files a stage processes, from a dir or archive of
+poems named after the corpus scheme 'Author__ID~~Title__ID' (e.g.
+'Agustini,_Delmira__321~~Amor__1057_annot.txt'):
+    - a custom order (sorter list: the part of the names before the first
+      '_' in the order wanted, see L{utils.file_to_ordered_list})
+    - a list of files to keep (see
+      L{utils.read_filenames_to_restrict_detection}): only those names are
+      looked up, the dir is not listed
+    - author-id and poem-id ranges, checked on the names alone
+Lists are loaded into dicts, so that ordering and filtering take a lookup
+per file.
+"""
+
+__author__ = 'Pablo Ruiz'
+__date__ = '19/10/26'
+__email__ = 'pabloruizfabo@gmail.com'
+
+
+import os
+import re
+
+# app specific imports
+import utils as ut
+
+
+# author name, author id, title, poem id (and suffix, e.g. _annot.txt)
+FILENAME_RE = re.compile(
+    r"^(?P<author>.*?)__(?P<author_id>\d+)~~(?P<title>.*)__(?P<poem_id>\d+)")
+
+
+def filename_metadata(fn):
+    """
+    Metadata in file name fn
+    @return: dict with 'author', 'author_id' (int), 'title' and 'poem_id'
+    (int), None if fn does not follow the scheme
+    """
+    match = FILENAME_RE.match(fn)
+    if match is None:
+        return None
+    meta = match.groupdict()
+    meta["author_id"] = int(meta["author_id"])
+    meta["poem_id"] = int(meta["poem_id"])
+    return meta
+
+
+def parse_id_ranges(spec):
+    """
+    Ranges in spec, e.g. '321,400-420' gives [(321, 321), (400, 420)]
+    @raise ValueError: if spec is not comma-separated ids or id ranges
+    """
+    ranges = []
+    for part in spec.split(","):
+        bounds = part.strip().split("-")
+        if len(bounds) > 2 or not all(bound.isdigit() for bound in bounds):
+            raise ValueError(u"Bad id range [{}] in [{}]".format(part, spec))
+        ranges.append((int(bounds[0]), int(bounds[-1])))
+    return ranges
+
+
+def in_ranges(nbr, ranges):
+    """True if nbr is in any of the (low, high) ranges"""
+    return any(low <= nbr <= high for low, high in ranges)
+
+
+def list_index(items):
+    """Dict with the position of the first occurrence of each item"""
+    index = {}
+    for pos, item in enumerate(items):
+        index.setdefault(item, pos)
+    return index
+
+
+def sorter_key(index):
+    """
+    Sort key for file names, from the index for a sorter list (see
+    L{list_index}), by the part of the names before the first '_'
+    @raise ValueError: for a name not in the list
+    """
+    def key(fn):
+        try:
+            return index[re.sub("_.*", "", fn)]
+        except KeyError:
+            raise ValueError(u"{} is not in the sorter list".format(
+                repr(fn)))
+    return key
+
+
+def kept_files(idn, keep):
+    """
+    Names in list keep found in dir idn (possibly compressed, see
+    L{utils.find_file}), in list order
+    @return: list of names, and list of those not found
+    """
+    found, missing = [], []
+    for fn in keep:
+        ffn = ut.find_file(os.path.join(idn, fn))
+        if ut.path_exists(ffn):
+            found.append(fn)
+        else:
+            missing.append(fn)
+    return found, missing
+
+
+def select_files(idn, sorter_list_fn=None, restrict_to_list_fn=None,
+                 authors=None, poems=None):
+    """
+    Files in idn to process, in order
+    @param idn: dir or archive (see L{utils.list_dir})
+    @param sorter_list_fn: path to a list for custom sorting order, else
+    sorted by name (or in list order if restrict_to_list_fn is given)
+    @param restrict_to_list_fn: path to a list of the files to keep (see
+    L{utils.read_filenames_to_restrict_detection}). Files in the list but
+    not in idn are reported and skipped
+    @param authors: author-id ranges to keep (see L{parse_id_ranges})
+    @param poems: poem-id ranges to keep
+    @return: list of file names
+    """
+    if restrict_to_list_fn is not None:
+        keep = list_index(ut.read_filenames_to_restrict_detection(
+            restrict_to_list_fn))
+        # without duplicates, in list order
+        fns, missing = kept_files(idn, sorted(keep, key=keep.get))
+        if missing:
+            print u"! {} files in list not found in input dir, e.g. {}".format(
+                len(missing), repr(missing[0]))
+    else:
+        fns = ut.list_dir(idn)
+    if authors is not None or poems is not None:
+        selected = []
+        for fn in fns:
+            meta = filename_metadata(fn)
+            if meta is None:
+                continue
+            if authors is not None and not in_ranges(meta["author_id"],
+                                                     authors):
+                continue
+            if poems is not None and not in_ranges(meta["poem_id"], poems):
+                continue
+            selected.append(fn)
+        fns = selected
+    if sorter_list_fn is not None:
+        # custom (files to skip will move to end, they start with '__')
+        return sorted(fns, key=sorter_key(list_index(
+            ut.file_to_ordered_list(sorter_list_fn))))
+    if restrict_to_list_fn is not None:
+        return fns
+    return sorted(fns)
@@ -0,0 +1,315 @@
+# coding: utf-8
+
+"""
+Run enjambment detection as a long-lived local service, so that annotating
+a single poem does not pay for starting Python, importing KafNafParserPy
+and loading lexicons and tag maps at each call.
+Listens over HTTP on a local TCP port, or on a Unix socket (-u).
+    - POST /detect: JSON object with 'text' (the poem, one line per line),
+      optionally 'id' and 'naf' (NAF for the text joined into a single line,
+      as in L{utils.get_line_positions}). Without 'naf', the text is parsed
+      with the NLP command (-m); text/plain bodies are also accepted.
+      Answers with the detection results as JSON (see L{annotate}).
+    - GET /stats: request counts and p50/p95 latency per stage ('queue' is
+      the wait for a free worker, included in 'total')
+    - GET /health
+At most -w requests are processed at once, others wait up to -q seconds
+and are rejected (503) after that.
+For tests without the NLP servers, use scripts/nlp_standin.py as the NLP
+command.
+"""
+
+__author__ = 'Pablo Ruiz'
+__date__ = '19/10/26'
+__email__ = 'pabloruizfabo@gmail.com'
+
+
+import argparse
+import BaseHTTPServer
+import collections
+import io
+import json
+import os
+import SocketServer
+import threading
+import time
+
+from KafNafParserPy import KafNafParser as np
+
+# add current dir
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(here)
+
+# app specific imports
+import config as cfg
+import detect as dt
+import extract_pos as ep
+import utils as ut
+
+
+# latencies kept per stage, to compute percentiles
+LATENCY_WINDOW = 1000
+STAGES = ("total", "queue", "nlp", "pos", "detect")
+
+STATS = {"requests": 0, "errors": 0, "rejected": 0, "inflight": 0,
+         "limit": 1, "started": time.time()}
+LATENCIES = dict((stage, collections.deque(maxlen=LATENCY_WINDOW))
+                 for stage in STAGES)
+# guards STATS and LATENCIES, and wakes up requests waiting for a slot
+STATS_LOCK = threading.Condition()
+
+
+def run_argparse():
+    """
+    Run the argparse-based cli parser for options or defaults
+    """
+    parser = argparse.ArgumentParser(
+        description="Serve enjambment detection over HTTP",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-H', '--host', default='127.0.0.1',
+                        help='Host to listen on')
+    parser.add_argument('-p', '--port', type=int, default=8090,
+                        help='Port to listen on')
+    parser.add_argument('-u', '--socket', dest='socket',
+                        help='Listen on this Unix socket instead of a port')
+    parser.add_argument('-w', '--workers', type=int, default=4,
+                        help='Max requests processed at once')
+    parser.add_argument('-q', '--wait', type=float, default=10,
+                        help='Seconds a request can wait for a free worker')
+    parser.add_argument('-m', '--nlpcmd',
+                        help='Shell command reading a one-line poem on stdin '
+                             'and writing NAF to stdout (default: the IXA '
+                             'clients, from run_nlp.sh --print-cmd def '
+                             'only_deps)')
+    parser.add_argument('-c', '--constituency', action='store_true',
+                        help='Use constituency info from NLP output')
+    parser.add_argument('-d', '--dependency', action='store_true',
+                        help='Use dependency info from NLP output')
+    parser.add_argument('-l', '--lang', dest='lang', default='en',
+                        help='Language for enjambment tags (English or Spanish)')
+    parser.add_argument('-5', '--m14',
+                        help='Allow rule application above 14 lines',
+                        action='store_true')
+    parser.add_argument('-k', '--warmup', action='store_true',
+                        help='Run the NLP command once before serving')
+    parser.set_defaults(constituency=cfg.USE_CONSTITUENCY,
+                        dependency=cfg.USE_DEP, m14=cfg.MORE14)
+    return parser.parse_args()
+
+
+def annotate(text, naf=None, pid=u"poem", nlpcmd=None, lxinfo=None,
+             lang="en", useconst=cfg.USE_CONSTITUENCY, usedep=cfg.USE_DEP,
+             m14=cfg.MORE14):
+    """
+    Run the complete workflow on a poem in memory: line positions (as in
+    prepro), NLP (unless NAF given), pos-tags per line (as in extract_pos)
+    and enjambment detection.
+    @param text: the poem, one line per line
+    @param naf: NAF for the poem if already available (utf8 string)
+    @param pid: poem-id, used in results and logs
+    @param nlpcmd: NLP command (see L{utils.run_nlp}), L{utils.nlp_command}
+    if None
+    @param lxinfo: lexicons and tag maps (see L{detect.load_resources})
+    @return: tuple with the results (dict with poem 'id', 'lines' with their
+    text and tags, 'spans' with the enjambed line pairs) and a dict with the
+    time in seconds for each stage
+    """
+    timings = {}
+    lines = [ll.strip() for ll in text.splitlines()]
+    ntext, positions = ut.get_line_positions(lines)
+    # as in extract_pos.read_positions: last match, 1-indexed
+    lnposis = dict((nbr + 1, posis[-1]) for nbr, posis in positions.items()
+                   if posis)
+    if naf is None:
+        start = time.time()
+        naf = ut.run_nlp(ntext, nlpcmd or ut.nlp_command())
+        timings["nlp"] = time.time() - start
+    if isinstance(naf, unicode):
+        naf = naf.encode("utf8")
+    start = time.time()
+    tree = np(io.BytesIO(naf))
+    ln2terms = ep.tag_tree_by_line(tree, lnposis)
+    toks = [[tuple(info) for info in infos]
+            for lnbr, infos in sorted(ln2terms.items())]
+    timings["pos"] = time.time() - start
+    start = time.time()
+    result = next(dt.detect_many([(pid, toks, tree)], lxinfo, lang, useconst,
+                                 usedep, m14))
+    timings["detect"] = time.time() - start
+    ana = result["annotations"]
+    olines = []
+    for idx, toklist in enumerate(toks):
+        # no 'B' allowed in last line, as in the output files
+        tags = [{"position": an[0], "type": an[1], "rule": an[2]}
+                for an in ana.get(idx, [])
+                if not (an[0] == "B" and idx == len(toks) - 1)]
+        olines.append({"line": idx + 1,
+                       "text": u" ".join(tok[0] for tok in toklist),
+                       "tags": tags})
+    spans = [{"start": first, "end": second, "type": etype, "rule": rid}
+             for first, second, etype, rid in result["spans"]]
+    return {"id": pid, "lines": olines, "spans": spans}, timings
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile pct (0-100) for values, None if no values"""
+    if not values:
+        return None
+    svalues = sorted(values)
+    rank = max(int(round(pct / 100.0 * len(svalues))) - 1, 0)
+    return svalues[min(rank, len(svalues) - 1)]
+
+
+def stats_report():
+    """Request counts, plus count and p50/p95 latency (ms) per stage"""
+    with STATS_LOCK:
+        report = dict(STATS)
+        latencies = dict((stage, list(vals))
+                         for stage, vals in LATENCIES.items())
+    report["uptime_s"] = round(time.time() - report.pop("started"), 3)
+    report["latency_ms"] = {}
+    for stage, vals in latencies.items():
+        report["latency_ms"][stage] = {"count": len(vals)}
+        for pct in (50, 95):
+            secs = percentile(vals, pct)
+            report["latency_ms"][stage]["p{}".format(pct)] = (
+                None if secs is None else round(1000 * secs, 3))
+    return report
+
+
+def acquire_slot(timeout):
+    """Wait up to timeout seconds for a free worker, True if got one"""
+    deadline = time.time() + timeout
+    with STATS_LOCK:
+        while STATS["inflight"] >= STATS["limit"]:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                STATS["rejected"] += 1
+                return False
+            STATS_LOCK.wait(remaining)
+        STATS["inflight"] += 1
+        return True
+
+
+def release_slot(timings=None, error=False):
+    """Free a worker, recording latencies for the request"""
+    with STATS_LOCK:
+        STATS["inflight"] -= 1
+        STATS["requests"] += 1
+        if error:
+            STATS["errors"] += 1
+        for stage, secs in (timings or {}).items():
+            LATENCIES[stage].append(secs)
+        STATS_LOCK.notify()
+
+
+class DetectHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Handle requests to the service (see module doc for endpoints)"""
+
+    def send_json(self, status, obj):
+        body = json.dumps(obj)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self.send_json(200, stats_report())
+        elif self.path == "/health":
+            self.send_json(200, {"status": "ok"})
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/detect":
+            self.send_json(404, {"error": "not found"})
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            if self.headers.get("Content-Type", "").startswith("text/plain"):
+                request = {"text": body.decode("utf8")}
+            else:
+                request = json.loads(body.decode("utf8"))
+            assert "text" in request
+        except (ValueError, AssertionError):
+            self.send_json(400, {"error": "expected JSON with 'text', "
+                                          "or a text/plain poem"})
+            return
+        # total latency includes the wait for a free worker (stage 'queue')
+        start = time.time()
+        if not acquire_slot(self.server.argus.wait):
+            self.send_json(503, {"error": "too many requests"})
+            return
+        queued = time.time() - start
+        argus = self.server.argus
+        try:
+            result, timings = annotate(
+                request["text"], request.get("naf"), request.get("id", u"poem"),
+                argus.nlpcmd, self.server.lxinfo, argus.lang,
+                argus.constituency, argus.dependency, argus.m14)
+        except Exception as exc:
+            release_slot(error=True)
+            self.send_json(500, {"error": unicode(exc)})
+            return
+        timings["queue"] = queued
+        timings["total"] = time.time() - start
+        release_slot(timings)
+        result["timing_ms"] = dict((stage, round(1000 * secs, 3))
+                                   for stage, secs in timings.items())
+        self.send_json(200, result)
+
+    def log_message(self, format, *args):
+        # no client address on Unix sockets
+        if isinstance(self.client_address, tuple):
+            client = self.client_address[0]
+        else:
+            client = "unix"
+        sys.stderr.write("{} - - [{}] {}\n".format(
+            client, self.log_date_time_string(), format % args))
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(SocketServer.ThreadingMixIn,
+                              SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def main():
+    argus = run_argparse()
+    if argus.nlpcmd is None:
+        argus.nlpcmd = ut.nlp_command()
+    STATS["limit"] = argus.workers
+    if argus.socket is not None:
+        if os.path.exists(argus.socket):
+            os.remove(argus.socket)
+        server = ThreadingUnixHTTPServer(argus.socket, DetectHandler)
+        where = argus.socket
+    else:
+        server = ThreadingHTTPServer((argus.host, argus.port), DetectHandler)
+        where = u"{}:{}".format(argus.host, argus.port)
+    server.argus = argus
+    # load resources now rather than on first request
+    server.lxinfo = dt.load_resources()
+    if argus.warmup:
+        ut.run_nlp(u"Warm up .", argus.nlpcmd)
+    print u"- Serving detection on [{}]".format(where)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if argus.socket is not None and os.path.exists(argus.socket):
+            os.remove(argus.socket)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+# coding: utf-8
+
+"""
+Run detection with several configurations in one pass over a corpus: each
+poem is read and its NAF parsed once, and the rules are applied for every
+combination of the values given for constituency (-c), dependencies (-d),
+rule application beyond 14 lines (-5), tag language (-l) and tag
+normalization (-z). Poems can also be read from a feature store (-s, see
+L{feature_store}).
+Outputs for each variant are written as detect.py does, to the dir and
+single file named as in L{config.resudir} and L{config.single_file} under
+the output dir (-o). Variants that differ from the defaults in the other
+options have them added to the names (e.g. _m14_1, _es, _norm_0).
+"""
+
+__author__ = 'Pablo Ruiz'
+__date__ = '19/10/26'
+__email__ = 'pabloruizfabo@gmail.com'
+
+
+import argparse
+import itertools
+import os
+import re
+import time
+
+# add current dir
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(here)
+
+# app specific imports
+import config as cfg
+import detect as dt
+import utils as ut
+
+
+BOOLS = {"0": False, "1": True}
+
+
+def run_argparse():
+    """
+    Run the argparse-based cli parser for options or defaults
+    """
+    parser = argparse.ArgumentParser(
+        description="Apply enjambment detection with several configurations",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-b', '--batch', dest='batchname', default="DEF",
+                        help='String representing the name of the batch. '
+                             '(Used to name output files etc.)')
+    parser.add_argument('-i', '--input', dest='inname',
+                        help='Input dir (contains PoS and term-id annotations)')
+    parser.add_argument('-n', '--nlpdir',
+                        help='Dir containing NLP output (NAF from IXA pipes)')
+    parser.add_argument('-s', '--store',
+                        help='Read poems from this feature store instead '
+                             '(see feature_store.py)')
+    parser.add_argument('-o', '--outdir',
+                        help='Dir for the outputs of all variants (default: '
+                             'the batch dir in config.baseoutdir)')
+    parser.add_argument('-c', '--constituency', nargs='+', choices=["0", "1"],
+                        default=[str(int(cfg.USE_CONSTITUENCY))],
+                        help='Use constituency info (0, 1 or both)')
+    parser.add_argument('-d', '--dependency', nargs='+', choices=["0", "1"],
+                        default=[str(int(cfg.USE_DEP))],
+                        help='Use dependency info (0, 1 or both)')
+    parser.add_argument('-5', '--m14', nargs='+', choices=["0", "1"],
+                        default=[str(int(cfg.MORE14))],
+                        help='Allow rule application above 14 lines')
+    parser.add_argument('-l', '--lang', nargs='+', choices=["en", "es"],
+                        default=["en"],
+                        help='Language for enjambment tags')
+    parser.add_argument('-z', '--norm', nargs='+', choices=["0", "1"],
+                        default=[str(int(cfg.NORM_ETAGS))],
+                        help='Normalize enjambment tags')
+    parser.add_argument('-u', '--ruleid', action='store_true',
+                        help='Print out rule ids')
+    parser.add_argument('-p', '--poemfiles', action='store_true',
+                        help='Also write the results file for each poem')
+    parser.set_defaults(ruleid=cfg.PRINT_RULEIDS)
+    return parser.parse_args()
+
+
+def variants(consts, deps, m14s, langs, norms):
+    """
+    Combinations of the values for each option
+    @return: list of dicts with 'useconst', 'usedep', 'm14', 'lang' and
+    'norm' for each variant
+    """
+    return [dict(zip(("useconst", "usedep", "m14", "lang", "norm"), combo))
+            for combo in itertools.product(consts, deps, m14s, langs, norms)]
+
+
+def variant_paths(outdir, batch, variant):
+    """
+    Output dir for the poems and single results file for a variant (see
+    L{config.resudir}, L{config.single_file})
+    """
+    names = dict(batch=batch, useconst=int(variant["useconst"]),
+                 usedep=int(variant["usedep"]))
+    sfx = u""
+    if variant["m14"] != cfg.MORE14:
+        sfx += u"_m14_{}".format(int(variant["m14"]))
+    if variant["lang"] != "en":
+        sfx += u"_{}".format(variant["lang"])
+    if variant["norm"] != cfg.NORM_ETAGS:
+        sfx += u"_norm_{}".format(int(variant["norm"]))
+    # byte strings, like the poem file names joined to them
+    return (os.path.join(outdir, (cfg.resudir.format(**names) +
+                                  sfx).encode("utf8")),
+            os.path.join(outdir, re.sub(ur"\.txt$", sfx + u".txt",
+                                        cfg.single_file.format(**names)
+                                        ).encode("utf8")))
+
+
+def read_poems(idn, nafdir, useconst):
+    """
+    Read the poems in idn and their NAF in nafdir, and extract the features
+    the rules need from the NAF (see L{detect.naf_features})
+    @return: generator of (filename, tokens, features)
+    """
+    todo = [fn for fn in sorted(ut.list_dir(idn)) if not fn.startswith("__")]
+    for fn, toks, naffn in dt.read_poems(todo, idn, nafdir):
+        yield fn, toks, dt.naf_features(
+            toks, ut.read_naf(naffn.replace(".txt", ".xml")), useconst)
+
+
+def sweep(poems, outdir, batch, todo, rids=False, poemfiles=False):
+    """
+    Apply the rules to each poem for all variants
+    @param poems: iterable of (filename, tokens, features), see L{read_poems}
+    @param todo: variants, as output by L{variants}
+    @param poemfiles: also write the results file for each poem
+    @return: paths for the single results file of each variant
+    """
+    lxinfo = dt.load_resources()
+    paths = [variant_paths(outdir, batch, variant) for variant in todo]
+    outs = []
+    try:
+        for odn, single_f in paths:
+            if poemfiles:
+                ut.make_output_dir(odn)
+            outs.append(dt.open_corpus_outputs(single_f, rids=rids))
+        for fn, toks, feats in poems:
+            for variant, (odn, single_f), vouts in zip(todo, paths, outs):
+                ana = dt.detect(fn, None, toks, feats, lxinfo, variant["lang"],
+                                variant["useconst"], variant["usedep"],
+                                variant["m14"], norm=variant["norm"])
+                result = {"id": fn, "tokens": toks, "annotations": ana,
+                          "spans": dt.standoff_spans(ana)}
+                ofn = None
+                if poemfiles:
+                    ofn = os.path.join(
+                        odn, fn.replace("_annot.txt", "_results.txt") +
+                        ut.compression_ext(single_f))
+                dt.write_poem_outputs(vouts, result, ofn, rids=rids)
+    finally:
+        for vouts in outs:
+            dt.close_corpus_outputs(vouts)
+        ut.close_archives()
+    return [single_f for odn, single_f in paths]
+
+
+def main():
+    argus = run_argparse()
+    start = time.time()
+    todo = variants([BOOLS[val] for val in argus.constituency],
+                    [BOOLS[val] for val in argus.dependency],
+                    [BOOLS[val] for val in argus.m14], argus.lang,
+                    [BOOLS[val] for val in argus.norm])
+    outdir = argus.outdir or os.path.join(cfg.baseoutdir, argus.batchname)
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    if argus.store is not None:
+        import feature_store as fs
+        store = fs.read_store(argus.store)
+        poems = fs.read_poems(store)
+    else:
+        if argus.inname is None or argus.nlpdir is None:
+            print "Give the input (-i) and NLP (-n) dirs, or a store (-s)"
+            sys.exit(2)
+        poems = read_poems(argus.inname, argus.nlpdir,
+                           any(variant["useconst"] for variant in todo))
+    written = sweep(poems, outdir, argus.batchname, todo, rids=argus.ruleid,
+                    poemfiles=argus.poemfiles)
+    for single_f in written:
+        print u"- Wrote single file to [{}]".format(single_f)
+    print u"- {} variants in {:.1f} s".format(len(todo), time.time() - start)
+
+
+if __name__ == "__main__":
+    main()
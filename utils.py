@@ -5,39 +5,422 @@ __date__ = '10/08/16'
 __email__ = 'pabloruizfabo@gmail.com'
 
 
+import array
 import codecs
-from lxml import etree
+import gzip
+import io
+import marshal
 import os
 import re
 from string import zfill
+import subprocess
+
+# lxml, KafNafParserPy, zipfile and tarfile are imported where needed, so
+# that tools start fast when they don't use them
 
 
 # add current dir to sys.path
-import inspect
 import sys
 
-basedir = os.path.dirname(os.path.abspath(
-    inspect.getfile(inspect.currentframe())))
+basedir = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(basedir)
 
 import config as cfg
+import metrics as mt
+import profiling as pf
 
 
 nspaces = {'tei': 'http://www.tei-c.org/ns/1.0'}
 
+# format version for the lexicon snapshot (see L{compile_lexicons})
+LEXICON_SNAPSHOT_VERSION = 1
+# extensions for compressed files, see L{open_file}
+COMPRESSED_EXTS = (".gz", ".zst")
+# extensions for archives that can stand for a dir, see L{split_archive_path}
+ARCHIVE_EXTS = (".zip", ".tar")
+# archives open for reading: (archive, member by file name) per path
+OPEN_ARCHIVES = {}
+# zip archives open for writing (see L{make_output_dir})
+WRITE_ARCHIVES = {}
+# interned pos-tags: L{TaggedPoem} stores codes for them (see L{pos_code})
+POS_TAGS = []
+POS_CODES = {}
+
+
+class ZstdFile(object):
+    """
+    Read or write a .zst file through the zstd command (L{config.zstd}),
+    with the file methods used in the app
+    """
+
+    def __init__(self, fn, mode="rb"):
+        self.name = fn
+        if mode.startswith("r"):
+            self.out = None
+            self.proc = subprocess.Popen([cfg.zstd, "-dcq", fn],
+                                         stdout=subprocess.PIPE)
+            self.fd = self.proc.stdout
+        else:
+            # appending a new frame keeps the file valid
+            self.out = open(fn, mode[0] + "b")
+            self.proc = subprocess.Popen(
+                [cfg.zstd, "-cq", "-{}".format(cfg.ZSTD_LEVEL)],
+                stdin=subprocess.PIPE, stdout=self.out)
+            self.fd = self.proc.stdin
+
+    def read(self, size=-1):
+        return self.fd.read(size)
+
+    def readline(self, size=-1):
+        return self.fd.readline(size)
+
+    def readlines(self, sizehint=-1):
+        return self.fd.readlines(sizehint)
+
+    def __iter__(self):
+        return iter(self.fd)
+
+    def write(self, data):
+        self.fd.write(data)
+
+    def flush(self):
+        self.fd.flush()
+
+    def close(self):
+        if self.fd.closed:
+            return
+        self.fd.close()
+        retcode = self.proc.wait()
+        if self.out is not None:
+            self.out.close()
+        # reading stops early if file not consumed, that is not an error
+        if retcode != 0 and (self.out is not None or retcode > 0):
+            raise IOError(u"zstd failed [{}] for [{}]".format(
+                retcode, self.name))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def compression_ext(fn):
+    """Compression extension for fn (see L{COMPRESSED_EXTS}), '' if none"""
+    for ext in COMPRESSED_EXTS:
+        if fn.endswith(ext):
+            return ext
+    return ""
+
+
+def strip_compression_ext(fn):
+    """fn without its compression extension if any"""
+    ext = compression_ext(fn)
+    return fn[0:-len(ext)] if ext else fn
+
+
+def find_file(fn):
+    """
+    Path to fn, or to a compressed version of it (fn plus an extension in
+    L{COMPRESSED_EXTS}) if only that exists. fn itself if none exists
+    """
+    if path_exists(fn):
+        return fn
+    for ext in COMPRESSED_EXTS:
+        if path_exists(fn + ext):
+            return fn + ext
+    return fn
+
+
+class ArchiveMemberWriter(object):
+    """
+    Write a member of a zip archive open for writing (see
+    L{make_output_dir}); the member is added when closed
+    """
+
+    def __init__(self, archive, name):
+        self.archive = archive
+        self.name = name
+        self.buf = io.BytesIO()
+
+    def write(self, data):
+        self.buf.write(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.buf is None:
+            return
+        import zipfile
+        ext = compression_ext(self.name)
+        # no point deflating members already compressed
+        WRITE_ARCHIVES[self.archive].writestr(
+            self.name, compress(self.buf.getvalue(), ext),
+            zipfile.ZIP_STORED if ext else zipfile.ZIP_DEFLATED)
+        self.buf = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def compress(data, ext):
+    """Compress bytes data as per compression extension ext"""
+    if ext == ".gz":
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode="wb",
+                           compresslevel=cfg.GZIP_LEVEL) as gzfd:
+            gzfd.write(data)
+        return buf.getvalue()
+    if ext == ".zst":
+        proc = subprocess.Popen(
+            [cfg.zstd, "-cq", "-{}".format(cfg.ZSTD_LEVEL)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        return proc.communicate(data)[0]
+    return data
+
+
+def decompress(data, ext):
+    """Decompress bytes data as per compression extension ext"""
+    if ext == ".gz":
+        return gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+    if ext == ".zst":
+        proc = subprocess.Popen([cfg.zstd, "-dcq"], stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE)
+        return proc.communicate(data)[0]
+    return data
+
+
+def is_archive(path):
+    """True if path is a zip or tar archive (see L{ARCHIVE_EXTS})"""
+    return path.endswith(ARCHIVE_EXTS) and os.path.isfile(path)
+
+
+def split_archive_path(path):
+    """
+    Archives stand for dirs, and their members for files in the dir, so
+    that os.path.join(archive, name) gives a path to a member
+    @return: (archive path, member name) if path is in an archive,
+    else (None, path)
+    """
+    archive, name = os.path.split(path)
+    if archive in WRITE_ARCHIVES or is_archive(archive):
+        return archive, name
+    return None, path
+
+
+def archive_members(archive):
+    """
+    Open archive for reading (only once per process) and index its members
+    by file name. Members in subdirs in the archive are listed by their file
+    name only
+    @return: tuple with open archive and dict with member for each file name
+    """
+    if archive not in OPEN_ARCHIVES:
+        import tarfile
+        import zipfile
+        members = {}
+        if archive.endswith(".zip"):
+            arch = zipfile.ZipFile(archive)
+            for info in arch.infolist():
+                if not info.filename.endswith("/"):
+                    members.setdefault(os.path.basename(info.filename), info)
+        else:
+            arch = tarfile.open(archive)
+            for info in arch.getmembers():
+                if info.isfile():
+                    members.setdefault(os.path.basename(info.name), info)
+        # names as in os.listdir with a str path
+        members = dict((name.encode("utf8") if isinstance(name, unicode)
+                        else name, info) for name, info in members.items())
+        OPEN_ARCHIVES[archive] = (arch, members)
+    return OPEN_ARCHIVES[archive]
+
+
+def read_member(archive, name):
+    """Read the bytes for member name of archive"""
+    arch, members = archive_members(archive)
+    if isinstance(name, unicode):
+        name = name.encode("utf8")
+    if name not in members:
+        raise IOError(u"No member [{}] in [{}]".format(
+            name.decode("utf8"), archive))
+    if hasattr(arch, "infolist"):
+        return arch.read(members[name])
+    return arch.extractfile(members[name]).read()
+
+
+def list_dir(dn):
+    """os.listdir for dn, which can be an archive (see L{split_archive_path})"""
+    if is_archive(dn):
+        return archive_members(dn)[1].keys()
+    return os.listdir(dn)
+
+
+def path_exists(path):
+    """os.path.exists for path, which can be in an archive"""
+    archive, name = split_archive_path(path)
+    if archive is None:
+        return os.path.exists(path)
+    if archive in WRITE_ARCHIVES:
+        return False
+    if isinstance(name, unicode):
+        name = name.encode("utf8")
+    return name in archive_members(archive)[1]
+
+
+def make_output_dir(odn):
+    """
+    Create output dir odn if needed. If odn ends in .zip, create a zip
+    archive instead (replacing any previous one), where files opened with
+    L{open_file} in odn will be written. Call L{close_archives} when done
+    """
+    if odn.endswith(".zip"):
+        import zipfile
+        OPEN_ARCHIVES.pop(odn, None)
+        dn = os.path.dirname(odn)
+        if dn and not os.path.exists(dn):
+            os.makedirs(dn)
+        WRITE_ARCHIVES[odn] = zipfile.ZipFile(
+            odn, "w", zipfile.ZIP_DEFLATED, allowZip64=True)
+    elif not os.path.exists(odn):
+        os.makedirs(odn)
+
+
+def atomic_write(path, data):
+    """
+    Write byte string data to path via a temporary file in the same dir that
+    then replaces it, so that readers never see a partial file. The
+    temporary file is removed if writing fails
+    """
+    tmpfn = path + ".{}.tmp".format(os.getpid())
+    try:
+        with open(tmpfn, "wb") as fd:
+            fd.write(data)
+        os.rename(tmpfn, path)
+    except (IOError, OSError):
+        if os.path.exists(tmpfn):
+            os.remove(tmpfn)
+        raise
+
+
+def close_archives():
+    """Close the archives opened for writing (see L{make_output_dir})"""
+    for odn in WRITE_ARCHIVES.keys():
+        WRITE_ARCHIVES.pop(odn).close()
+
+
+def open_file(fn, mode="r", encoding="utf8"):
+    """
+    Open fn like codecs.open, but compressing or decompressing gzip or
+    zstandard files, as per the extension of fn (.gz or .zst).
+    fn can be a member of an archive (see L{split_archive_path}): it is read
+    from memory, or written when closed if the archive was created with
+    L{make_output_dir}
+    @param mode: r, w or a (not for archive members)
+    @param encoding: encoding for the text, None to read or write bytes
+    """
+    ext = compression_ext(fn)
+    archive, name = split_archive_path(fn)
+    if archive is not None:
+        if mode.startswith("r"):
+            fd = io.BytesIO(decompress(read_member(archive, name), ext))
+        elif mode.startswith("w") and archive in WRITE_ARCHIVES:
+            fd = ArchiveMemberWriter(archive, name)
+        else:
+            raise IOError(u"Cannot open [{}] in [{}] with mode {}".format(
+                name, archive, mode))
+    elif not ext:
+        if encoding is None:
+            return open(fn, mode[0] + "b")
+        return codecs.open(fn, mode[0], encoding)
+    elif ext == ".gz":
+        fd = gzip.open(fn, mode[0] + "b", cfg.GZIP_LEVEL)
+    else:
+        fd = ZstdFile(fn, mode[0] + "b")
+    if encoding is None:
+        return fd
+    info = codecs.lookup(encoding)
+    srw = codecs.StreamReaderWriter(fd, info.streamreader, info.streamwriter)
+    srw.encoding = encoding
+    return srw
+
+
+def find_naf(fn):
+    """
+    Path to NAF file fn, or to a version of it ending in L{config.nafext}
+    instead of its extension, either of them possibly compressed (see
+    L{find_file}). fn itself if none exists
+    """
+    base = strip_compression_ext(fn)
+    for cand in (base, os.path.splitext(base)[0] + cfg.nafext):
+        path = find_file(cand)
+        if path_exists(path):
+            return path
+    return fn
+
+
+def nlp_command(postype="def", onlydeps=True):
+    """
+    Shell command for the NLP clients, as built by L{config.nlprunner}
+    (run_nlp.sh --print-cmd) for the servers it starts
+    @param postype: 'def' or 'alt' pos-tagger (see run_nlp.sh)
+    @param onlydeps: dependencies only, no SRL
+    @return: command reading a poem on a single line on stdin and writing
+    NAF to stdout (see L{run_nlp})
+    """
+    args = ["bash", cfg.nlprunner, "--print-cmd", postype]
+    if onlydeps:
+        args.append("only_deps")
+    return subprocess.check_output(args).strip()
+
+
+def run_nlp(text, cmd):
+    """
+    Parse text with NLP command cmd
+    @param text: poem on a single line
+    @param cmd: shell command reading text on stdin and writing NAF to stdout
+    @return: NAF output (utf8 string)
+    """
+    proc = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate(text.encode("utf8"))
+    if proc.returncode != 0 or not out.strip():
+        raise RuntimeError(u"NLP command failed [{}]: {}".format(
+            proc.returncode, err.decode("utf8", "replace").strip()))
+    return out
+
+
+def read_naf(fn):
+    """
+    Parse NAF file fn, which can be compressed (see L{find_naf}) or in an
+    archive (see L{split_archive_path})
+    @rtype: L{KafNafParserPy.KafNafParser}
+    """
+    from KafNafParserPy import KafNafParser as np
+    fn = find_naf(fn)
+    if not compression_ext(fn) and split_archive_path(fn)[0] is None:
+        return np(fn)
+    with open_file(fn, "r", encoding=None) as fd:
+        return np(fd)
+
 
 def read_dir_into_ttl2txt_dict(idir):
     """
     Read a directory of plain text poems where the filename represents a title
-    into a title2text dict.
+    into a title2text dict. The directory can also be a zip or tar archive
+    (see L{split_archive_path}).
     Filename format (not exploiting the format for now, here just for info):
         - AuthorLast_First__AuthorID~~Title__TitleID.txt or
         - AuthorLast_First__AuthorID~~Title__TitleID__Subtitle__SubtitleID.txt
     """
     ttl2txt = {}
-    for fn in sorted(os.listdir(idir)):
+    for fn in sorted(list_dir(idir)):
         ffn = os.path.join(idir, fn)
-        with codecs.open(ffn, "r", "utf8") as ifd:
+        with open_file(ffn, "r", "utf8") as ifd:
             # only strip newline in case leading/trailing spaces in text
             #text = [ll.strip("\r\n") for ll in ifd]
             text = [ll.strip() for ll in ifd]
@@ -88,6 +471,7 @@ def tei_lgl2text(xfn, mynspaces=nspaces):
     @return: tuple with title and lines of the poem
     @rtype: tuple
     """
+    from lxml import etree
     lines = []
     tree = etree.parse(xfn)
     try:
@@ -131,6 +515,30 @@ def escape4regex(txt):
     return txt
 
 
+def get_line_positions(text):
+    """
+    Join the lines of a poem into a single line, and find the positions of
+    each non-empty line in the joined text (see
+    L{merge_lines_and_get_line_positions})
+    @param text: list with the lines of the poem
+    @return: tuple with the joined text and a dict with a list of
+    (start, end) offsets per line number (0-indexed, empty lines not counted)
+    """
+    ntext = " ".join(text)
+    positions = {}
+    # text with empty lines removed, to avoid incorrect line numbers
+    text_without_empty_lines = [li for li in text if len(li) > 0]
+    for nbr, line in enumerate(text_without_empty_lines):
+        # store more than one position for a line that repeats, but
+        # not finding which line numbers are equivalent for now
+        eline = escape4regex(line)
+        # search, in text including empties, positions for non-empties
+        positions[nbr] = [(m.start(), m.end())
+                          for m in re.finditer(eline, ntext)
+                          if len(eline) > 0]
+    return ntext, positions
+
+
 def merge_lines_and_get_line_positions(t2t, odir, logdir, batchname):
     """
     Remove line-breaks from poems so that can run nlp tools on them, but
@@ -151,28 +559,21 @@ def merge_lines_and_get_line_positions(t2t, odir, logdir, batchname):
     for ti, text in t2t.items():
         linepositions.setdefault(ti, {})
         # text including empty lines
-        ntext = " ".join(text)
+        ntext, positions = get_line_positions(text)
         if len(ntext.strip()) == 0:
             print u"! Empty text".format(ti)
+            mt.poem_done(ti, error=u"Empty text")
             continue
-        # text with empty lines removed, to avoid incorrect line numbers
-        text_without_empty_lines = [li for li in text if len(li) > 0]
-        for nbr, line in enumerate(text_without_empty_lines):
-            # store more than one position for a line that repeats, but
-            # not finding which line numbers are equivalent for now
-            eline = escape4regex(line)
-            # search, in text including empties, positions for non-empties
-            positions = [(m.start(), m.end())
-                         for m in re.finditer(eline, ntext)
-                         if len(eline) > 0]
-            linepositions[ti][nbr] = positions
+        linepositions[ti] = positions
         try:
             onelinefn = ti.decode("utf8")
         except (UnicodeDecodeError, UnicodeEncodeError):
             onelinefn = ti
-        with codecs.open(os.path.join(odir, u"{}_oneline.txt".format(
-                onelinefn)), "w", "utf8") as outf:
+        onelinepath = os.path.join(odir, u"{}_oneline.txt".format(onelinefn))
+        with codecs.open(onelinepath, "w", "utf8") as outf:
             outf.write(ntext)
+        pf.poem_done(ti)
+        mt.poem_done(ti, outpaths=(onelinepath,))
     with codecs.open(os.path.join(logdir, cfg.line_positions.format(
             batch=batchname)), "w", "utf8") as logf:
         for ti, l2posis in sorted(linepositions.items()):
@@ -191,18 +592,115 @@ def merge_lines_and_get_line_positions(t2t, odir, logdir, batchname):
                                                       lnbr + 1, out_posis))
 
 
+def pos_code(pos):
+    """Code for pos-tag pos in L{POS_TAGS}, added if new"""
+    code = POS_CODES.get(pos)
+    if code is None:
+        code = POS_CODES[pos] = len(POS_TAGS)
+        POS_TAGS.append(pos)
+    return code
+
+
+def term_number(tid):
+    """Term-id as an integer ('t12' -> 12), see L{term_id}"""
+    return int(tid[1:])
+
+
+def term_id(nbr):
+    """Term-id for integer nbr (12 -> 't12'), see L{term_number}"""
+    return u"t{}".format(nbr)
+
+
+class TaggedPoem(object):
+    """
+    Pos-tagged poem (see L{read_pos_tagged_poem}), stored compactly: the
+    word-forms in a flat list, and in arrays the pos-tags (codes for
+    L{POS_TAGS}), the term-ids (as integers, see L{term_number}) and the
+    index of each line's first token.
+    Indexing or iterating gives the lines as lists of (word-form, pos,
+    term-id) tuples, like the lists of lines it replaces.
+    """
+    __slots__ = ("forms", "poss", "tids", "starts")
+
+    def __init__(self, lines=()):
+        """
+        @param lines: lines as lists of (word-form, pos, term-id) tuples
+        """
+        self.forms = []
+        self.poss = array.array("H")
+        self.tids = array.array("l")
+        self.starts = array.array("l", [0])
+        for line in lines:
+            self.append(line)
+
+    def append(self, line):
+        """Add a line, a list of (word-form, pos, term-id) tuples"""
+        for wf, pos, tid in line:
+            self.forms.append(wf)
+            self.poss.append(pos_code(pos))
+            self.tids.append(term_number(tid))
+        self.starts.append(len(self.forms))
+
+    def __len__(self):
+        return len(self.starts) - 1
+
+    def line_range(self, idx):
+        """Indexes of the first and after the last token in line idx"""
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("line index out of range")
+        return self.starts[idx], self.starts[idx + 1]
+
+    def __getitem__(self, idx):
+        beg, end = self.line_range(idx)
+        return [(self.forms[tnbr], POS_TAGS[self.poss[tnbr]],
+                 term_id(self.tids[tnbr])) for tnbr in xrange(beg, end)]
+
+    def __iter__(self):
+        for idx in xrange(len(self)):
+            yield self[idx]
+
+    def line_tids(self, idx):
+        """Term-ids (integers) for line idx"""
+        beg, end = self.line_range(idx)
+        return self.tids[beg:end]
+
+    def to_tuple(self):
+        """
+        The poem as a tuple of built-in types, e.g. to marshal it (see
+        L{from_tuple}): word-forms, pos-tags, and term-ids and line starts as
+        array bytes
+        """
+        return (self.forms, [POS_TAGS[code] for code in self.poss],
+                self.tids.tostring(), self.starts.tostring())
+
+    @classmethod
+    def from_tuple(cls, data):
+        """Poem from the output of L{to_tuple}"""
+        forms, poss, tids, starts = data
+        poem = cls()
+        poem.forms = list(forms)
+        poem.poss = array.array("H", [pos_code(pos) for pos in poss])
+        poem.tids = array.array("l")
+        poem.tids.fromstring(tids)
+        poem.starts = array.array("l")
+        poem.starts.fromstring(starts)
+        return poem
+
+
 def read_pos_tagged_poem(inf):
     """
-    Read pos-tagged poem, written as in L{}
+    Read pos-tagged poem, written as in L{extract_pos.write_tagged_lines}
     and return tokens with pos and term-id
     @param inf: input file
+    @return: the poem, as a L{TaggedPoem}
     """
-    tokpoem = []
-    with codecs.open(inf, "r", "utf8") as fni:
+    tokpoem = TaggedPoem()
+    with open_file(inf, "r", "utf8") as fni:
         lines = fni.readlines()
         for ll in lines:
-            toks = re.findall(cfg.TOKRE, ll.strip())
-            tokpoem.append(toks)
+            tokpoem.append(re.findall(cfg.TOKRE, ll.strip()))
     return tokpoem
 
 
@@ -229,7 +727,9 @@ def read_suplemento(cf):
             add_prep_2 = False
             # read dict
             sl = line.strip().split("\t")
-            lemma, lemma2, prep = sl[0], re.sub("rse$", "r", sl[0]), sl[1]
+            # pronominal infinitive to plain infinitive (-rse to -r)
+            lemma, prep = sl[0], sl[1]
+            lemma2 = lemma[0:-2] if lemma.endswith("rse") else lemma
             # contracted preps
             if prep in ("de", "a"):
                 prep2 = prep + "l"
@@ -247,11 +747,11 @@ def read_suplemento(cf):
                     di.setdefault(lemma2, set()).add(prep2)
             # add participles (in case pos-tagging errors)
             if lemma2[-2:] in ("er", "ir"):
-                partic_m = re.sub(r"[ei]r$", "ido", lemma2)
-                partic_f = re.sub(r"[ei]r$", "ida", lemma2)
+                partic_m = lemma2[0:-2] + "ido"
+                partic_f = lemma2[0:-2] + "ida"
             elif lemma2.endswith("ar"):
-                partic_m = re.sub("r$", "do", lemma2)
-                partic_f = re.sub("r$", "da", lemma2)
+                partic_m = lemma2[0:-1] + "do"
+                partic_f = lemma2[0:-1] + "da"
             di.setdefault(partic_m, set()).add(prep)
             di.setdefault(partic_f, set()).add(prep)
             if add_prep_2:
@@ -302,9 +802,67 @@ def read_periphrases(cf):
     return di
 
 
-def normalize_enca_types(cf, etag):
+def lexicon_stamps(cf):
     """
-    Given config, replace an enjambemnt type tag by another one
+    Version stamps for the lexical resources compiled in the lexicon snapshot
+    (see L{compile_lexicons}): snapshot format, Python and marshal versions,
+    and path, size and modification time of each source file
+    """
+    stamps = [LEXICON_SNAPSHOT_VERSION, tuple(sys.version_info[0:2]),
+              marshal.version]
+    for path in (cf.suplemento, cf.periphrases):
+        stat = os.stat(path)
+        stamps.append((os.path.abspath(path), stat.st_size, stat.st_mtime))
+    return tuple(stamps)
+
+
+def compile_lexicons(cf, snapfn=None):
+    """
+    Read the lexical resources (L{read_suplemento}, L{read_periphrases}) and
+    write them to a snapshot file that L{load_lexicons} reads without
+    parsing the sources again (see L{atomic_write})
+    @param cf: config for app, at L{config.py}
+    @param snapfn: snapshot path, L{config.lexicon_snapshot} by default
+    @return: dict with 'suplemento' and 'periphrases'
+    """
+    snapfn = snapfn or cf.lexicon_snapshot
+    stamps = lexicon_stamps(cf)
+    lexicons = {"suplemento": read_suplemento(cf),
+                "periphrases": read_periphrases(cf)}
+    atomic_write(snapfn, marshal.dumps((stamps, lexicons)))
+    return lexicons
+
+
+def load_lexicons(cf, snapfn=None):
+    """
+    Load the lexical resources from their snapshot (see
+    L{compile_lexicons}), compiling it first if missing or if its stamps
+    (L{lexicon_stamps}) don't match the current sources
+    @param cf: config for app, at L{config.py}
+    @param snapfn: snapshot path, L{config.lexicon_snapshot} by default
+    @return: dict with 'suplemento' and 'periphrases'
+    """
+    snapfn = snapfn or cf.lexicon_snapshot
+    stamps = lexicon_stamps(cf)
+    try:
+        with open(snapfn, "rb") as fd:
+            snap_stamps, lexicons = marshal.load(fd)
+        if snap_stamps == stamps:
+            return lexicons
+    except (IOError, EOFError, ValueError, TypeError):
+        pass
+    try:
+        return compile_lexicons(cf, snapfn)
+    except (IOError, OSError):
+        # e.g. read-only data dir: use the sources without a snapshot
+        return {"suplemento": read_suplemento(cf),
+                "periphrases": read_periphrases(cf)}
+
+
+def load_enca_tag_normalization(cf):
+    """
+    Load (regex, replacement) pairs to normalize enjambment type tags,
+    as per path in config cf
     """
     reps = []
     with codecs.open(cf.entagnorm, "r", "utf8") as fd:
@@ -317,26 +875,55 @@ def normalize_enca_types(cf, etag):
             assert sl[0] not in reps
             reps.append((sl[0], sl[1]))
             line = fd.readline()
+    return reps
+
+
+def normalize_enca_types(cf, etag, reps=None):
+    """
+    Given config, replace an enjambemnt type tag by another one
+    @param reps: replacements as output by L{load_enca_tag_normalization},
+    read from config if not given
+    """
+    if reps is None:
+        reps = load_enca_tag_normalization(cf)
     for context, rep in reps:
         if re.search(context, etag):
             etag = re.sub(context, rep, etag)
     return etag
 
 
+def file_list_prefixes(fns):
+    """
+    Prefixes to grep for in results for the filenames in fns (without the
+    _annot suffix used for fns in app)
+    @return: dict with the number of times each prefix is in fns, and
+    sorted prefix lengths
+    """
+    prefixes = {}
+    for fn in fns:
+        prefix = fn.replace("_annot", "")
+        prefixes[prefix] = prefixes.get(prefix, 0) + 1
+    return prefixes, sorted(set(len(prefix) for prefix in prefixes))
+
+
+def matching_prefixes(line, prefixes, lengths):
+    """Prefixes (see L{file_list_prefixes}) that line starts with"""
+    return [line[:length] for length in lengths
+            if line[:length] in prefixes]
+
+
 def grep_file_list_in_results_file(fns, rfn):
     """
     Given filelist fns and results filename rfn, grep in the results
     for the filenames in the list. Return list of matches.
+    (See L{result_index} to read poems from results without scanning them)
     """
+    prefixes, lengths = file_list_prefixes(fns)
     lines = []
-    with codecs.open(rfn, "r", "utf8") as fd:
-        line = fd.readline()
-        while line:
-            for fn in fns:
-                # _annot suffix used in fns in app
-                if line.startswith(fn.replace("_annot", "")):
-                    lines.append(line.strip())
-            line = fd.readline()
+    with io.open(rfn, "r", encoding="utf8") as fd:
+        for line in fd:
+            for prefix in matching_prefixes(line, prefixes, lengths):
+                lines.extend([line.strip()] * prefixes[prefix])
     return lines
 
 
@@ -346,11 +933,14 @@ def grep_file_list_in_results_lines(fns, rfl):
     grep in the results for the filenames in the list.
     Return list of matches.
     """
+    prefixes, lengths = file_list_prefixes(fns)
+    matches = {}
+    for ll in rfl:
+        for prefix in matching_prefixes(ll, prefixes, lengths):
+            matches.setdefault(prefix, []).append(ll.strip())
     lines = []
     for fn in fns:
-        for ll in rfl:
-            if ll.startswith(fn.replace("_annot", "")):
-                lines.append(ll.strip())
+        lines.extend(matches.get(fn.replace("_annot", ""), []))
     return lines
 
 
@@ -397,6 +987,29 @@ def load_enca_tag_translations_as_regex(cf):
     return tagt
 
 
+def load_enca_tag_translations_as_single_regex(cf):
+    """
+    Load translation equivalents for enjambment tags, as per path
+    in config cf, as a single regex matching any tag as a full word
+    (see L{apply_enca_tag_translation_single_regex})
+    @return: regex, and dict with the translation for each tag
+    """
+    tagt = load_enca_tag_translations(cf)
+    # longest first, in case a tag starts another one
+    tags = sorted(tagt, key=len, reverse=True)
+    tagre = re.compile(ur"(?<!\w)(?:{})(?!\w)".format(
+        u"|".join(re.escape(tag) for tag in tags)))
+    return tagre, tagt
+
+
+def apply_enca_tag_translation_single_regex(tagre, trdi, txt):
+    """
+    Translate all tags in txt in one pass, with regex tagre and the
+    translations in trdi (see L{load_enca_tag_translations_as_single_regex})
+    """
+    return tagre.sub(lambda match: trdi[match.group(0)], txt)
+
+
 def translate_enca_tag(tag, trdi):
     """Translate a tag (tag) based on a translation dict (trdi)"""
     if tag not in trdi:
@@ -460,9 +1073,32 @@ def update_span(di, idx, etype, rid, dn, m14):
             di[idx] = filt
 
 
+def index_tree_for_log(tree):
+    """
+    Index a NAF tree's tokens and terms for L{logdep}, so that logging a rule
+    does not need to scan the text and term layers
+    @param tree: NAF tree for NLP results
+    @type tree: L{KafNafParserPy.KafNafParser}
+    @return: dict with token for each token-id ('tokens'), term for each
+    term-id ('terms'), (word-form, token-id) pairs for each sentence number
+    ('sents'), and term-id for the first term spanning each token-id
+    ('tok2term')
+    """
+    idx = {"tokens": {}, "terms": {}, "sents": {}, "tok2term": {}}
+    for tok in tree.text_layer:
+        idx["tokens"][tok.get_id()] = tok
+        idx["sents"].setdefault(tok.get_sent(), []).append(
+            (tok.get_text(), tok.get_id()))
+    for term in tree.term_layer:
+        idx["terms"][term.get_id()] = term
+        idx["tok2term"].setdefault(term.get_span().get_span_ids()[0],
+                                   term.get_id())
+    return idx
+
+
 def logdep(fn, tree, lgfh, idx, rid, cur=(None, None, None),
            nxt=(None, None, None), pen=(None, None, None), sec=(None, None, None),
-           headdep=None):
+           headdep=None, treeidx=None):
     """
     Log details for rules involving dependency info.
     @param fn: filename
@@ -478,36 +1114,31 @@ def logdep(fn, tree, lgfh, idx, rid, cur=(None, None, None),
     @param sec: triple (word-form, pos, term-id) for following line's second token
     @param headdep: head/dependent pair from tree's dependency layer
     @type headdep: L{KafNafParserPy.dependency_data.Cdependency}
+    @param treeidx: indexes for the tree (see L{index_tree_for_log}); pass
+    them when logging several rules for a tree, else they're built here
     @note: .get_dependencies() on the tree is a generator, and tree.dependency_layer
     gives you a L{KafNafParserPy.dependency_data.Cdependencies}
     """
+    if treeidx is None:
+        treeidx = index_tree_for_log(tree)
     pi = u"pen=[{}, {}, {}]".format(pen[0], pen[1], pen[2])
     ci = u"cur=[{}, {}, {}]".format(cur[0], cur[1], cur[2])
     ni = u"nxt=[{}, {}, {}]".format(nxt[0], nxt[1], nxt[2])
     si = u"sec=[{}, {}, {}]".format(sec[0], sec[1], sec[2])
     # figure out head/dependent tokens
-    htok = [tok for tok in tree.text_layer if tok.get_id() ==
-            tree.term_layer.get_term(headdep.get_from()).get_span().get_span_ids()[0]
-           ][0]
+    hterm = treeidx["terms"][headdep.get_from()]
+    dterm = treeidx["terms"][headdep.get_to()]
+    htok = treeidx["tokens"][hterm.get_span().get_span_ids()[0]]
     hwf = htok.get_text()
-    hpos = tree.term_layer.get_term(headdep.get_from()).get_pos()
-    dwf = [tok for tok in tree.text_layer if tok.get_id() ==
-           tree.term_layer.get_term(headdep.get_to()).get_span().get_span_ids()[0]
-          ][0].get_text()
-    dpos = tree.term_layer.get_term(headdep.get_to()).get_pos()
+    hpos = hterm.get_pos()
+    dwf = treeidx["tokens"][dterm.get_span().get_span_ids()[0]].get_text()
+    dpos = dterm.get_pos()
     func = headdep.get_function()
     hdi = u"hea=[{}, {}, {}] | dep=[{}, {}, {}] | func=[{}]".format(
         hwf, hpos, headdep.get_from(), dwf, dpos, headdep.get_to(), func)
     # get sentence
-    sent_nbr = htok.get_sent()
-    sent_tokens = [[tok.get_text(), tok.get_id()] for tok in tree.text_layer
-                   if tok.get_sent() == sent_nbr]
-    sent_terms = [[tk[0],
-                   #[term.get_pos() for term in tree.term_layer
-                   # if term.get_span().get_span_ids()[0] == tk[1]][0],
-                   [term.get_id() for term in tree.term_layer
-                    if term.get_span().get_span_ids()[0] == tk[1]][0]]
-                  for tk in sent_tokens]
+    sent_terms = [(wf, treeidx["tok2term"][wid])
+                  for wf, wid in treeidx["sents"][htok.get_sent()]]
     sent_terms_with_line_boundary = [(te[0], u"{}****".format(te[1]))
                                      if te[1] == cur[2] else (te[0], te[1])
                                      for te in sent_terms]